@@ -0,0 +1,111 @@
+# Evaluation of h0 and the epsilon set on point sets of arbitrary size
+#
+# X is an (N, d) float32 array, usually a memmap (np.load(fname, mmap_mode="r")),
+# and is streamed in chunks. All linear classifiers are stacked into one (M, d)
+# matrix, a chunk costs one matmul and the predictions are kept transposed as a
+# (M + 1, chunk) float32 0/1 block F, the last row holding the labels. The chunk
+# is small enough (CHUNK_BYTES) for F to stay in cache, and everything is read
+# off F right away:
+#     gram = F F^T         [i, j] points on which models i and j both predict True,
+#                          the diagonal and the label row give the errors and
+#                          pairwise disagreement counts
+#     ambiguous            points where 0 < sum of the predictions < M, i.e. some
+#                          member of the epsilon set disagrees with h0
+# Only these counts are kept, so the memory does not grow with N.
+# Model 0 is h0, models 1 ... M-1 are the epsilon set.
+#
+# Example:
+#     X = np.load("points.npy", mmap_mode="r")
+#     evaluator = ChunkedEvaluator(h0, eps_set)
+#     evaluator.evaluate(X, y)
+#     print(evaluator.ambiguity, evaluator.discrepancy, evaluator.risk)
+
+import numpy as np
+
+from utils import Custom_SVM
+
+
+CHUNK_BYTES = 1 << 20
+
+
+class ChunkedEvaluator():
+    def __init__(self, h0: Custom_SVM, eps_set: list, chunk_size: int = None):
+        models = [h0, *eps_set]
+        self.W = np.stack([np.ravel(h.w) for h in models]).astype(np.float32)      # (M, d)
+        self.b = np.array([np.ravel(h.b)[0] for h in models], dtype=np.float32)[:, None]
+        n_models, d = self.W.shape
+        self.chunk_size = chunk_size or max(1024, CHUNK_BYTES // (4 * (n_models + 1 + d)))
+        # Counts of a chunk are exact in float32 as long as the chunk has < 2^24 points
+        assert self.chunk_size < 1 << 24
+        self._F = np.empty((n_models + 1, self.chunk_size), dtype=np.float32)
+        self.reset()
+
+    @property
+    def n_models(self) -> int:
+        return self.W.shape[0]
+
+    def reset(self):
+        self.n_points = 0
+        self.n_labelled = 0
+        self.errors = np.zeros(self.n_models, dtype=np.int64)
+        self.n_ambiguous = 0
+        self.gram = np.zeros((self.n_models, self.n_models), dtype=np.int64)
+
+    def update(self, X: np.ndarray, y: np.ndarray = None):
+        """ Adds the counts of one chunk of at most chunk_size points
+        """
+        M, n = self.n_models, len(X)
+        if n > self.chunk_size:
+            self.evaluate(X, y)
+            return
+        F = self._F[:, :n]
+        Z = self.W @ np.asarray(X, dtype=np.float32).T
+        Z += self.b
+        np.greater(Z, 0, out=F[:M])
+        F[M] = 0 if y is None else np.asarray(y, dtype=bool)
+        gram = np.rint(F @ F.T).astype(np.int64)
+
+        self.n_points += n
+        self.gram += gram[:M, :M]
+        if y is not None:
+            # |P_m != y| = |P_m| + |y| - 2 |P_m and y|
+            self.errors += np.diag(gram)[:M] + gram[M, M] - 2 * gram[:M, M]
+            self.n_labelled += n
+        n_positive = F[:M].sum(axis=0)
+        self.n_ambiguous += np.count_nonzero((n_positive > 0) & (n_positive < M))
+
+    def evaluate(self, X: np.ndarray, y: np.ndarray = None) -> "ChunkedEvaluator":
+        """ Streams X (N, d) and the optional labels y (N,) through all models
+        """
+        for start in range(0, len(X), self.chunk_size):
+            stop = min(start + self.chunk_size, len(X))
+            self.update(X[start:stop], None if y is None else y[start:stop])
+        return self
+
+    @property
+    def disagreement(self) -> np.ndarray:
+        """ (M, M) fraction of points on which two models disagree
+        """
+        positives = np.diag(self.gram)
+        counts = positives[:, None] + positives[None, :] - 2 * self.gram
+        return counts / max(self.n_points, 1)
+
+    @property
+    def risk(self) -> np.ndarray:
+        """ (M,) empirical risk of every model
+        """
+        return self.errors / max(self.n_labelled, 1)
+
+    @property
+    def accuracy(self) -> np.ndarray:
+        return 1 - self.risk
+
+    @property
+    def ambiguity(self) -> float:
+        return self.n_ambiguous / max(self.n_points, 1)
+
+    @property
+    def discrepancy(self) -> float:
+        if self.n_models == 1:
+            return 0.
+        return float(self.disagreement[0, 1:].max())
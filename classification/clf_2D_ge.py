@@ -5,6 +5,7 @@ from matplotlib.gridspec import GridSpec
 
 from sklearn import svm
 from utils import Custom_SVM
+from rashomon_2d import RashomonSet2D
 
 from plot_glyph import draw_binary_glyph, explain_binary_glyph, TRUE_GREEN, FALSE_RED
 
@@ -30,19 +31,19 @@ def make_marx_dataset(n: int = 10):
 
 
 
-def example_baseline_and_epsilon_set():
+def example_baseline_and_epsilon_set(X=None, y=None, epsilon: float = 0.04, n: int = 2):
+    # Members spread over the exact epsilon set of the hyperplanes through the origin
+    if X is None:
+        X, y = make_dataset(n=100, sampling="mesh")
     h0 = Custom_SVM(w=np.array([1, 0]), b=0)
-    eps_set = []
-    for i in range(2):
-        clf = Custom_SVM(w=np.array([np.cos((2*i-1)*np.pi/20), np.sin((2*i-1)*np.pi/20)]), b=0)
-        eps_set.append(clf)
+    eps_set = RashomonSet2D(X, y, epsilon, h0=h0).representatives(n)
     return h0, eps_set
 
 def main():
     X, y = make_dataset(n=100, sampling="mesh")
     X_custom, y_custom = make_dataset(n=15, sampling="random")
     X_custom, y_custom = X, y
-    h0, eps_set = example_baseline_and_epsilon_set()
+    h0, eps_set = example_baseline_and_epsilon_set(X, y)
 
     # X, y = make_marx_dataset(n=10)
     # h0, eps_set = fit_baseline_and_epsilon_set(X, y, n_representatives=3)
@@ -5,8 +5,10 @@ from matplotlib.gridspec import GridSpec
 
 from sklearn import svm
 from utils import Custom_SVM
+from rashomon_2d import RashomonSet2D
 
 from plot_glyph import draw_binary_glyph, explain_binary_glyph, TRUE_GREEN, FALSE_RED
+from figure_builder import FigureBuilder
 
 
 cm = 1/2.54
@@ -51,14 +53,12 @@ def fit_baseline_and_epsilon_set(X, y, epsilon=0.1, n_representatives=3):
             break
     return h0, eps_set
 
-def example_baseline_and_epsilon_set():
+def example_baseline_and_epsilon_set(X=None, y=None, epsilon: float = 0., n: int = 3):
+    # Members spread over the exact epsilon set of the hyperplanes through the origin
+    if X is None:
+        X, y = make_xor_dataset(n=100, sampling="mesh")
     h0 = Custom_SVM(w=np.array([0, 1]), b=0)
-    eps_set = []
-
-    for i in range(3):
-        clf = Custom_SVM(w=np.array([np.sin((i+1)*np.pi/5),
-                                     np.cos((i+1)*np.pi/5)]), b=0)
-        eps_set.append(clf)
+    eps_set = RashomonSet2D(X, y, epsilon, h0=h0).representatives(n, max_angle=np.pi/2)
     return h0, eps_set
 
 # Plot for presentation
@@ -87,55 +87,78 @@ def plot_only_dataset():
     
     fig.savefig("../figures/xor/only_data.png", dpi=300)
 
-def plot_with_classifier(n: int = 0, plot_glyph: bool=False):
+def plot_with_classifier_sequence(ns=range(4), plot_glyph: bool=False):
+    # Data and shaded areas are rendered once, every figure only adds the decision
+    # boundaries of the next epsilon set members. The glyphs are drawn below the
+    # boundaries, so with glyphs the boundaries are redrawn on top of them per figure
     X, y = make_xor_dataset(n=100, sampling="mesh")
-    fig, ax = plt.subplots(1, 1, figsize=(10*cm, 10*cm))
-    color = np.full((len(y), 3), FALSE_RED)
-    color[y] = TRUE_GREEN
-    ax.scatter(X[:, 0], X[:, 1], c=color, s=4)
-    
-    # Shade area
-    ax.fill_between([-1, 0], [0, 0], [1, 1], color=TRUE_GREEN, alpha=0.4)
-    ax.fill_between([0, 1], [-1, -1], [0, 0], color=TRUE_GREEN, alpha=0.4)
-    ax.fill_between([-1, 0], [-1, -1], [0, 0], color=FALSE_RED, alpha=0.4)
-    ax.fill_between([0, 1], [0, 0], [1, 1], color=FALSE_RED, alpha=0.4)
-        
-    ## Classifiers
     h0, eps_set = example_baseline_and_epsilon_set()
-    
-    if plot_glyph:
-        eps_set = eps_set[:n]
-        idz = [16, 24, 28, 31, 54, 58, 61, 85]
-        X_custom, y_custom = X[idz], y[idz]
-        # Draw glyphs
-        for i in range(X_custom.shape[0]):
-            draw_binary_glyph(ax, X_custom[i, 0], X_custom[i, 1], [h.predict(X_custom[i]) for h in eps_set], h0.predict(X_custom[i]), y_custom[i])
+    idz = [16, 24, 28, 31, 54, 58, 61, 85]
+    X_custom, y_custom = X[idz], y[idz]
 
     X_plot, Y_plot = np.meshgrid(np.arange(-1, 1, 0.01), np.arange(-1, 1, 0.01))
     X_concat = np.c_[X_plot.ravel(), Y_plot.ravel()]
-    # Baseline
-    Z = h0.decision_function(X_concat).reshape(X_plot.shape)
-    ax.contour(X_plot, Y_plot, Z, colors=["k"], linestyles=['--'], levels=[0])
-    # Epsilon Set
     colors = ["tab:blue", "tab:orange", "tab:green", "tab:purple"]
-    for i in range(n):
-        clf = eps_set[i]
-        Z = clf.decision_function(X_concat).reshape(X_plot.shape)
-        ax.contour(X_plot, Y_plot, Z, colors=[colors[i]], linestyles=['--'], levels=[0])
 
+    def draw_base(ax):
+        color = np.full((len(y), 3), FALSE_RED)
+        color[y] = TRUE_GREEN
+        ax.scatter(X[:, 0], X[:, 1], c=color, s=4)
+
+        # Shade area
+        ax.fill_between([-1, 0], [0, 0], [1, 1], color=TRUE_GREEN, alpha=0.4)
+        ax.fill_between([0, 1], [-1, -1], [0, 0], color=TRUE_GREEN, alpha=0.4)
+        ax.fill_between([-1, 0], [-1, -1], [0, 0], color=FALSE_RED, alpha=0.4)
+        ax.fill_between([0, 1], [0, 0], [1, 1], color=FALSE_RED, alpha=0.4)
+
+        # Annotation
+        ax.set_xlabel('$x_1$')
+        ax.set_ylabel('$x_2$')
+        ax.set_xlim(-1, 1)
+        ax.set_ylim(-1, 1)
+        ax.set_xticks(np.arange(-1, 1.1, 1))
+        ax.set_yticks(np.arange(-1, 1.1, 1))
+
+    def draw_baseline(ax):
+        Z = h0.decision_function(X_concat).reshape(X_plot.shape)
+        ax.contour(X_plot, Y_plot, Z, colors=["k"], linestyles=['--'], levels=[0])
+
+    def draw_boundaries(start, stop):
+        def draw(ax):
+            for i in range(start, stop):
+                Z = eps_set[i].decision_function(X_concat).reshape(X_plot.shape)
+                ax.contour(X_plot, Y_plot, Z, colors=[colors[i]], linestyles=['--'], levels=[0])
+        return draw
+
+    def draw_glyphs_and_boundaries(n):
+        def draw(ax):
+            # A glyph needs at least one epsilon set member, without any there are none
+            for i in range(X_custom.shape[0] if n > 0 else 0):
+                draw_binary_glyph(ax, X_custom[i, 0], X_custom[i, 1], [h.predict(X_custom[i]) for h in eps_set[:n]],
+                                  h0.predict(X_custom[i]), y_custom[i])
+            draw_baseline(ax)
+            draw_boundaries(0, n)(ax)
+        return draw
+
+    builder = FigureBuilder(figsize=(10*cm, 10*cm), dpi=300)
+    builder.layer(draw_base)
+    if plot_glyph:
+        builder.freeze()
+        for n in ns:
+            with builder.variant(draw_glyphs_and_boundaries(n)):
+                builder.save(f"../figures/xor/with_{n}_classifiers.png")
+        return
+
+    builder.layer(draw_baseline)
+    builder.freeze()
+    n_drawn = 0
+    for n in sorted(ns):
+        builder.add(draw_boundaries(n_drawn, max(n_drawn, n)))
+        n_drawn = max(n_drawn, n)
+        builder.save(f"../figures/xor/with_{n}_classifiers.png")
 
-    
-    # Annotation
-    ax.set_xlabel('$x_1$')
-    ax.set_ylabel('$x_2$')
-    ax.set_xlim(-1, 1)
-    ax.set_ylim(-1, 1)
-    # axs[0].grid()
-    # axs[0].set_title('XOR Dataset')
-    ax.set_xticks(np.arange(-1, 1.1, 1))
-    ax.set_yticks(np.arange(-1, 1.1, 1))
-    
-    fig.savefig(f"../figures/xor/with_{n}_classifiers.png", dpi=300)
+def plot_with_classifier(n: int = 0, plot_glyph: bool=False):
+    plot_with_classifier_sequence([n], plot_glyph=plot_glyph)
 
 def plot_pm_for_all():
     X, y = make_xor_dataset(n=100, sampling="mesh")
@@ -328,5 +351,4 @@ if __name__ == "__main__":
     plot_only_dataset()
     plot_pred_for_baseline()
     plot_pm_for_all()
-    for n in range(4):
-        plot_with_classifier(n)
\ No newline at end of file
+    plot_with_classifier_sequence(range(4))
\ No newline at end of file
@@ -0,0 +1,118 @@
+# Incremental figures for sequences of classifier variants
+#
+# The layers every variant shares (data points, shaded regions, baseline, axes) are
+# drawn once and the rendered raster is cached. A variant only draws its delta
+# layers (e.g. one more decision boundary) on top of the cached raster:
+#     add:     the delta stays, the cache is updated (cumulative sequences)
+#     variant: the delta is removed again afterwards (independent variants)
+# The base artists above OVERLAY_ZORDER (spines, texts) are kept out of the cache and
+# drawn with every delta in zorder, as in a full draw. The rest of the base is always
+# below a delta, so layers that have to stay above it (e.g. lines over glyphs)
+# belong to the delta, not to the frozen base.
+# Raster outputs (png, jpg) are written straight from the canvas buffer, vector
+# outputs fall back to a full savefig of the current artists.
+#
+# Usage:
+#     builder = FigureBuilder(figsize=(10*cm, 10*cm))
+#     builder.layer(lambda ax: ax.scatter(X[:, 0], X[:, 1]))
+#     builder.freeze()
+#     for clf in eps_set:
+#         builder.add(lambda ax: ax.contour(...))
+#         builder.save(f"with_{i}.png")
+
+import contextlib
+import os
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+RASTER_FORMATS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".webp")
+# Artists above this zorder (spines, texts) are not cached but drawn over every delta
+OVERLAY_ZORDER = 2
+
+
+def _by_zorder(artists: list) -> list:
+    # Stable, i.e. the order of a full draw
+    return sorted(artists, key=lambda a: a.get_zorder())
+
+
+class FigureBuilder():
+    def __init__(self, figsize=(4, 4), dpi: int = 300):
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+        self._background = None
+        self._overlay = []
+
+    def layer(self, draw_fn) -> list:
+        """ Calls draw_fn(ax) and returns the artists it added
+        """
+        before = set(self.ax.get_children())
+        draw_fn(self.ax)
+        return [a for a in self.ax.get_children() if a not in before]
+
+    def freeze(self):
+        """ Renders everything drawn so far once and caches the raster as the base
+        """
+        self._overlay = [a for a in self.ax.get_children()
+                         if a.get_visible() and a.get_zorder() > OVERLAY_ZORDER]
+        for artist in self._overlay:
+            artist.set_visible(False)
+        self.canvas.draw()
+        self._background = self.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self._overlay:
+            artist.set_visible(True)
+        self._blit([])
+
+    def _blit(self, artists: list):
+        # The delta and the overlay in the order of a full draw on top of the cached raster,
+        # the overlay was added first
+        self.canvas.restore_region(self._background)
+        for artist in _by_zorder(self._overlay + artists):
+            self.ax.draw_artist(artist)
+
+    def add(self, draw_fn) -> list:
+        """ Delta layer that stays for all following outputs
+        """
+        artists = self.layer(draw_fn)
+        if self._background is None:
+            self.freeze()
+            return artists
+        cached = [a for a in artists if a.get_zorder() <= OVERLAY_ZORDER]
+        self.canvas.restore_region(self._background)
+        for artist in _by_zorder(cached):
+            self.ax.draw_artist(artist)
+        self._background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._overlay += [a for a in artists if a.get_zorder() > OVERLAY_ZORDER]
+        self._blit([])
+        return artists
+
+    @contextlib.contextmanager
+    def variant(self, draw_fn):
+        """ Delta layer that only exists within the with block
+        """
+        artists = self.layer(draw_fn)
+        if self._background is None:
+            self.freeze()
+        self._blit(artists)
+        try:
+            yield artists
+        finally:
+            for artist in artists:
+                artist.remove()
+            self._blit([])
+
+    def snapshot(self) -> np.ndarray:
+        """ Current raster (height, width, 4) uint8, e.g. as a frame of an animation
+        """
+        return np.asarray(self.canvas.buffer_rgba()).copy()
+
+    def save(self, fname: str, **savefig_kwargs):
+        if self._background is not None and os.path.splitext(fname)[1].lower() in RASTER_FORMATS \
+                and not savefig_kwargs:
+            plt.imsave(fname, np.asarray(self.canvas.buffer_rgba()), dpi=self.fig.dpi)
+        else:
+            self.fig.savefig(fname, dpi=self.fig.dpi, **savefig_kwargs)
@@ -0,0 +1,205 @@
+# Exact Rashomon set of 2D linear classifiers
+#
+# A classifier predicts x @ w + b > 0 with w = (cos(theta), sin(theta)). For a fixed
+# offset b, a point x = r * (cos(phi), sin(phi)) changes its side exactly at the two
+# critical angles theta = phi +- arccos(-b / r). Sorting the 2N critical angles and
+# sweeping once around the circle gives the empirical risk of every angle, and so the
+# epsilon set as angular intervals, in O(N log N).
+#
+# Ambiguity and discrepancy w.r.t. the baseline h0 follow from the same sweep:
+#     ambiguity: fraction of points on which some member of the epsilon set disagrees with h0
+#     discrepancy: max over the members of the fraction of points they disagree with h0 on
+#
+# Angles where a boundary passes exactly through a point have measure zero and are ignored.
+#
+# Example:
+#     rs = RashomonSet2D(X, y, epsilon=0.05, h0=h0)
+#     print(rs.intervals, rs.ambiguity, rs.discrepancy)
+#     eps_set = rs.representatives(3)
+
+import numpy as np
+
+from utils import Custom_SVM
+
+
+TWO_PI = 2 * np.pi
+
+
+def angle_of(clf: Custom_SVM) -> tuple:
+    """ (theta, b) of a linear classifier, normalized to |w| = 1
+    """
+    w = np.asarray(clf.w, dtype=float)
+    norm = np.linalg.norm(w)
+    return np.arctan2(w[1], w[0]) % TWO_PI, clf.b / norm
+
+
+def from_angle(theta: float, b: float = 0.) -> Custom_SVM:
+    return Custom_SVM(w=np.array([np.cos(theta), np.sin(theta)]), b=b)
+
+
+def angular_sweep(X: np.ndarray, y: np.ndarray, b: float, reference: np.ndarray = None) -> dict:
+    """ Risk on every angular segment between the critical angles
+
+    Input:
+        X.shape = (n, 2), y.shape = (n,) bool
+        reference: (n,) bool predictions, e.g. of h0, the disagreement with it is swept as well
+    Returns:
+        boundaries: (m+2,) 0, the sorted critical angles, 2 pi; segment j = [boundaries[j], boundaries[j+1])
+        risk, disagreement: (m+1,) per segment
+        down, up: (n,) segment index at which a point turns negative / positive, -1 if it never changes
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=bool)
+    n = len(X)
+    r = np.hypot(X[:, 0], X[:, 1])
+    phi = np.arctan2(X[:, 1], X[:, 0])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos_alpha = np.where(r > 0, -b / r, np.sign(-b) * np.inf)
+    changes = np.abs(cos_alpha) < 1
+    alpha = np.arccos(np.clip(cos_alpha[changes], -1, 1))
+    idx = np.nonzero(changes)[0]
+
+    # Positive on (phi - alpha, phi + alpha): turns negative at phi + alpha, positive at phi - alpha
+    angles = np.concatenate([(phi[idx] + alpha) % TWO_PI, (phi[idx] - alpha) % TWO_PI])
+    points = np.concatenate([idx, idx])
+    turns_positive = np.concatenate([np.zeros(len(idx), dtype=bool), np.ones(len(idx), dtype=bool)])
+    order = np.argsort(angles, kind="stable")
+    angles, points, turns_positive = angles[order], points[order], turns_positive[order]
+
+    # Start at theta = 0 and count the changes of every event
+    pred = X[:, 0] + b > 0
+    errors0 = np.sum(pred != y)
+    delta = np.where(turns_positive == y[points], -1, 1)
+    risk = np.concatenate([[errors0], errors0 + np.cumsum(delta)]) / n
+
+    result = {"boundaries": np.concatenate([[0.], angles, [TWO_PI]]), "risk": risk}
+    if reference is not None:
+        reference = np.asarray(reference, dtype=bool)
+        disagree0 = np.sum(pred != reference)
+        delta = np.where(turns_positive == reference[points], -1, 1)
+        result["disagreement"] = np.concatenate([[disagree0], disagree0 + np.cumsum(delta)]) / n
+
+    # The segment after event e is e + 1
+    down, up = np.full(n, -1), np.full(n, -1)
+    down[points[~turns_positive]] = np.nonzero(~turns_positive)[0] + 1
+    up[points[turns_positive]] = np.nonzero(turns_positive)[0] + 1
+    result.update(down=down, up=up, pred0=pred)
+    return result
+
+
+def _merge_intervals(boundaries: np.ndarray, inside: np.ndarray) -> list:
+    """ Merges consecutive segments inside the set into (start, end) intervals, across 2 pi
+    """
+    intervals = []
+    for j in np.nonzero(inside)[0]:
+        start, end = boundaries[j], boundaries[j + 1]
+        if intervals and np.isclose(intervals[-1][1], start):
+            intervals[-1] = (intervals[-1][0], float(end))
+        else:
+            intervals.append((float(start), float(end)))
+    if len(intervals) > 1 and intervals[0][0] == 0. and intervals[-1][1] == TWO_PI:
+        start, _ = intervals.pop()
+        intervals[0] = (start - TWO_PI, intervals[0][1])
+    return intervals
+
+
+class RashomonSet2D():
+    def __init__(self, X: np.ndarray, y: np.ndarray, epsilon: float,
+                 offsets=(0.,), h0: Custom_SVM = None):
+        """ All linear classifiers with an offset in offsets and risk <= risk(h0) + epsilon
+
+        h0: baseline, by default the best classifier over all angles and offsets
+        """
+        self.X = np.asarray(X, dtype=float)
+        self.y = np.asarray(y, dtype=bool)
+        self.epsilon = epsilon
+        self.offsets = np.atleast_1d(np.asarray(offsets, dtype=float))
+
+        if h0 is None:
+            best = None
+            for b in self.offsets:
+                sweep = angular_sweep(self.X, self.y, b)
+                width = np.diff(sweep["boundaries"])
+                risk = np.where(width > 0, sweep["risk"], np.inf)
+                j = np.argmin(risk)
+                if best is None or risk[j] < best[0]:
+                    best = (risk[j], sweep["boundaries"][j] + width[j] / 2, b)
+            h0 = from_angle(best[1], best[2])
+        self.h0 = h0
+        self.theta0, self.b0 = angle_of(h0)
+        reference = h0.predict(self.X)
+        self.risk_h0 = h0.empirical_risk(self.X, self.y)
+
+        self.intervals = {}
+        self.discrepancy = 0.
+        ambiguous = np.zeros(len(self.X), dtype=bool)
+        for b in self.offsets:
+            sweep = angular_sweep(self.X, self.y, b, reference=reference)
+            boundaries = sweep["boundaries"]
+            inside = (sweep["risk"] <= self.risk_h0 + epsilon + 1e-12) & (np.diff(boundaries) > 0)
+            self.intervals[float(b)] = _merge_intervals(boundaries, inside)
+            if not inside.any():
+                continue
+            self.discrepancy = max(self.discrepancy, sweep["disagreement"][inside].max())
+            ambiguous |= self._ambiguous(sweep, inside, reference)
+        self.ambiguous = ambiguous
+        self.ambiguity = ambiguous.mean()
+
+    @staticmethod
+    def _ambiguous(sweep: dict, inside: np.ndarray, reference: np.ndarray) -> np.ndarray:
+        # A point disagrees with h0 on a cyclic range of segments, it is ambiguous
+        # if that range contains a segment of the epsilon set
+        n_segments = len(inside)
+        count = np.concatenate([[0], np.cumsum(inside)])
+        down, up = sweep["down"], sweep["up"]
+        constant = down < 0
+        # Constant points disagree everywhere or nowhere
+        result = constant & (sweep["pred0"] != reference)
+
+        # Negative on the segments down .. up - 1, positive on up .. down - 1 (cyclic)
+        start = np.where(reference, down, up)[~constant]
+        stop = np.where(reference, up, down)[~constant]
+        inner = np.where(start <= stop, count[stop] - count[start],
+                         count[n_segments] - count[start] + count[stop])
+        result[~constant] = inner > 0
+        return result
+
+    def measure(self, b: float = None) -> float:
+        """ Angular measure of the epsilon set at offset b (default: the one of h0)
+        """
+        return sum(end - start for start, end in self.intervals[self._offset(b)])
+
+    def _offset(self, b: float = None) -> float:
+        b = self.b0 if b is None else b
+        return float(self.offsets[np.argmin(np.abs(self.offsets - b))])
+
+    def representatives(self, n: int, b: float = None, max_angle: float = None) -> list:
+        """ n members evenly spread over the epsilon set at offset b, walking
+        counter-clockwise from the angle of h0
+
+        max_angle: only members within this angle of h0, e.g. pi / 2 to avoid
+                   flipped copies of the decision boundaries
+        """
+        b = self._offset(b)
+        intervals = [((s - self.theta0) % TWO_PI, (s - self.theta0) % TWO_PI + (e - s))
+                     for s, e in self.intervals[b]]
+        # Split the interval containing h0, so the walk starts at h0
+        pieces = []
+        for s, e in intervals:
+            if e > TWO_PI:
+                pieces += [(0., e - TWO_PI), (s, TWO_PI)]
+            else:
+                pieces.append((s, e))
+        if max_angle is not None:
+            pieces = [(max(s, lo), min(e, hi)) for s, e in pieces
+                      for lo, hi in [(0., max_angle), (TWO_PI - max_angle, TWO_PI)]
+                      if min(e, hi) > max(s, lo)]
+        pieces.sort()
+        lengths = np.array([e - s for s, e in pieces])
+        if len(pieces) == 0 or lengths.sum() == 0:
+            return []
+        positions = (np.arange(1, n + 1) / (n + 1)) * lengths.sum()
+        cum = np.concatenate([[0], np.cumsum(lengths)])
+        k = np.minimum(np.searchsorted(cum, positions, side="right") - 1, len(pieces) - 1)
+        thetas = np.array([pieces[i][0] for i in k]) + positions - cum[k] + self.theta0
+        return [from_angle(theta, b) for theta in thetas]
@@ -0,0 +1,169 @@
+# MCMC sampler of the Rashomon set of linear classifiers in d dimensions
+#
+# A classifier predicts x @ w + b > 0, which only depends on the direction of
+# theta = (w, b). The chains move on the unit sphere in R^(d+1) and sample uniformly
+# from the epsilon set {theta: risk(theta) <= risk(h0) + epsilon}: a move is accepted
+# iff it stays in the set. The risks of all chains are one (chains, N) matmul.
+#
+# Moves:
+#     random_walk: theta + step * gaussian, projected back onto the sphere
+#     hit_and_run: a random great circle through theta, the angle along it is drawn
+#                  uniformly and the bracket is shrunk towards theta after every
+#                  rejection (slice sampling), so a chain always moves
+#
+# Ambiguity and discrepancy w.r.t. h0 are estimated from the thinned samples of all
+# chains pooled (any disagreement over all chains, max disagreement over all chains).
+# Their Monte Carlo error is the spread of the pooled statistics over N_BOOTSTRAP
+# resamples of the chains with replacement; the resamples are drawn once from their
+# own Generator (SeedSequence(seed, spawn_key=(1,))), so the chains are not affected.
+# They are computed on demand; history holds the point estimates of every record and
+# the standard errors only at the end of each run.
+#
+# Example:
+#     sampler = RashomonMCMC(X, y, epsilon=0.05, h0=h0, n_chains=64, seed=0)
+#     sampler.run(n_samples=50, burn_in=100, thin=10)
+#     print(sampler.ambiguity, sampler.ambiguity_se)
+#     eps_set = sampler.models()
+
+import numpy as np
+
+from utils import Custom_SVM
+
+
+N_BOOTSTRAP = 200
+
+class RashomonMCMC():
+    def __init__(self, X: np.ndarray, y: np.ndarray, epsilon: float, h0: Custom_SVM,
+                 n_chains: int = 64, move: str = "hit_and_run", step: float = 0.1,
+                 max_shrink: int = 20, seed=None):
+        assert move in ("random_walk", "hit_and_run")
+        self.X = np.hstack([np.asarray(X, dtype=float), np.ones((len(X), 1))])
+        self.y = np.asarray(y, dtype=bool)
+        self.epsilon = epsilon
+        self.h0 = h0
+        self.move = move
+        self.step_size = step
+        self.max_shrink = max_shrink
+        self.rng = np.random.default_rng(seed)
+
+        theta0 = np.append(np.ravel(h0.w), h0.b).astype(float)
+        self.theta0 = theta0 / np.linalg.norm(theta0)
+        self.reference = self._predict(self.theta0[None])[0]
+        self.threshold = np.mean(self.reference != self.y) + epsilon
+        self.theta = np.repeat(self.theta0[None], n_chains, axis=0)
+        self.n_chains = n_chains
+        # (N_BOOTSTRAP, chains) True for the chains in a resample
+        resamples = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(1,))) \
+            .integers(n_chains, size=(N_BOOTSTRAP, n_chains))
+        self._resampled = np.zeros((N_BOOTSTRAP, n_chains), dtype=bool)
+        np.put_along_axis(self._resampled, resamples, True, axis=1)
+
+        self.n_proposed = 0
+        self.n_accepted = 0
+        self.samples = []
+        # Per chain: points on which a sample disagreed with h0, max disagreement
+        self._ambiguous = np.zeros((n_chains, len(self.X)), dtype=bool)
+        self._discrepancy = np.zeros(n_chains)
+        self.history = []
+
+    def _predict(self, theta: np.ndarray) -> np.ndarray:
+        return theta @ self.X.T > 0
+
+    def risk(self, theta: np.ndarray) -> np.ndarray:
+        """ Empirical risk of every row of theta (chains, d+1)
+        """
+        return np.mean(self._predict(theta) != self.y, axis=-1)
+
+    def _in_set(self, theta: np.ndarray) -> np.ndarray:
+        return self.risk(theta) <= self.threshold + 1e-12
+
+    def _random_walk(self):
+        proposal = self.theta + self.step_size * self.rng.normal(0, 1, self.theta.shape)
+        proposal /= np.linalg.norm(proposal, axis=-1, keepdims=True)
+        accept = self._in_set(proposal)
+        self.theta[accept] = proposal[accept]
+        self.n_proposed += len(accept)
+        self.n_accepted += accept.sum()
+
+    def _hit_and_run(self):
+        # Direction orthogonal to theta: theta(t) = cos(t) theta + sin(t) u stays on the sphere
+        u = self.rng.normal(0, 1, self.theta.shape)
+        u -= np.sum(u * self.theta, axis=-1, keepdims=True) * self.theta
+        u /= np.linalg.norm(u, axis=-1, keepdims=True)
+        lo, hi = np.full(self.n_chains, -np.pi), np.full(self.n_chains, np.pi)
+        pending = np.arange(self.n_chains)
+        for _ in range(self.max_shrink):
+            t = self.rng.uniform(lo[pending], hi[pending])[:, None]
+            proposal = np.cos(t) * self.theta[pending] + np.sin(t) * u[pending]
+            accept = self._in_set(proposal)
+            self.n_proposed += len(pending)
+            self.n_accepted += accept.sum()
+            self.theta[pending[accept]] = proposal[accept]
+            # Shrink the bracket towards the current point (t = 0)
+            t, pending = t[~accept, 0], pending[~accept]
+            lo[pending] = np.where(t < 0, t, lo[pending])
+            hi[pending] = np.where(t >= 0, t, hi[pending])
+            if len(pending) == 0:
+                break
+
+    def step(self):
+        if self.move == "random_walk":
+            self._random_walk()
+        else:
+            self._hit_and_run()
+
+    def _record(self):
+        self.samples.append(self.theta.copy())
+        disagree = self._predict(self.theta) != self.reference
+        self._ambiguous |= disagree
+        self._discrepancy = np.maximum(self._discrepancy, disagree.mean(axis=-1))
+        # Point estimates only, the bootstrap of the standard errors runs once per run
+        self.history.append({"n_samples": len(self.samples) * self.n_chains,
+                             "ambiguity": self.ambiguity, "discrepancy": self.discrepancy})
+
+    def run(self, n_samples: int = 50, burn_in: int = 100, thin: int = 10) -> np.ndarray:
+        """ n_samples per chain, every thin-th state after burn_in steps
+
+        Returns:
+            all samples so far, shape (n_samples * n_chains, d+1), unit norm (w, b)
+        """
+        for _ in range(burn_in):
+            self.step()
+        for _ in range(n_samples):
+            for _ in range(thin):
+                self.step()
+            self._record()
+        if self.history:
+            self.history[-1].update(ambiguity_se=self.ambiguity_se, discrepancy_se=self.discrepancy_se)
+        return self.sample_array()
+
+    def sample_array(self) -> np.ndarray:
+        if not self.samples:
+            return np.zeros((0, self.X.shape[1]))
+        return np.concatenate(self.samples)
+
+    def models(self) -> list:
+        return [Custom_SVM(w=theta[:-1], b=theta[-1]) for theta in self.sample_array()]
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.n_accepted / max(self.n_proposed, 1)
+
+    @property
+    def ambiguity(self) -> float:
+        return float(self._ambiguous.any(axis=0).mean())
+
+    @property
+    def ambiguity_se(self) -> float:
+        # Pooled ambiguity of every resample: a point is ambiguous if any chain in it flagged it
+        ambiguous = self._resampled.astype(np.int32) @ self._ambiguous.astype(np.int32) > 0
+        return float(ambiguous.mean(axis=-1).std(ddof=1))
+
+    @property
+    def discrepancy(self) -> float:
+        return float(self._discrepancy.max())
+
+    @property
+    def discrepancy_se(self) -> float:
+        discrepancy = np.where(self._resampled, self._discrepancy, -np.inf).max(axis=-1)
+        return float(discrepancy.std(ddof=1))
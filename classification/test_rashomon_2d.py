@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from rashomon_2d import TWO_PI, RashomonSet2D, angular_sweep, from_angle
+
+
+# Brute force: every classifier of a dense grid of angles
+THETAS = (np.arange(200000) + 0.5) / 200000 * TWO_PI
+
+
+def data(seed: int, n: int = 40) -> tuple:
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, 2))
+    y = X @ np.array([1., 0.5]) + 0.3 * rng.normal(size=n) > 0
+    return X, y
+
+
+def grid_predictions(X: np.ndarray, b: float) -> np.ndarray:
+    # (n_thetas, n) predictions of all grid classifiers
+    return np.cos(THETAS)[:, None] * X[:, 0] + np.sin(THETAS)[:, None] * X[:, 1] + b > 0
+
+
+def segment_of(boundaries: np.ndarray, thetas: np.ndarray) -> np.ndarray:
+    return np.searchsorted(boundaries, thetas, side="right") - 1
+
+
+@pytest.mark.parametrize("seed, b", [(0, 0.), (1, 0.4), (2, -0.7)])
+def test_sweep_risk(seed, b):
+    X, y = data(seed)
+    reference = from_angle(1., b).predict(X)
+    sweep = angular_sweep(X, y, b, reference=reference)
+    segments = segment_of(sweep["boundaries"], THETAS)
+    pred = grid_predictions(X, b)
+    np.testing.assert_allclose(sweep["risk"][segments], (pred != y).mean(axis=1))
+    np.testing.assert_allclose(sweep["disagreement"][segments], (pred != reference).mean(axis=1))
+
+
+@pytest.mark.parametrize("seed, epsilon, offsets", [(0, 0.05, (0.,)),
+                                                    (1, 0.1, (0.,)),
+                                                    (2, 0.05, (-0.3, 0., 0.3))])
+def test_rashomon_set(seed, epsilon, offsets):
+    X, y = data(seed)
+    rs = RashomonSet2D(X, y, epsilon, offsets=offsets)
+
+    ambiguous = np.zeros(len(X), dtype=bool)
+    discrepancy = 0.
+    reference = rs.h0.predict(X)
+    for b in offsets:
+        pred = grid_predictions(X, b)
+        inside = (pred != y).mean(axis=1) <= rs.risk_h0 + epsilon + 1e-12
+        in_intervals = np.zeros(len(THETAS), dtype=bool)
+        for start, end in rs.intervals[float(b)]:
+            in_intervals |= ((THETAS - start) % TWO_PI) < end - start
+        np.testing.assert_array_equal(in_intervals, inside)
+        np.testing.assert_allclose(rs.measure(b), inside.mean() * TWO_PI, atol=1e-3)
+
+        disagree = pred[inside] != reference
+        ambiguous |= disagree.any(axis=0)
+        discrepancy = max(discrepancy, disagree.mean(axis=1).max(initial=0.))
+    np.testing.assert_array_equal(rs.ambiguous, ambiguous)
+    assert rs.ambiguity == pytest.approx(ambiguous.mean())
+    assert rs.discrepancy == pytest.approx(discrepancy)
+
+
+def test_default_h0_is_a_best_classifier():
+    X, y = data(3)
+    rs = RashomonSet2D(X, y, 0.)
+    assert rs.risk_h0 == pytest.approx((grid_predictions(X, 0.) != y).mean(axis=1).min())
+
+
+def test_representatives_are_members():
+    X, y = data(4)
+    rs = RashomonSet2D(X, y, 0.1)
+    members = rs.representatives(5)
+    assert len(members) == 5
+    for clf in members:
+        assert clf.empirical_risk(X, y) <= rs.risk_h0 + 0.1 + 1e-12
@@ -0,0 +1,194 @@
+# Adjacency of the knowledge graph and k-hop neighbourhoods around query entities
+#
+# Every triple (h, r, t) is stored twice, as the edge h -> t in direction OUT and as
+# t -> h in direction IN, in one CSR sorted by (direction, source, relation):
+# the edges of row = direction * n_entities + source are
+# targets[indptr[row]:indptr[row+1]], and the edges of a single relation are a
+# contiguous part of that row, found by binary search on the sorted keys.
+# So one structure serves the merged and the per relation adjacency in both directions.
+#
+# k_hop expands the frontiers of a whole batch of anchors at once: every hop is one
+# gather of the neighbours of all (anchor, node) pairs of the frontier (repeat/offsets)
+# and one np.unique to drop the nodes already visited. induced_subgraphs keeps the
+# edges between the nodes of each neighbourhood.
+#
+# Usage:
+#     adjacency = Adjacency(store.all_triples(["train"]), store.n_entities, store.n_relations)
+#     context = adjacency.context(anchors, k=2, max_degree=100)
+#     nodes, hops, triples = context[i]
+#     LayoutCache().layout(nodes, triples[:, [HEAD, TAIL]])
+
+import numpy as np
+
+from triples import HEAD, RELATION, TAIL
+
+
+OUT, IN = 0, 1
+DIRECTIONS = {"out": (OUT,), "in": (IN,), "both": (OUT, IN)}
+
+
+class Subgraphs():
+    def __init__(self, triples: np.ndarray,
+                 node_indptr: np.ndarray, nodes: np.ndarray, hops: np.ndarray,
+                 edge_indptr: np.ndarray, edges: np.ndarray):
+        """ One subgraph per anchor in CSR format
+
+        nodes[node_indptr[i]:node_indptr[i+1]]: entities of subgraph i, the anchor first
+        hops: distance of every node to its anchor
+        edges[edge_indptr[i]:edge_indptr[i+1]]: row indices of the triples of subgraph i
+        """
+        self.all_triples = triples
+        self.node_indptr = node_indptr
+        self.nodes = nodes
+        self.hops = hops
+        self.edge_indptr = edge_indptr
+        self.edges = edges
+
+    def __len__(self) -> int:
+        return len(self.node_indptr) - 1
+
+    def __getitem__(self, i: int) -> tuple:
+        """ (nodes, hops, triples) of subgraph i
+        """
+        nodes = slice(self.node_indptr[i], self.node_indptr[i + 1])
+        edges = self.edges[self.edge_indptr[i]:self.edge_indptr[i + 1]]
+        return self.nodes[nodes], self.hops[nodes], self.all_triples[edges]
+
+    def local_triples(self, i: int) -> np.ndarray:
+        """ Triples of subgraph i with head and tail as row indices of its nodes, e.g. for
+        graph_layout.draw_relations
+        """
+        nodes, _, triples = self[i]
+        order = np.argsort(nodes)
+        local = triples.astype(np.int64)
+        for column in (HEAD, TAIL):
+            local[:, column] = order[np.searchsorted(nodes[order], triples[:, column])]
+        return local
+
+
+class Adjacency():
+    def __init__(self, triples: np.ndarray, n_entities: int, n_relations: int = None):
+        """ Input:
+            triples.shape = (n_triples, 3) int (head, relation, tail)
+        """
+        self.triples = np.asarray(triples).reshape(-1, 3)
+        self.n_entities = n_entities
+        if n_relations is None:
+            n_relations = int(self.triples[:, RELATION].max()) + 1 if len(self.triples) else 0
+        self.n_relations = max(n_relations, 1)
+
+        n = len(self.triples)
+        heads, tails = self.triples[:, HEAD].astype(np.int64), self.triples[:, TAIL].astype(np.int64)
+        sources = np.concatenate([heads, tails])
+        targets = np.concatenate([tails, heads])
+        relations = np.tile(self.triples[:, RELATION].astype(np.int64), 2)
+        directions = np.repeat([OUT, IN], n)
+
+        rows = directions * n_entities + sources
+        keys = rows * self.n_relations + relations
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]                                   # (2 n_triples,) sorted
+        self.targets = targets[order].astype(np.int32)
+        self.relations = relations[order].astype(np.int32)
+        self.edge_ids = np.tile(np.arange(n), 2)[order]           # row of the triple
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=2 * n_entities))])
+
+    def degree(self, entities: np.ndarray, direction: str = "both") -> np.ndarray:
+        entities = np.asarray(entities, dtype=np.int64)
+        return sum(self.indptr[d * self.n_entities + entities + 1] - self.indptr[d * self.n_entities + entities]
+                   for d in DIRECTIONS[direction])
+
+    def _ranges(self, entities: np.ndarray, relation: int = None, direction: str = "both") -> tuple:
+        # (owner, starts, counts): the edge ranges of the rows of all entities
+        entities = np.asarray(entities, dtype=np.int64)
+        owners, starts, counts = [], [], []
+        for d in DIRECTIONS[direction]:
+            rows = d * self.n_entities + entities
+            if relation is None:
+                start, stop = self.indptr[rows], self.indptr[rows + 1]
+            else:
+                key = rows * self.n_relations + relation
+                start, stop = np.searchsorted(self.keys, key), np.searchsorted(self.keys, key, side="right")
+            owners.append(np.arange(len(entities)))
+            starts.append(start)
+            counts.append(stop - start)
+        return np.concatenate(owners), np.concatenate(starts), np.concatenate(counts)
+
+    def neighbours(self, entities: np.ndarray, relation: int = None, direction: str = "both") -> tuple:
+        """ All edges of a batch of entities
+
+        relation: only the edges of this relation, default all
+        direction: "out" (entity is the head), "in" (entity is the tail) or "both"
+        Returns:
+            owner: index into entities of every edge
+            targets, relations: the other end and the relation of every edge
+            edge_ids: row of the triple
+        """
+        owners, starts, counts = self._ranges(entities, relation, direction)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        idx = np.repeat(starts, counts) + within
+        return np.repeat(owners, counts), self.targets[idx], self.relations[idx], self.edge_ids[idx]
+
+    def k_hop(self, anchors: np.ndarray, k: int = 2, relation: int = None, direction: str = "both",
+              max_degree: int = None) -> tuple:
+        """ Entities within k hops of every anchor
+
+        max_degree: entities with more edges (hubs) are included but not expanded
+        Returns:
+            batch, nodes, hops: (anchor index, entity, distance), sorted by anchor and
+                                distance, the anchor itself is the first node of its batch
+        """
+        anchors = np.asarray(anchors, dtype=np.int64)
+        E = self.n_entities
+        batch, nodes = np.arange(len(anchors)), anchors
+        visited = np.unique(batch * E + nodes)
+        result = [(batch, nodes, np.zeros(len(anchors), dtype=np.int64))]
+        for hop in range(1, k + 1):
+            if max_degree is not None:
+                expand = self.degree(nodes, direction) <= max_degree
+                batch, nodes = batch[expand], nodes[expand]
+            owner, targets, _, _ = self.neighbours(nodes, relation, direction)
+            keys = np.unique(batch[owner] * E + targets)
+            keys = keys[~_contains(visited, keys)]
+            if len(keys) == 0:
+                break
+            visited = np.union1d(visited, keys)
+            batch, nodes = keys // E, keys % E
+            result.append((batch, nodes, np.full(len(keys), hop)))
+
+        batch, nodes, hops = (np.concatenate(x) for x in zip(*result))
+        order = np.lexsort([hops, batch])
+        return batch[order], nodes[order], hops[order]
+
+    def induced_subgraphs(self, batch: np.ndarray, nodes: np.ndarray) -> tuple:
+        """ The triples between the nodes of the same batch
+
+        Returns:
+            batch, edge_ids: sorted by batch, every triple once per batch
+        """
+        batch, nodes = np.asarray(batch, dtype=np.int64), np.asarray(nodes, dtype=np.int64)
+        members = np.unique(batch * self.n_entities + nodes)
+        owner, targets, _, edge_ids = self.neighbours(nodes, direction="out")
+        edge_batch = batch[owner]
+        inside = _contains(members, edge_batch * self.n_entities + targets)
+        edge_batch, edge_ids = edge_batch[inside], edge_ids[inside]
+        order = np.lexsort([edge_ids, edge_batch])
+        return edge_batch[order], edge_ids[order]
+
+    def context(self, anchors: np.ndarray, k: int = 2, relation: int = None, direction: str = "both",
+                max_degree: int = None) -> Subgraphs:
+        """ k-hop neighbourhood and the triples inside it, for every anchor
+        """
+        batch, nodes, hops = self.k_hop(anchors, k, relation, direction, max_degree)
+        edge_batch, edge_ids = self.induced_subgraphs(batch, nodes)
+        n = len(anchors)
+        node_indptr = np.concatenate([[0], np.cumsum(np.bincount(batch, minlength=n))])
+        edge_indptr = np.concatenate([[0], np.cumsum(np.bincount(edge_batch, minlength=n))])
+        return Subgraphs(self.triples, node_indptr, nodes, hops, edge_indptr, edge_ids)
+
+
+def _contains(sorted_keys: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    idx = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[idx] == keys
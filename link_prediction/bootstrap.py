@@ -0,0 +1,105 @@
+# Bootstrap confidence intervals for the link prediction metrics
+#
+# The queries are resampled with replacement n_boot times. Every replicate is
+# represented by its (n_queries,) resample counts, so all replicates of all
+# per-query statistics are one matrix product: counts (b, Q) @ outcomes (Q, S).
+# The replicates are generated in chunks of b to bound the memory.
+#
+# Multiplicity of the epsilon set (model 0 is h0), on the top-k decisions:
+#     ambiguity: fraction of queries where any member decides differently than h0
+#     discrepancy: max over the members of the fraction of queries decided differently
+#
+# Example:
+#     cis = confidence_intervals(ranks, voted_ranks={"Borda": borda_ranks}, k=4)
+#     print(format_confidence_intervals(cis))
+
+import numpy as np
+
+import tracing
+
+
+def resample_counts(n_queries: int, n_boot: int, rng: np.random.Generator) -> np.ndarray:
+    """ (n_boot, n_queries) how often every query is drawn in every replicate
+    """
+    idx = rng.integers(0, n_queries, (n_boot, n_queries))
+    idx += np.arange(n_boot)[:, None] * n_queries
+    return np.bincount(idx.ravel(), minlength=n_boot * n_queries).reshape(n_boot, n_queries)
+
+
+def bootstrap_means(outcomes: np.ndarray, n_boot: int = 10000, chunk_size: int = 256,
+                    seed=None) -> np.ndarray:
+    """ Bootstrap replicates of the means of per-query outcomes
+
+    Input:
+        outcomes.shape = (n_queries, n_statistics)
+    Returns:
+        (n_boot, n_statistics)
+    """
+    outcomes = np.asarray(outcomes, dtype=np.float64)
+    n_queries = len(outcomes)
+    rng = np.random.default_rng(seed)
+    replicates = np.zeros((n_boot, outcomes.shape[1]))
+    with tracing.span("bootstrap", n_boot=n_boot, n_queries=n_queries, n_statistics=outcomes.shape[1]):
+        for start in range(0, n_boot, chunk_size):
+            b = min(chunk_size, n_boot - start)
+            counts = resample_counts(n_queries, b, rng).astype(np.float64)
+            replicates[start:start + b] = counts @ outcomes / n_queries
+    return replicates
+
+
+def percentile_interval(replicates: np.ndarray, alpha: float = 0.05) -> tuple:
+    low, high = np.percentile(replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return low, high
+
+
+def confidence_intervals(ranks: np.ndarray,
+                         voted_ranks: dict = None,
+                         k: int = 10,
+                         n_boot: int = 10000,
+                         alpha: float = 0.05,
+                         chunk_size: int = 256,
+                         seed=None,
+                         model_names: list = None) -> dict:
+    """ Point estimates and percentile intervals of Hits@k and MRR for every model
+    and voting method, and of the ambiguity and discrepancy of the epsilon set
+
+    Input:
+        ranks.shape = (n_models, n_queries), filtered ranks, model 0 is h0
+        voted_ranks: {voting method name: (n_queries,) ranks of its aggregated scores}
+    Returns:
+        {name: {"estimate", "low", "high"}}
+    """
+    ranks = np.asarray(ranks, dtype=np.float64)
+    voted_ranks = voted_ranks or {}
+    n_models = len(ranks)
+    model_names = model_names or ["h0"] + [f"h{m}" for m in range(1, n_models)]
+
+    names = list(model_names) + list(voted_ranks)
+    all_ranks = np.vstack([ranks] + [np.asarray(r, dtype=np.float64)[None] for r in voted_ranks.values()])
+    hits = all_ranks <= k
+    # Decisions of the members which differ from h0, per query
+    flips = hits[1:n_models] != hits[0]
+    outcomes = np.hstack([hits.T, (1. / all_ranks).T, flips.any(axis=0)[:, None], flips.T])
+
+    replicates = bootstrap_means(outcomes, n_boot=n_boot, chunk_size=chunk_size, seed=seed)
+    n = len(names)
+    estimates = outcomes.mean(axis=0)
+    statistics = {f"Hits@{k} {name}": (estimates[i], replicates[:, i]) for i, name in enumerate(names)}
+    statistics.update({f"MRR {name}": (estimates[n + i], replicates[:, n + i]) for i, name in enumerate(names)})
+    statistics["ambiguity"] = (estimates[2 * n], replicates[:, 2 * n])
+    if n_models > 1:
+        # The max over the members is taken within every replicate
+        statistics["discrepancy"] = (estimates[2 * n + 1:].max(), replicates[:, 2 * n + 1:].max(axis=1))
+
+    result = {}
+    for name, (estimate, reps) in statistics.items():
+        low, high = percentile_interval(reps, alpha)
+        result[name] = {"estimate": float(estimate), "low": float(low), "high": float(high)}
+    return result
+
+
+def format_confidence_intervals(cis: dict, alpha: float = 0.05) -> str:
+    lines = [f"{'statistic':<24} {'estimate':>8}  {100 * (1 - alpha):.0f}% CI"]
+    for name, ci in cis.items():
+        lines.append(f"{name:<24} {ci['estimate']:>8.3f}  [{ci['low']:.3f}, {ci['high']:.3f}]")
+    return "\n".join(lines)
@@ -0,0 +1,109 @@
+# Candidate pruning by the domain and range of the relations
+#
+# For every (relation, direction) the entities that can answer a query are stored
+# in CSR format like the FilterIndex: the candidates of row i are
+# indices[indptr[i]:indptr[i+1]], row = relation * 2 + direction.
+# direction 0: tail is missing, candidates = range of the relation (observed tails)
+# direction 1: head is missing, candidates = domain of the relation (observed heads)
+#
+# With entity types, the candidates are all entities of the observed types.
+# Relations without observed triples are not pruned.
+# Pruned entities are scored -inf, the ranking treats them like any other -inf score,
+# i.e. a pruned target ranks behind all candidates.
+
+import numpy as np
+
+from triples import HEAD, RELATION, TAIL
+
+
+class CandidateSets():
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, n_entities: int):
+        self.indptr = indptr      # (2 * n_relations + 1,) int64
+        self.indices = indices    # (n_candidates,) int32, sorted per row
+        self.n_entities = n_entities
+
+    @property
+    def n_relations(self) -> int:
+        return (len(self.indptr) - 1) // 2
+
+    @staticmethod
+    def rows(relations: np.ndarray, head_is_missing: np.ndarray) -> np.ndarray:
+        return np.asarray(relations, dtype=np.int64) * 2 + np.asarray(head_is_missing, dtype=np.int64)
+
+    @classmethod
+    def from_triples(cls, triples: np.ndarray, n_entities: int, n_relations: int,
+                     entity_types: np.ndarray = None) -> "CandidateSets":
+        """ Observed domains and ranges of the training triples
+
+        Input:
+            triples.shape = (n_triples, 3) int (head, relation, tail)
+            entity_types: optional (n_entities,) int type id of every entity
+        """
+        triples = np.asarray(triples).reshape(-1, 3)
+        rows = np.concatenate([cls.rows(triples[:, RELATION], np.zeros(len(triples), dtype=bool)),
+                               cls.rows(triples[:, RELATION], np.ones(len(triples), dtype=bool))])
+        answers = np.concatenate([triples[:, TAIL], triples[:, HEAD]]).astype(np.int64)
+
+        if entity_types is not None:
+            # (row, type) pairs -> all entities of the type
+            entity_types = np.asarray(entity_types, dtype=np.int64)
+            n_types = entity_types.max() + 1
+            pairs = np.unique(rows * n_types + entity_types[answers])
+            rows, types = pairs // n_types, pairs % n_types
+            by_type = np.argsort(entity_types, kind="stable")
+            type_indptr = np.concatenate([[0], np.cumsum(np.bincount(entity_types, minlength=n_types))])
+            counts = type_indptr[types + 1] - type_indptr[types]
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            answers = by_type[np.repeat(type_indptr[types], counts) + offsets]
+            rows = np.repeat(rows, counts)
+
+        pairs = np.unique(rows * n_entities + answers)
+        rows, indices = pairs // n_entities, (pairs % n_entities).astype(np.int32)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=2 * n_relations))])
+        return cls(indptr, indices, n_entities)
+
+    def _counts(self, rows: np.ndarray) -> tuple:
+        # (starts, counts) of the rows, 0 counts for the rows beyond the known relations
+        known = rows < len(self.indptr) - 1
+        rows = np.where(known, rows, 0)
+        starts = self.indptr[rows]
+        return starts, np.where(known, self.indptr[rows + 1] - starts, 0)
+
+    def candidates(self, relation: int, head_is_missing: bool) -> np.ndarray:
+        starts, counts = self._counts(self.rows([relation], [head_is_missing]))
+        if counts[0] == 0:
+            return np.arange(self.n_entities, dtype=np.int32)
+        return self.indices[starts[0]:starts[0] + counts[0]]
+
+    def mask(self, relations: np.ndarray, head_is_missing: np.ndarray) -> np.ndarray:
+        """ (n_queries, n_entities) bool, True for the candidates of every query
+        """
+        starts, counts = self._counts(self.rows(relations, head_is_missing))
+        query_idx = np.repeat(np.arange(len(counts)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        mask = np.zeros((len(counts), self.n_entities), dtype=bool)
+        mask[query_idx, self.indices[np.repeat(starts, counts) + offsets]] = True
+        mask[counts == 0] = True
+        return mask
+
+    def apply(self, scores: np.ndarray, relations: np.ndarray, head_is_missing: np.ndarray,
+              fill_value: float = -np.inf) -> np.ndarray:
+        """ Sets the scores of all pruned entities to fill_value (in place)
+        """
+        scores[~self.mask(relations, head_is_missing)] = fill_value
+        return scores
+
+    def groups(self, relations: np.ndarray, head_is_missing: np.ndarray):
+        """ Yields (query_idx, candidates) for the queries sharing a (relation, direction)
+        """
+        rows = self.rows(relations, head_is_missing)
+        order = np.argsort(rows, kind="stable")
+        unique_rows, starts = np.unique(rows[order], return_index=True)
+        for row, query_idx in zip(unique_rows, np.split(order, starts[1:])):
+            yield query_idx, self.candidates(row // 2, row % 2)
+
+    def pruning_ratio(self, relations: np.ndarray, head_is_missing: np.ndarray) -> float:
+        """ Fraction of the (query, entity) scores that are not computed
+        """
+        _, counts = self._counts(self.rows(relations, head_is_missing))
+        return 1 - np.mean(np.where(counts == 0, self.n_entities, counts)) / self.n_entities
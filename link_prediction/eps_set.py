@@ -0,0 +1,143 @@
+# Epsilon set of KGE models by "perturb and fine-tune"
+#
+# Instead of training every member from scratch, a member starts from the trained
+# baseline h0 and is
+#     1. perturbed: gaussian noise on the embeddings, relative to their scale
+#     2. fine-tuned for a few epochs on the training triples without a random
+#        dropout subset, with its own negative sampling seed. The negatives are
+#        filtered against all known triples, the dropped ones included.
+#     3. accepted if its validation Hits@k is at most epsilon below the one of h0
+#
+# Example:
+#     generator = EpsilonSetGenerator(h0, train, valid, epsilon=0.02, filter_index=filter_index)
+#     members = generator.generate(50)
+#     print(generator.report(h0_seconds=...))
+
+import copy
+import time
+
+import numpy as np
+
+from filter_index import FilterIndex
+from negative_sampling import NegativeSampler
+from ranking import filtered_ranks, hits_at_k
+from triples import HEAD, RELATION, TAIL
+import tracing
+
+
+def perturb(model, noise: float, seed=None):
+    """ Copy of the model (e.g. kge.DistMult) with noise on its embeddings and a new seed
+    """
+    # The negative sampler is only read, the members share it
+    sampler = getattr(model, "sampler", None)
+    member = copy.deepcopy(model, memo={} if sampler is None else {id(sampler): sampler})
+    rng = np.random.default_rng(seed)
+    for name in ("entity_emb", "relation_emb"):
+        emb = getattr(member, name)
+        emb += (noise * emb.std() * rng.normal(0, 1, emb.shape)).astype(emb.dtype)
+    member.rng = rng
+    return member
+
+
+class EpsilonSetGenerator():
+    def __init__(self, h0,
+                 train: np.ndarray,
+                 valid: np.ndarray,
+                 epsilon: float,
+                 k: int = 10,
+                 filter_index: FilterIndex = None,
+                 noise: float = 0.1,
+                 dropout: float = 0.1,
+                 fine_tune_epochs: int = 2,
+                 seed=None,
+                 known: np.ndarray = None,
+                 **fit_kwargs):
+        """ Generates members of the epsilon set around the trained baseline h0
+
+        Input:
+            h0: trained model with score(relations, anchors, head_is_missing) and fit(triples, epochs=...)
+            train, valid: int triples (n_triples, 3)
+            filter_index: all known triples, for the filtered validation ranks
+            known: triples that are never sampled as negatives, default train
+            fit_kwargs: passed to h0.fit, e.g. a NegativeSampler as sampler replaces the one of known
+        """
+        self.h0 = h0
+        self.train = np.asarray(train)
+        self.k = k
+        self.epsilon = epsilon
+        self.filter_index = filter_index
+        self.noise = noise
+        self.dropout = dropout
+        self.fine_tune_epochs = fine_tune_epochs
+        self.fit_kwargs = dict(fit_kwargs)
+        if self.fit_kwargs.get("sampler") is None:
+            known = self.train if known is None else np.asarray(known)
+            self.fit_kwargs["sampler"] = NegativeSampler(known, h0.n_entities, len(h0.relation_emb))
+        self.seed_sequence = np.random.SeedSequence(seed)
+
+        # Validation queries in both directions
+        valid = np.asarray(valid)
+        n = len(valid)
+        self.relations = np.concatenate([valid[:, RELATION], valid[:, RELATION]])
+        self.anchors = np.concatenate([valid[:, HEAD], valid[:, TAIL]])
+        self.head_is_missing = np.concatenate([np.zeros(n, dtype=bool), np.ones(n, dtype=bool)])
+        self.targets = np.concatenate([valid[:, TAIL], valid[:, HEAD]])
+
+        self.h0_hits = self.validation_hits(h0)
+        self.history = []
+
+    def validation_hits(self, model) -> float:
+        def scores(start, stop):
+            return model.score(self.relations[start:stop], self.anchors[start:stop],
+                               self.head_is_missing[start:stop])
+        ranks = filtered_ranks(scores, self.targets, self.relations, self.anchors, self.head_is_missing,
+                               filter_index=self.filter_index)
+        return hits_at_k(ranks, self.k)
+
+    def candidate(self, seed_sequence: np.random.SeedSequence):
+        """ One perturbed and fine-tuned model
+        """
+        member = perturb(self.h0, self.noise, seed=seed_sequence)
+        keep = member.rng.random(len(self.train)) >= self.dropout
+        if self.fine_tune_epochs:
+            member.fit(self.train[keep], epochs=self.fine_tune_epochs, **self.fit_kwargs)
+        return member
+
+    def generate(self, n_members: int, max_tries: int = None) -> list:
+        """ Accepted members, at most max_tries (default 4 * n_members) candidates are tried
+        """
+        max_tries = max_tries or 4 * n_members
+        members = []
+        with tracing.span("eps_set", n_members=n_members):
+            for seed_sequence in self.seed_sequence.spawn(max_tries):
+                if len(members) == n_members:
+                    break
+                t = time.perf_counter()
+                member = self.candidate(seed_sequence)
+                hits = self.validation_hits(member)
+                accepted = hits >= self.h0_hits - self.epsilon
+                if accepted:
+                    members.append(member)
+                self.history.append({"seed": seed_sequence.spawn_key, "hits": hits, "accepted": accepted,
+                                     "seconds": time.perf_counter() - t})
+        return members
+
+    @property
+    def acceptance_rate(self) -> float:
+        return np.mean([h["accepted"] for h in self.history]) if self.history else 0.
+
+    def report(self, h0_seconds: float = None) -> str:
+        """ Cost per candidate and per accepted member, relative to training h0 if its time is given
+        """
+        seconds = np.array([h["seconds"] for h in self.history])
+        n_accepted = sum(h["accepted"] for h in self.history)
+        per_member = seconds.sum() / max(n_accepted, 1)
+        hits = [h["hits"] for h in self.history if h["accepted"]]
+        lines = [f"h0: Hits@{self.k} = {self.h0_hits:.3f}, epsilon = {self.epsilon}",
+                 f"Accepted {n_accepted} of {len(self.history)} candidates ({100 * self.acceptance_rate:.0f}%)",
+                 f"Cost: {seconds.mean():.2f} s per candidate, {per_member:.2f} s per accepted member"]
+        if hits:
+            lines.append(f"Members: Hits@{self.k} in [{min(hits):.3f}, {max(hits):.3f}]")
+        if h0_seconds:
+            lines.append(f"Per member {per_member / h0_seconds:.2f}x the cost of training h0 ({h0_seconds:.2f} s)")
+        return "\n".join(lines)
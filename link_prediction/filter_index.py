@@ -0,0 +1,218 @@
+# Filter index for the filtered link prediction ranking
+#
+# For every (relation, direction, anchor) all known answers are stored in
+# CSR format: the answers of row i are indices[indptr[i]:indptr[i+1]].
+# direction 0: tail is missing, anchor = head, answers = tails
+# direction 1: head is missing, anchor = tail, answers = heads
+#
+# insert keeps the new answers in a second, small index (the delta) that is
+# searched together with the main arrays, and merges it into them in one pass
+# once it has grown to MAX_DELTA_FRACTION of the answers.
+
+import numpy as np
+
+from triples import HEAD, RELATION, TAIL
+
+
+class FilterIndex():
+    MAX_DELTA_FRACTION = 0.05
+
+    def __init__(self, keys: np.ndarray, indptr: np.ndarray, indices: np.ndarray, n_entities: int):
+        self.keys = keys          # (n_rows,) int64, sorted
+        self.indptr = indptr      # (n_rows+1,) int32
+        self.indices = indices    # (n_answers,) int32
+        self.n_entities = n_entities
+        self._delta = None        # FilterIndex of the answers inserted since the last compact
+
+    @staticmethod
+    def row_keys(relations: np.ndarray, anchors: np.ndarray, head_is_missing: np.ndarray,
+                 n_entities: int) -> np.ndarray:
+        direction = np.asarray(head_is_missing, dtype=np.int64)
+        return (np.asarray(relations, dtype=np.int64) * 2 + direction) * n_entities + anchors
+
+    @classmethod
+    def _pairs(cls, triples: np.ndarray, n_entities: int) -> tuple:
+        # (row key, answer) of both directions of every triple, sorted and unique
+        triples = np.asarray(triples).reshape(-1, 3)
+        n = len(triples)
+        keys = np.concatenate([
+            cls.row_keys(triples[:, RELATION], triples[:, HEAD], np.zeros(n, dtype=bool), n_entities),
+            cls.row_keys(triples[:, RELATION], triples[:, TAIL], np.ones(n, dtype=bool), n_entities)])
+        answers = np.concatenate([triples[:, TAIL], triples[:, HEAD]]).astype(np.int32)
+
+        order = np.lexsort((answers, keys))
+        keys, answers = keys[order], answers[order]
+        # Drop duplicated triples
+        if len(keys):
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = (keys[1:] != keys[:-1]) | (answers[1:] != answers[:-1])
+            keys, answers = keys[first], answers[first]
+        return keys, answers
+
+    @classmethod
+    def _from_pairs(cls, keys: np.ndarray, answers: np.ndarray, n_entities: int) -> "FilterIndex":
+        assert len(answers) < np.iinfo(np.int32).max
+        row_keys, starts = np.unique(keys, return_index=True)
+        indptr = np.append(starts, len(keys)).astype(np.int32)
+        return cls(row_keys, indptr, answers, n_entities)
+
+    @classmethod
+    def from_triples(cls, triples: np.ndarray, n_entities: int) -> "FilterIndex":
+        """ Builds the index with one sort over all known triples (train, valid and test)
+
+        Input:
+            triples.shape = (n_triples, 3) int (head, relation, tail)
+        """
+        return cls._from_pairs(*cls._pairs(triples, n_entities), n_entities)
+
+    def _pairs_of_rows(self) -> tuple:
+        return np.repeat(self.keys, np.diff(self.indptr)), self.indices
+
+    def _find(self, keys: np.ndarray, answers: np.ndarray) -> tuple:
+        """ Position of (row key, answer) pairs in indices, by a binary search within
+        the rows of all pairs at once
+
+        Returns:
+            positions: where the answer is or would be inserted
+            found: the pair is known
+        """
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        rows = np.searchsorted(self.keys, keys)
+        clipped = np.minimum(rows, len(self.keys) - 1)
+        row_known = self.keys[clipped] == keys
+        lo = np.where(row_known, self.indptr[clipped], self.indptr[rows]).astype(np.int64)
+        stop = np.where(row_known, self.indptr[clipped + 1], lo).astype(np.int64)
+        hi = stop.copy()
+        last = len(self.indices) - 1
+        while np.any(lo < hi):
+            mid = (lo + hi) // 2
+            active = lo < hi
+            right = active & (self.indices[np.minimum(mid, last)] < answers)
+            lo = np.where(right, mid + 1, lo)
+            hi = np.where(active & ~right, mid, hi)
+        found = (lo < stop) & (self.indices[np.minimum(lo, last)] == answers)
+        return lo, found
+
+    def insert(self, triples: np.ndarray) -> np.ndarray:
+        """ Adds new known triples, returns the keys of the rows that changed
+
+        The new answers go into a small delta index, which is merged into the
+        main CSR arrays (compact) once it holds MAX_DELTA_FRACTION of the answers.
+        So an update costs O(delta log delta) plus the amortized merge.
+        """
+        keys, answers = self._pairs(triples, self.n_entities)
+        _, known = self._find(keys, answers)
+        if self._delta is not None:
+            known |= self._delta._find(keys, answers)[1]
+        keys, answers = keys[~known], answers[~known]
+        if len(keys) == 0:
+            return keys
+
+        if self._delta is not None:
+            delta_keys, delta_answers = self._delta._pairs_of_rows()
+            keys_all, answers_all = np.concatenate([delta_keys, keys]), np.concatenate([delta_answers, answers])
+            order = np.lexsort((answers_all, keys_all))
+            self._delta = self._from_pairs(keys_all[order], answers_all[order], self.n_entities)
+        else:
+            self._delta = self._from_pairs(keys, answers, self.n_entities)
+        if len(self._delta.indices) > self.MAX_DELTA_FRACTION * len(self.indices):
+            self.compact()
+        return np.unique(keys)
+
+    def compact(self) -> "FilterIndex":
+        """ Merges the delta index into the main CSR arrays in one pass
+        """
+        if self._delta is None:
+            return self
+        keys, answers = self._delta._pairs_of_rows()
+        self._delta = None
+        positions, _ = self._find(keys, answers)
+        self.indices = np.insert(self.indices, positions, answers)
+        # Rows: counts of the existing rows plus the new ones
+        delta_row_keys = np.unique(keys)
+        rows = np.searchsorted(self.keys, delta_row_keys)
+        known = self.keys[np.minimum(rows, len(self.keys) - 1)] == delta_row_keys if len(self.keys) else \
+            np.zeros(len(rows), dtype=bool)
+        new_row_keys, rows = delta_row_keys[~known], rows[~known]
+        counts = np.insert(np.diff(self.indptr).astype(np.int64), rows, 0)
+        self.keys = np.insert(self.keys, rows, new_row_keys)
+        counts += np.bincount(np.searchsorted(self.keys, keys), minlength=len(self.keys))
+        assert counts.sum() < np.iinfo(np.int32).max
+        self.indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+        return self
+
+    def copy(self) -> "FilterIndex":
+        """ An index that can be compacted, inserted into or resized without changing this one
+
+        The arrays are shared, these methods replace them instead of writing into them
+        """
+        index = FilterIndex(self.keys, self.indptr, self.indices, self.n_entities)
+        if self._delta is not None:
+            index._delta = self._delta.copy()
+        return index
+
+    def resize(self, n_entities: int) -> "FilterIndex":
+        """ More entities, the row keys are re-packed (their order does not change)
+        """
+        assert n_entities >= self.n_entities
+        direction, anchors = np.divmod(self.keys, self.n_entities)
+        self.keys = direction * n_entities + anchors
+        self.n_entities = n_entities
+        if self._delta is not None:
+            self._delta.resize(n_entities)
+        return self
+
+    @property
+    def n_answers(self) -> int:
+        return len(self.indices) + (0 if self._delta is None else len(self._delta.indices))
+
+    def lookup(self, relations: np.ndarray, anchors: np.ndarray, head_is_missing: np.ndarray) -> np.ndarray:
+        """ Row of every query in the main CSR arrays, -1 if nothing is known for it there
+        """
+        keys = self.row_keys(relations, anchors, head_is_missing, self.n_entities)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1)
+        rows = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[rows] == keys, rows, -1)
+
+    def answers(self, relation: int, anchor: int, head_is_missing: bool) -> np.ndarray:
+        _, entity_idx = self.gather(np.array([relation]), np.array([anchor]), np.array([head_is_missing]))
+        return np.sort(entity_idx)
+
+    def gather(self, relations: np.ndarray, anchors: np.ndarray, head_is_missing: np.ndarray) -> tuple:
+        """ All known answers of a batch of queries as (query_idx, entity_idx) pairs
+        """
+        rows = self.lookup(relations, anchors, head_is_missing)
+        valid = rows >= 0
+        rows = np.where(valid, rows, 0)
+        starts = self.indptr[rows].astype(np.int64)
+        counts = np.where(valid, self.indptr[rows + 1] - starts, 0)
+
+        query_idx = np.repeat(np.arange(len(rows)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        entity_idx = self.indices[np.repeat(starts, counts) + offsets]
+        if self._delta is not None:
+            delta_query_idx, delta_entity_idx = self._delta.gather(relations, anchors, head_is_missing)
+            query_idx = np.concatenate([query_idx, delta_query_idx])
+            entity_idx = np.concatenate([entity_idx, delta_entity_idx])
+        return query_idx, entity_idx
+
+    def apply(self, scores: np.ndarray,
+              relations: np.ndarray,
+              anchors: np.ndarray,
+              head_is_missing: np.ndarray,
+              targets: np.ndarray = None,
+              fill_value: float = -np.inf) -> np.ndarray:
+        """ Sets the scores of all known answers to fill_value (in place)
+
+        Input:
+            scores.shape = (n_queries, n_entities), a chunk of queries
+            targets: the answer of every query, which is kept unfiltered
+        """
+        query_idx, entity_idx = self.gather(relations, anchors, head_is_missing)
+        if targets is not None:
+            keep = entity_idx != np.asarray(targets)[query_idx]
+            query_idx, entity_idx = query_idx[keep], entity_idx[keep]
+        scores[query_idx, entity_idx] = fill_value
+        return scores
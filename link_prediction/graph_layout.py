@@ -0,0 +1,241 @@
+# Automatic layout and batched rendering of (sub)graphs of the knowledge graph
+#
+# force_layout is a Fruchterman-Reingold layout in NumPy with grid-binned repulsion
+# (Barnes-Hut on a grid hierarchy): the nodes are binned into a fine grid of about
+# NODES_PER_CELL nodes per cell, every coarser level merges 2x2 cells. Nodes in the
+# same or a neighbouring fine cell repel each other exactly. On every level a cell
+# is repelled by the centroids (weighted with their node counts) of the cells that
+# are not its neighbours but whose parents are neighbours of its parent, and passes
+# that force on to its nodes. So every pair of nodes is accounted for exactly once
+# and an iteration costs O(n) instead of O(n^2). The pairs of a level are built at
+# once from the sorted cell keys (repeat/offsets, no Python loop over cells).
+#
+# LayoutCache keeps the positions on disk, keyed by a hash of the node ids, the
+# (undirected) edges and the layout parameters, so a neighbourhood is laid out once.
+#
+# draw_relations draws all edges of a relation as one LineCollection (plus one
+# quiver for the arrow heads) instead of one FancyArrowPatch per edge.
+#
+# Usage:
+#     positions = LayoutCache("layouts").layout(nodes, triples[:, [HEAD, TAIL]])
+#     draw_relations(ax, positions, local_triples, relation_names=store.relations)
+
+import hashlib
+import os
+
+import numpy as np
+from matplotlib.collections import LineCollection
+
+import tracing
+
+
+RELATION_COLORS = {"orbits": "darkorange", "observes": "mediumorchid"}
+# Half of the neighbourhood, every unordered pair of cells is visited once
+NEIGHBOUR_CELLS = [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]
+NODES_PER_CELL = 8
+
+
+def _undirected_edges(edges: np.ndarray, n_nodes: int) -> np.ndarray:
+    """ Unique (i, j) with i < j, self loops removed
+    """
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    edges = np.sort(edges[edges[:, 0] != edges[:, 1]], axis=1)
+    keys = np.unique(edges[:, 0] * n_nodes + edges[:, 1])
+    return np.stack([keys // n_nodes, keys % n_nodes], axis=1)
+
+
+def neighbour_pairs(cells: np.ndarray) -> tuple:
+    """ All pairs (a, b), a != b, of items in the same or neighbouring grid cells, each once
+
+    cells: (n_items, 2) integer cell coordinates
+    """
+    cells = np.asarray(cells, dtype=np.int64)
+    if len(cells) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    cells = cells - cells.min(axis=0)
+    width = cells[:, 0].max() + 3
+    keys = (cells[:, 1] + 1) * width + cells[:, 0] + 1
+    order = np.argsort(keys, kind="stable")
+    cell_keys, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+    sources, targets = [], []
+    for dx, dy in NEIGHBOUR_CELLS:
+        neighbour = keys + dy * width + dx
+        c = np.minimum(np.searchsorted(cell_keys, neighbour), len(cell_keys) - 1)
+        n = np.where(cell_keys[c] == neighbour, counts[c], 0)
+        within = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        sources.append(np.repeat(np.arange(len(keys)), n))
+        targets.append(order[np.repeat(starts[c], n) + within])
+    sources, targets = np.concatenate(sources), np.concatenate(targets)
+    # Within a cell both orders were generated
+    keep = (keys[sources] != keys[targets]) | (sources < targets)
+    return sources[keep], targets[keep]
+
+
+def _add_pair_forces(force: np.ndarray, a: np.ndarray, b: np.ndarray, points: np.ndarray,
+                     mass_a, mass_b, k: float):
+    """ Repulsion k^2 / d between the pairs, scaled with the mass of the other side
+    """
+    delta = points[a] - points[b]
+    dist2 = np.maximum(np.einsum("ij,ij->i", delta, delta), 1e-4 * k * k)
+    f = (k * k / dist2)[:, None] * delta
+    for end, weight in ((a, mass_b), (b, -mass_a)):
+        w = np.broadcast_to(weight, len(end))
+        for d in range(2):
+            force[:, d] += np.bincount(end, w * f[:, d], minlength=len(force))
+
+
+def repulsion(positions: np.ndarray, cell: float, k: float = 1.) -> np.ndarray:
+    """ sum_j k^2 / |x_i - x_j| in the direction x_i - x_j of all nodes i, see the header
+    """
+    n = len(positions)
+    force = np.zeros((n, 2))
+    cells = np.floor((positions - positions.min(axis=0)) / cell).astype(np.int64)
+    i, j = neighbour_pairs(cells)
+    _add_pair_forces(force, i, j, positions, 1., 1., k)
+
+    node_cell = np.arange(n)
+    while cells.max() > 1:
+        # Cells of this level, their centroid and node count
+        keys = cells[:, 1] * (cells[:, 0].max() + 1) + cells[:, 0]
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        node_cell = inverse.ravel()[node_cell]
+        mass = np.bincount(node_cell)
+        centroid = np.stack([np.bincount(node_cell, positions[:, d], minlength=len(mass))
+                             for d in range(2)], axis=1) / mass[:, None]
+        cells = cells[first]
+
+        a, b = neighbour_pairs(cells // 2)
+        far = np.abs(cells[a] - cells[b]).max(axis=1) > 1
+        a, b = a[far], b[far]
+        cell_force = np.zeros((len(cells), 2))
+        _add_pair_forces(cell_force, a, b, centroid, mass[a], mass[b], k)
+        force += cell_force[node_cell]
+        cells = cells // 2
+    return force
+
+
+def force_layout(n_nodes: int, edges: np.ndarray, n_iter: int = 50, k: float = 1.,
+                 seed=0, init: np.ndarray = None) -> np.ndarray:
+    """ Fruchterman-Reingold layout with grid-binned repulsion
+
+    Input:
+        edges: (n_edges, 2) node indices, direction and duplicates are ignored
+        k: ideal edge length
+        init: (n_nodes, 2) start positions, default uniform in a square of area n_nodes k^2
+    Returns:
+        positions: (n_nodes, 2), centered and scaled into [-1, 1]
+    """
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(max(n_nodes, 1)) * k
+    positions = rng.uniform(0, side, (n_nodes, 2)) if init is None else np.array(init, dtype=float)
+    if n_nodes < 2:
+        return np.zeros((n_nodes, 2))
+    edges = _undirected_edges(edges, n_nodes)
+    n_cells = max(n_nodes // NODES_PER_CELL, 1)
+
+    with tracing.span("force_layout", n_nodes=n_nodes, n_edges=len(edges), n_iter=n_iter):
+        for it in range(n_iter):
+            temperature = 0.1 * side * (1 - it / n_iter)
+            # Bin size from the bulk of the nodes, a few far away leaves would make it too coarse
+            extent = np.maximum(np.diff(np.percentile(positions, [5, 95], axis=0), axis=0)[0], 1e-3 * k)
+            cell = np.sqrt(extent.prod() / n_cells) * (1 + 1e-9)
+
+            displacement = repulsion(positions, cell, k)
+
+            # Attraction d^2 / k along the edges
+            delta = positions[edges[:, 1]] - positions[edges[:, 0]]
+            force = np.linalg.norm(delta, axis=1, keepdims=True) / k * delta
+            for end, sign in ((0, 1), (1, -1)):
+                displacement[:, 0] += sign * np.bincount(edges[:, end], force[:, 0], minlength=n_nodes)
+                displacement[:, 1] += sign * np.bincount(edges[:, end], force[:, 1], minlength=n_nodes)
+
+            # Move at most temperature
+            length = np.maximum(np.linalg.norm(displacement, axis=1, keepdims=True), 1e-12)
+            positions += displacement / length * np.minimum(length, temperature)
+
+    positions -= (positions.max(axis=0) + positions.min(axis=0)) / 2
+    return positions / max(np.abs(positions).max(), 1e-12)
+
+
+def local_edges(nodes: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """ Entity ids -> row indices of nodes, edges with an end outside of nodes are dropped
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    order = np.argsort(nodes)
+    sorted_nodes = nodes[order]
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    if len(nodes) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    idx = np.minimum(np.searchsorted(sorted_nodes, edges), len(nodes) - 1)
+    inside = np.all(sorted_nodes[idx] == edges, axis=1)
+    return order[idx[inside]]
+
+
+def subgraph_hash(nodes: np.ndarray, edges: np.ndarray, **params) -> str:
+    """ Identifies a layout: node ids (in order), undirected edges and layout parameters
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    h = hashlib.sha1(nodes.tobytes())
+    h.update(_undirected_edges(edges, int(nodes.max()) + 1 if len(nodes) else 1).tobytes())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+
+class LayoutCache():
+    def __init__(self, directory: str = "layouts"):
+        self.directory = directory
+        self._memory = {}
+
+    def layout(self, nodes: np.ndarray, edges: np.ndarray, **params) -> np.ndarray:
+        """ Positions (len(nodes), 2) of the subgraph, rows in the order of nodes
+
+        nodes: (global) entity ids of the subgraph
+        edges: (n_edges, 2) entity ids, edges with an end outside of nodes are dropped
+        params: passed to force_layout
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        key = subgraph_hash(nodes, edges, **params)
+        if key in self._memory:
+            return self._memory[key]
+        fname = os.path.join(self.directory, f"{key}.npy")
+        if os.path.exists(fname):
+            positions = np.load(fname)
+        else:
+            positions = force_layout(len(nodes), local_edges(nodes, edges), **params)
+            os.makedirs(self.directory, exist_ok=True)
+            np.save(fname, positions)
+        self._memory[key] = positions
+        return positions
+
+
+def draw_relations(ax, positions: np.ndarray, triples: np.ndarray, relation_names: list = None,
+                   colors: dict = None, linewidth: float = 0.5, arrows: bool = True,
+                   head_length: float = 0.03, shrink: float = 0.) -> dict:
+    """ One LineCollection (and one quiver of arrow heads) per relation
+
+    Input:
+        triples: (n, 3) (head, relation, tail) with head and tail rows of positions
+        relation_names: name of every relation id, for the colors and labels
+        shrink: the lines stop this far before the tail, e.g. the node radius
+    Returns:
+        relation name -> LineCollection, e.g. for a legend
+    """
+    triples = np.asarray(triples, dtype=np.int64).reshape(-1, 3)
+    colors = {**RELATION_COLORS, **(colors or {})}
+    collections = {}
+    for n, r in enumerate(np.unique(triples[:, 1])):
+        name = relation_names[r] if relation_names is not None else str(r)
+        color = colors.get(name, f"C{n}")
+        start, end = positions[triples[triples[:, 1] == r, 0]], positions[triples[triples[:, 1] == r, 2]]
+        delta = end - start
+        length = np.maximum(np.linalg.norm(delta, axis=1, keepdims=True), 1e-12)
+        end = end - delta / length * np.minimum(shrink, length)
+        collections[name] = ax.add_collection(LineCollection(np.stack([start, end], axis=1), colors=color,
+                                                             linewidths=linewidth, label=name))
+        if arrows:
+            head = delta / length * np.minimum(head_length, length)
+            ax.quiver(*(end - head).T, *head.T, color=color, angles="xy", scale_units="xy", scale=1,
+                      width=0.002, headwidth=4, headlength=5, headaxislength=4.5)
+    return collections
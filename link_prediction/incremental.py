@@ -0,0 +1,161 @@
+# Incremental evaluation when new triples arrive
+#
+# Keeps the filtered ranks of all test queries for every model cached, together
+# with running sums for Hits@k and MRR. Adding triples updates the triple store
+# and the filter index in place and only recomputes the queries whose
+# (relation, direction, anchor) got a new known answer.
+#
+# Optionally the models are fine-tuned for a few warm-started epochs on the new
+# triples. Then the queries whose anchor, relation or target embedding was
+# touched are recomputed as well. The scores of the other queries only move
+# through the candidate embeddings that were updated; call refresh() for an
+# exact recomputation of everything. The negative sampler of the warm starts
+# knows all triples of the store, not only the new ones.
+#
+# Triples may bring new entities (and relations): the store, the filter index and
+# the models (resize) grow. New entities are candidates of every query, so then all
+# queries are recomputed.
+
+import numpy as np
+
+from filter_index import FilterIndex
+from negative_sampling import NegativeSampler
+from ranking import ranks_of_targets
+from triples import TripleStore, HEAD, RELATION, TAIL
+import tracing
+
+
+class IncrementalEvaluator():
+    def __init__(self, models: list,
+                 store: TripleStore,
+                 relations: np.ndarray,
+                 anchors: np.ndarray,
+                 head_is_missing: np.ndarray,
+                 targets: np.ndarray,
+                 k: int = 10,
+                 filter_index: FilterIndex = None):
+        """ Caches the ranks of the queries for all models
+
+        Input:
+            models: with score(relations, anchors, head_is_missing) -> (n_queries, n_entities),
+                    fit(triples, epochs=..., sampler=...) for warm starts and
+                    resize(n_entities, n_relations) for new entities (e.g. kge.DistMult)
+            relations, anchors, head_is_missing, targets: the encoded test queries
+        """
+        self.models = models
+        self.store = store
+        self.k = k
+        self.relations = np.asarray(relations)
+        self.anchors = np.asarray(anchors)
+        self.head_is_missing = np.asarray(head_is_missing, dtype=bool)
+        self.targets = np.asarray(targets)
+        self.filter_index = filter_index or FilterIndex.from_triples(store.all_triples(), store.n_entities)
+
+        self._index_queries()
+        # Negative sampler of all known triples, built by the first warm start
+        self.sampler = None
+
+        self.ranks = np.zeros((len(models), len(self.targets)))
+        self._hits_sum = np.zeros(len(models))
+        self._rr_sum = np.zeros(len(models))
+        self.n_recomputed = 0
+        self.refresh()
+
+    def _compute(self, query_idx: np.ndarray, chunk_size: int = 1024):
+        """ (Re)computes the cached ranks and running metric sums of the given queries
+        """
+        with tracing.span("incremental_rank", n_queries=len(query_idx)):
+            for start in range(0, len(query_idx), chunk_size):
+                idx = query_idx[start:start + chunk_size]
+                r, a, h, t = self.relations[idx], self.anchors[idx], self.head_is_missing[idx], self.targets[idx]
+                for m, model in enumerate(self.models):
+                    scores = np.array(model.score(r, a, h), dtype=np.float64)
+                    self.filter_index.apply(scores, r, a, h, targets=t)
+                    new_ranks = ranks_of_targets(scores, t)
+                    old_ranks = self.ranks[m, idx]
+                    # Swap the contributions of these queries in the running sums
+                    self._hits_sum[m] += np.sum(new_ranks <= self.k) - np.sum((old_ranks <= self.k) & (old_ranks > 0))
+                    self._rr_sum[m] += np.sum(1. / new_ranks) - np.sum(np.divide(1., old_ranks, where=old_ranks > 0,
+                                                                                 out=np.zeros_like(old_ranks)))
+                    self.ranks[m, idx] = new_ranks
+        self.n_recomputed += len(query_idx)
+
+    def _index_queries(self):
+        # Queries sorted by their filter row key
+        self._query_keys = FilterIndex.row_keys(self.relations, self.anchors, self.head_is_missing,
+                                                self.store.n_entities)
+        self._by_key = np.argsort(self._query_keys, kind="stable")
+
+    def _grow(self, triples) -> bool:
+        """ Adds the new entities and relations of the triples (names), True if there are new entities
+        """
+        n_entities, n_relations = self.store.n_entities, self.store.n_relations
+        self.store.add_entities(name for t in triples for name in (t[0], t[2]))
+        self.store.add_relations(t[1] for t in triples)
+        if (self.store.n_entities, self.store.n_relations) == (n_entities, n_relations):
+            return False
+        for model in self.models:
+            model.resize(self.store.n_entities, self.store.n_relations)
+        if self.sampler is not None:
+            self.sampler.resize(self.store.n_entities, self.store.n_relations)
+        if self.store.n_entities > n_entities:
+            self.filter_index.resize(self.store.n_entities)
+            self._index_queries()
+        return self.store.n_entities > n_entities
+
+    def refresh(self):
+        """ Exact recomputation of all queries
+        """
+        self.ranks[:] = 0
+        self._hits_sum[:] = 0
+        self._rr_sum[:] = 0
+        self._compute(np.arange(len(self.targets)))
+
+    def hits_at_k(self) -> np.ndarray:
+        return self._hits_sum / len(self.targets)
+
+    def mean_reciprocal_rank(self) -> np.ndarray:
+        return self._rr_sum / len(self.targets)
+
+    def _queries_with_keys(self, keys: np.ndarray) -> np.ndarray:
+        sorted_keys = self._query_keys[self._by_key]
+        starts = np.searchsorted(sorted_keys, keys, side="left")
+        stops = np.searchsorted(sorted_keys, keys, side="right")
+        if len(keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return self._by_key[np.concatenate([np.arange(s, e) for s, e in zip(starts, stops)])]
+
+    def _queries_touching(self, entities: np.ndarray, relations: np.ndarray) -> np.ndarray:
+        touched = np.isin(self.anchors, entities) | np.isin(self.targets, entities) | \
+                  np.isin(self.relations, relations)
+        return np.nonzero(touched)[0]
+
+    def add_triples(self, triples, split: str = "train", warm_start_epochs: int = 0, **fit_kwargs) -> np.ndarray:
+        """ Appends the triples (names) to the store and updates the cached metrics
+
+        Returns:
+            the indices of the queries that were recomputed
+        """
+        with tracing.span("incremental_update", n_triples=len(triples)):
+            triples = list(triples)
+            new_entities = self._grow(triples)
+            encoded = self.store.add(split, triples)
+            changed_keys = self.filter_index.insert(encoded)
+            affected = self._queries_with_keys(changed_keys)
+
+            if warm_start_epochs and split == "train":
+                if self.sampler is None:
+                    self.sampler = NegativeSampler(self.store.all_triples(), self.store.n_entities,
+                                                   self.store.n_relations)
+                else:
+                    self.sampler.add(encoded)
+                for model in self.models:
+                    model.fit(encoded, epochs=warm_start_epochs, sampler=self.sampler, **fit_kwargs)
+                entities = np.unique(np.concatenate([encoded[:, HEAD], encoded[:, TAIL]]))
+                affected = np.union1d(affected, self._queries_touching(entities, np.unique(encoded[:, RELATION])))
+
+            if new_entities:
+                affected = np.arange(len(self.targets))
+            affected = np.unique(affected)
+            self._compute(affected)
+        return affected
@@ -1,6 +1,11 @@
+import copy
 from typing import Iterable
 import numpy as np
 
+from retrieval import exhaustive_top_k
+from quantize import QuantizedArray, quantize
+from negative_sampling import NegativeSampler
+
 class KGE():
     def __init__(self):
         pass
@@ -10,7 +15,146 @@ class KGE():
 
     def predict(words: Iterable[str]) -> np.ndarray:
         pass
-    
+
 class KGE_dummy(KGE):
     def predict(words: Iterable[str]) -> np.ndarray:
-        return np.arange(len(words))
\ No newline at end of file
+        return np.arange(len(words))
+
+
+class DistMult(KGE):
+    """ Bilinear diagonal model score(h, r, t) = sum(e_h * w_r * e_t)
+
+    Works on the int triples of a TripleStore (head, relation, tail)
+    """
+    def __init__(self, n_entities: int, n_relations: int, dim: int = 32, seed=None):
+        rng = np.random.default_rng(seed)
+        self.entity_emb = rng.normal(0, 1 / np.sqrt(dim), (n_entities, dim)).astype(np.float32)
+        self.relation_emb = rng.normal(0, 1 / np.sqrt(dim), (n_relations, dim)).astype(np.float32)
+        # Adagrad accumulators
+        self._g2_entity = np.zeros(n_entities, dtype=np.float32)
+        self._g2_relation = np.zeros(n_relations, dtype=np.float32)
+        self.rng = rng
+        # Negative sampler of the known positives, built by the first fit and kept
+        self.sampler = None
+
+    @property
+    def n_entities(self) -> int:
+        return len(self.entity_emb)
+
+    def resize(self, n_entities: int, n_relations: int) -> "DistMult":
+        """ Appends embeddings of new entities and relations, initialized like in __init__
+        """
+        dim = self.entity_emb.shape[1]
+        for name, g2_name, n in (("entity_emb", "_g2_entity", n_entities),
+                                 ("relation_emb", "_g2_relation", n_relations)):
+            emb = getattr(self, name)
+            n_new = n - len(emb)
+            if n_new > 0:
+                new = self.rng.normal(0, 1 / np.sqrt(dim), (n_new, dim)).astype(np.float32)
+                setattr(self, name, np.concatenate([emb, new]))
+                setattr(self, g2_name, np.concatenate([getattr(self, g2_name), np.zeros(n_new, dtype=np.float32)]))
+        if self.sampler is not None:
+            self.sampler.resize(n_entities, n_relations)
+        return self
+
+    def query_vectors(self, relations: np.ndarray, anchors: np.ndarray,
+                      head_is_missing: np.ndarray = None) -> np.ndarray:
+        """ The score of every candidate entity is query_vector @ entity_emb.T
+
+        DistMult is symmetric, so the direction of the query does not matter.
+        """
+        return self._entity_rows(anchors) * self.relation_emb[relations]
+
+    def _entity_rows(self, idx: np.ndarray) -> np.ndarray:
+        rows = self.entity_emb[idx]
+        return rows.dequantize() if isinstance(rows, QuantizedArray) else rows
+
+    def score(self, relations: np.ndarray, anchors: np.ndarray,
+              head_is_missing: np.ndarray = None, candidates=None) -> np.ndarray:
+        """ Scores of all entities, shape (n_queries, n_entities)
+
+        candidates: CandidateSets, only the candidates of every query are scored, the others are -inf
+        """
+        query_vectors = self.query_vectors(relations, anchors, head_is_missing)
+        if candidates is not None:
+            scores = np.full((len(query_vectors), self.n_entities), -np.inf, dtype=np.float32)
+            for query_idx, entities in candidates.groups(relations, head_is_missing):
+                scores[query_idx[:, None], entities] = query_vectors[query_idx] @ self._entity_rows(entities).T
+            return scores
+        if isinstance(self.entity_emb, QuantizedArray):
+            return self.entity_emb.matmul_T(query_vectors)
+        return query_vectors @ self.entity_emb.T
+
+    def quantize_embeddings(self, mode: str = "int8") -> "DistMult":
+        """ Copy for inference with the entity embeddings stored as float16 or int8
+        """
+        model = copy.copy(self)
+        model.entity_emb = quantize(self.entity_emb, mode)
+        return model
+
+    def top_k(self, relations: np.ndarray, anchors: np.ndarray,
+              head_is_missing: np.ndarray = None, k: int = 10,
+              index=None, n_probe: int = 8) -> tuple:
+        """ (ids, scores) of the k best entities per query
+
+        With an IVFIndex built over entity_emb only the probed lists are scored.
+        """
+        query_vectors = self.query_vectors(relations, anchors, head_is_missing)
+        if index is None:
+            return exhaustive_top_k(query_vectors, self.entity_emb, k)
+        return index.search(query_vectors, k=k, n_probe=n_probe)
+
+    def score_triples(self, triples: np.ndarray) -> np.ndarray:
+        h, r, t = triples[:, 0], triples[:, 1], triples[:, 2]
+        return np.sum(self.entity_emb[h] * self.relation_emb[r] * self.entity_emb[t], axis=-1)
+
+    def _sgd_step(self, triples: np.ndarray, labels: np.ndarray, lr: float, l2: float):
+        # Logistic loss log(1 + exp(-label * score)), Adagrad on the touched rows
+        h, r, t = triples[:, 0], triples[:, 1], triples[:, 2]
+        e_h, w_r, e_t = self.entity_emb[h], self.relation_emb[r], self.entity_emb[t]
+        scores = np.sum(e_h * w_r * e_t, axis=-1)
+        coeff = (-labels / (1 + np.exp(np.clip(labels * scores, -30, 30))))[:, None].astype(np.float32)
+
+        grad_h = coeff * w_r * e_t + l2 * e_h
+        grad_r = coeff * e_h * e_t + l2 * w_r
+        grad_t = coeff * e_h * w_r + l2 * e_t
+        self._adagrad(self.entity_emb, self._g2_entity, np.concatenate([h, t]),
+                      np.concatenate([grad_h, grad_t]), lr)
+        self._adagrad(self.relation_emb, self._g2_relation, r, grad_r, lr)
+
+    @staticmethod
+    def _adagrad(params: np.ndarray, g2: np.ndarray, idx: np.ndarray, grads: np.ndarray, lr: float):
+        rows, inverse = np.unique(idx, return_inverse=True)
+        grad = np.zeros((len(rows), params.shape[1]), dtype=params.dtype)
+        np.add.at(grad, inverse, grads)
+        g2[rows] += np.mean(grad**2, axis=-1)
+        params[rows] -= lr * grad / (np.sqrt(g2[rows])[:, None] + 1e-8)
+
+    def fit(self, X: np.ndarray, y=None, epochs: int = 10, lr: float = 0.1,
+            n_neg: int = 4, batch_size: int = 1024, l2: float = 1e-4,
+            sampler: NegativeSampler = None):
+        """ Mini-batch training with negative sampling, continues from the current embeddings
+
+        X: int triples (n_triples, 3), y is ignored (all triples are positives)
+        sampler: rejects all known positives, it is kept for the following fits. By default
+                 the first fit builds one of X, later fits add the triples of X it does not know.
+        """
+        X = np.asarray(X)
+        if sampler is not None:
+            self.sampler = sampler
+        elif self.sampler is None:
+            self.sampler = NegativeSampler(X, self.n_entities, len(self.relation_emb))
+        else:
+            new = X[~self.sampler.is_known(X)]
+            if len(new):
+                self.sampler.add(new)
+        sampler = self.sampler
+        for epoch in range(epochs):
+            order = self.rng.permutation(len(X))
+            for start in range(0, len(X), batch_size):
+                batch = X[order[start:start + batch_size]]
+                negatives = sampler.corrupt(batch, n_neg, rng=self.rng)
+                triples = np.concatenate([batch, negatives])
+                labels = np.concatenate([np.ones(len(batch)), -np.ones(len(negatives))])
+                self._sgd_step(triples, labels, lr, l2)
+        return self
@@ -3,37 +3,103 @@ from typing import Iterable
 
 from kge import KGE, KGE_dummy
 from query import Query
+import tracing
+
+
+class ProxySpec():
+    """ Behaviour of a proxy model: value = scale * truth + offset + noise
+
+    noise: name of a np.random.Generator distribution with (loc, scale), e.g.
+           "normal", "laplace", "logistic" or "gumbel"
+    """
+    def __init__(self, scale: float = 1., offset: float = 0.,
+                 noise: str = "normal", noise_loc: float = 0., noise_scale: float = 0.):
+        self.scale = scale
+        self.offset = offset
+        self.noise = noise
+        self.noise_loc = noise_loc
+        self.noise_scale = noise_scale
+
+    def __call__(self, truth: np.ndarray, rng: np.random.Generator, dtype=np.float64,
+                 n_draws: int = None) -> np.ndarray:
+        """ Values of a whole (n_queries, n_entities) block, the noise is drawn in one call
+
+        n_draws: (n_draws, n_queries, n_entities) independent noise realisations of the block
+        """
+        shape = truth.shape if n_draws is None else (n_draws, *truth.shape)
+        noise = getattr(rng, self.noise)(self.noise_loc, self.noise_scale, shape)
+        return (self.scale * truth + self.offset + noise).astype(dtype, copy=False)
+
+    def __repr__(self):
+        return f"ProxySpec({self.scale}*x + {self.offset} + {self.noise}({self.noise_loc}, {self.noise_scale}))"
+
 
 class KGE_model():
-    def __init__(self, entities: Iterable[str]):
+    spec = ProxySpec()
+
+    def __init__(self, entities: Iterable[str], spec: ProxySpec = None, seed=None):
+        """ seed: int or np.random.SeedSequence (e.g. from SeedSequence.spawn) of the noise
+        """
         self.kge = KGE_dummy()
         self.entities = entities
         self.n_entities = len(entities)
-        self.value_fn = lambda x: x
+        self.entity_to_id = {e: i for i, e in enumerate(entities)}
+        self.spec = spec or self.spec
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
 
     def fit(self, X, y):
-        self.X_train = X # (head, relation, tail)
-        self.kge.fit(X, y)
+        with tracing.span("fit", model=type(self).__name__):
+            self.X_train = X # (head, relation, tail)
+            self.kge.fit(X, y)
+            # Known answers per (relation, anchor, head_is_missing)
+            self._known = {}
+            for triple in X:
+                h, r, t = triple[:3]
+                if h in self.entity_to_id and t in self.entity_to_id:
+                    self._known.setdefault((r, t, True), []).append(self.entity_to_id[h])
+                    self._known.setdefault((r, h, False), []).append(self.entity_to_id[t])
 
     def predict_w_truth_prob(self, X: Iterable[Query],
                              truth_probs: Iterable[float],
-                             elements_of_interest: Iterable[str]) -> np.ndarray:
+                             elements_of_interest: Iterable[str],
+                             dtype=np.float64,
+                             candidates: Iterable[np.ndarray] = None,
+                             rng: np.random.Generator = None) -> np.ndarray:
         """ Makes the prediction according to truth_probs
+
+        Known triples have truth 1, the element of interest its truth_prob, the rest 0.
+        dtype: e.g. np.float32 to halve the memory of the returned scores
+        candidates: per query the entity indices to score (see CandidateSets), the others get -inf
+        rng: generator of the noise, by default the one of the model
         """
         assert len(X) == len(truth_probs) == len(elements_of_interest)
 
-        predicted_values = np.zeros((len(X), self.n_entities))
+        with tracing.span("predict", model=type(self).__name__, n_queries=len(X)) as sp:
+            truth = self.truth(X, truth_probs, elements_of_interest)
+            predicted_values = self.spec(truth, rng or self.rng, dtype=dtype)
+            sp.add_arrays(predicted_values)
+
+            if candidates is not None:
+                pruned = np.ones(predicted_values.shape, dtype=bool)
+                for i, idx in enumerate(candidates):
+                    pruned[i, idx] = False
+                predicted_values[pruned] = -np.inf
 
-        for i, query in enumerate(X):
-            for j, e in enumerate(self.entities):
-                if query.fill_in_missing_value(e) in self.X_train:
-                    predicted_values[i, j] = self.value_fn(1.0)
-                elif e is elements_of_interest[i]:
-                    predicted_values[i, j] = self.value_fn(truth_probs[i])
-                else:
-                    predicted_values[i, j] = self.value_fn(0.0)
-    
         return predicted_values
+
+    def truth(self, X: Iterable[Query],
+              truth_probs: Iterable[float],
+              elements_of_interest: Iterable[str]) -> np.ndarray:
+        """ (n_queries, n_entities) truth the proxy values are drawn around, see predict_w_truth_prob
+        """
+        truth = np.zeros((len(X), self.n_entities))
+        for i, query in enumerate(X):
+            eoi = self.entity_to_id.get(elements_of_interest[i])
+            if eoi is not None:
+                truth[i, eoi] = truth_probs[i]
+            truth[i, self._known.get((query.relation, query.value, query.head_is_missing), [])] = 1.
+        return truth
     
 
     def top_k(self, predicted_values: np.ndarray,
@@ -48,7 +114,6 @@ class KGE_model():
             # Calculate the rank
             rank = np.argsort(-predicted_values[i])
             y[i] = np.where(rank == e)[0] < k
-            print(e, rank)
         return y
     
     def hits_at_k(self, predicted_values: np.ndarray,
@@ -61,27 +126,21 @@ class KGE_model():
 
 
 class KGE_model_1(KGE_model):
-    def __init__(self, entities: Iterable[str]):
-        super().__init__(entities)
-        self.value_fn = lambda x: 1*x+np.random.normal(0, 0.)
-        
+    spec = ProxySpec(scale=1., offset=0., noise_loc=0., noise_scale=0.)
+
 class KGE_model_2(KGE_model):
-    def __init__(self, entities: Iterable[str]):
-        super().__init__(entities)
-        self.value_fn = lambda x: 60*x+np.random.normal(0, 10) + 20
-        
+    spec = ProxySpec(scale=60., offset=20., noise_loc=0., noise_scale=10.)
+
 class KGE_model_3(KGE_model):
-    def __init__(self, entities: Iterable[str]):
-        super().__init__(entities)
-        self.value_fn = lambda x: 5*x+np.random.normal(0.1, 0.1) - 2
-        
-class KGE_model_4(KGE_model):
-    def __init__(self, entities: Iterable[str]):
-        super().__init__(entities)
-        self.value_fn = lambda x: 2*x+np.random.normal(-0.1, 0.1)
-        
-        
+    spec = ProxySpec(scale=5., offset=-2., noise_loc=0.1, noise_scale=0.1)
 
+class KGE_model_4(KGE_model):
+    spec = ProxySpec(scale=2., offset=0., noise_loc=-0.1, noise_scale=0.1)
 
-        
 
+def proxy_models(entities: Iterable[str], specs: Iterable[ProxySpec], seed=None) -> list:
+    """ One proxy model per spec, every model gets its own independent noise stream
+    """
+    specs = list(specs)
+    seeds = np.random.SeedSequence(seed).spawn(len(specs))
+    return [KGE_model(entities, spec=spec, seed=s) for spec, s in zip(specs, seeds)]
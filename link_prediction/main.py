@@ -4,6 +4,7 @@
 #
 # Prints a latex table with the results and
 
+import os
 import numpy as np
 
 from typing import Iterable
@@ -13,128 +14,242 @@ from kge import KGE_dummy
 from kge_models import *
 from query import Query
 from voting_methods import Majority, Borda, Range
-from plot_graphs import plot_graph
+import plot_graphs
+from plot_graphs import plot_graph, plot_graph_layout
+from graph_layout import draw_relations
+from plot_glyph import draw_binary_glyph
+from report import write_report, ReportWriter
+from triples import TripleStore
+from filter_index import FilterIndex
+from ranking import filtered_ranks
+from quantize import quantize, rank_change_report, format_rank_change_report
+from parallel_eval import ParallelEvaluator
+from tensor_store import TensorStore
+from bootstrap import confidence_intervals, format_confidence_intervals
+from monte_carlo import MonteCarloEstimator, format_monte_carlo
+from pipeline import Pipeline, code_fingerprint
+import tracing
 
 # Presentation specific stuff
+import presentation
 from presentation import plot_graph_presentation
 
 
-def latex_table(query: Query,
-                entity_of_interest: str,
-                entities: Iterable[str],
-                model_preds: np.ndarray,
-                kge_models,
-                voting_methods,
-                k: int = 4) -> str:
-    """ Converts the predicted values to a latex table
-
-    Input:
-        model_preds.shape = (n_models, n_entities)
-        unsorted float values for query, e.g. (?, Orbits, Sun)
-    """
-    n_cols = len(kge_models)+len(voting_methods)+1
-
-    # Calculations
-    ranking_idz = np.argsort(-model_preds, axis=-1)
-    voting_val = [voting_methods[i](model_preds) for i in range(len(voting_methods))]
-    # Quickfix since voting methods don't yet work
-
-    # voting_idz = [np.argsort(-voting_val[i], axis=-1) for i in range(len(voting_methods))]
-    # print(voting_methods)
-    # print(f"ranking_idz {ranking_idz}")
-
-    # Shorten the name of the entities
-    shrink_names_dict = {"Curiosity Rover": "Rover",
-                  "Jupiter": "Jup."}
-    for i, e in enumerate(entities):
-        if e in shrink_names_dict:
-            entities[i] = shrink_names_dict[e]
-
-    # Latex
-    table = "\\begin{table} \n"
-    table += "\\centering \n"
-    table += "\\begin{tabular}{" + "r|"*(n_cols-1) + "r}\n"
-    
-    # Super-Header
-    table += f"&\\multicolumn{{{len(kge_models)}}}" + "{|c|}{Models}&\n"
-    table += f"\\multicolumn{{{len(voting_methods)}}}" + "{|c}{Voting Methods using Models $h_i$}" + r"\\"
-    table += "\n \\hline \n"
-    # Header
-    table += f"Rank &"
-    for i_col in range(n_cols-1):
-        if i_col < len(kge_models):
-            table += f"$h_{i_col}(q, e)$ &"
-        else:
-            table += f"{voting_methods[i_col-len(kge_models)]} &"
-    table = table[:-2] + r"\\" + "\n\\hline\n"
-
-    # Data
-    for i_rank in range(len(entities)):
-        table += f"{i_rank+1} &"
-        for i_model in range(len(kge_models)):
-            idx = ranking_idz[i_model, i_rank]
-            e = entities[idx]
-            val = model_preds[i_model, idx]
-            table += f"{e} ({val:.1f})&\t\t"
-        
-        for i_vot_mod in range(len(voting_methods)):
-            # e = entities[voting_idz[i_rank]]
-            # val = voting_val[i_vot_mod, voting_idz[i_rank]]
-            table += f"{e} ({val:.1f}) &"
-        
-        table = table[:-2] + r"\\" + "\n"
-        if i_rank == k-1:
-            table += r"\hline \hline" + "\n"
-    
-    # Latex
-    table += r"\end{tabular}" + "\n"
-    table += r"\caption{Sorted values of $h_i(tr(q,e))$ with $q=\langle ?, \text{orbits}, \text{sun} \rangle$ where we want to predict " + entity_of_interest + r"}" + "\n"
-    table += r"\end{table}"
-
-    return table
-
-
-def main(entities, train_relations):
+def load_data(entities, train_relations, test_relations) -> dict:
     # Prediction what orbits the sun
     test_queries = [Query("Sun", "orbits", head_is_missing=True)]
     entities_of_interest = ["Moon"]
     truth_probs = [0.4]
 
-    # Define Models and Voting methods
-    kge_models = [KGE_model_1(entities),
-                  KGE_model_2(entities),
-                  KGE_model_3(entities)]
-        
-    voting_methods = [Majority(), Borda(), Range()]
-    
+    # Filter every known answer except the one of interest
+    store = TripleStore(entities)
+    store.add("train", train_relations)
+    store.add("test", test_relations)
+    filter_index = FilterIndex.from_triples(store.all_triples(), store.n_entities)
+    relations, anchors, head_is_missing = store.encode_queries(test_queries)
+    targets = store.encode_entities(entities_of_interest)
+    return {"entities": list(entities), "train_relations": list(train_relations),
+            "test_queries": test_queries, "entities_of_interest": entities_of_interest,
+            "truth_probs": truth_probs, "filter_index": filter_index, "relations": relations,
+            "anchors": anchors, "head_is_missing": head_is_missing, "targets": targets}
+
+
+def train_models(data: dict) -> list:
+    # Define Models
+    entities = data["entities"]
+    seeds = np.random.SeedSequence(0).spawn(3)
+    kge_models = [KGE_model_1(entities, seed=seeds[0]),
+                  KGE_model_2(entities, seed=seeds[1]),
+                  KGE_model_3(entities, seed=seeds[2])]
+
     # "Training" (just memorizing)
+    train_relations = data["train_relations"]
     for model in kge_models:
         model.fit(train_relations, [0.] * len(train_relations))
+    return kge_models
+
+
+def score_queries(data: dict, models: list, scores_dir: str) -> TensorStore:
+    # Prediction, (model, chunk of queries) tasks on a thread pool
+    evaluator = ParallelEvaluator(chunk_size=256, seed=0)
+    test_queries, truth_probs = data["test_queries"], data["truth_probs"]
+    entities, entities_of_interest = data["entities"], data["entities_of_interest"]
+
+    def predict(m, start, stop, rng):
+        return models[m].predict_w_truth_prob(test_queries[start:stop], truth_probs[start:stop],
+                                              entities_of_interest[start:stop], dtype=np.float32, rng=rng)
+
+    # The scores are kept on disk and reused as long as models, data and the code computing them are the same
+    meta = {"entities": entities, "queries": [str(q) for q in test_queries],
+            "truth_probs": truth_probs, "models": [type(m).__name__ for m in models],
+            "specs": [repr(m.spec) for m in models], "seeds": [repr(m.seed) for m in models],
+            "evaluator": {"seed": evaluator.seed, "chunk_size": evaluator.chunk_size},
+            "code": code_fingerprint([ParallelEvaluator, *(type(m) for m in models)]),
+            "train": [list(t) for t in data["train_relations"]]}
+    scores = TensorStore.open_or_create(scores_dir, len(test_queries), (len(entities),), meta=meta)
+    if scores.n_models > len(models):
+        scores = TensorStore.create(scores_dir, len(test_queries), (len(entities),), meta=meta)
+    # One chunk of queries of one model in memory at a time, an interrupted run resumes with the next model
+    for i in range(scores.n_models, len(models)):
+        scores.append_model(lambda start, stop: evaluator.model_scores(predict, i, start, stop, len(entities)),
+                            name=f"h_{i}")
+    return scores
+
+
+def rank_models(data: dict, scores: TensorStore) -> dict:
+    evaluator = ParallelEvaluator(chunk_size=256, seed=0)
+
+    def stored_preds(m, start, stop, rng):
+        return scores.read_slice(m, slice(start, stop))
+
+    raw = evaluator.ranks(stored_preds, scores.n_models, data["targets"])
+    filtered = evaluator.ranks(stored_preds, scores.n_models, data["targets"], data["relations"],
+                               data["anchors"], data["head_is_missing"], filter_index=data["filter_index"])
+    return {"raw": raw, "filtered": filtered}
+
+
+def vote(data: dict, scores: TensorStore, voting_methods: list) -> dict:
+    return {str(vm): filtered_ranks(lambda start, stop: vm(scores.read_slice(queries=slice(start, stop))),
+                                    data["targets"], data["relations"], data["anchors"], data["head_is_missing"],
+                                    filter_index=data["filter_index"])
+            for vm in voting_methods}
+
+
+def bootstrap_metrics(ranks: dict, votes: dict, k: int, n_boot: int) -> dict:
+    # Bootstrap confidence intervals over the test queries
+    filtered = ranks["filtered"]
+    return confidence_intervals(filtered, votes, k=k, n_boot=n_boot, seed=0,
+                                model_names=[f"h_{i}" for i in range(len(filtered))])
+
+
+def monte_carlo_metrics(data: dict, models: list, voting_methods: list, k: int,
+                        mc_tol: float, mc_max_draws: int) -> dict:
+    # Distribution of the metrics over the noise of the proxy models, one run of score_queries is one draw
+    estimator = MonteCarloEstimator(models, voting_methods, k=k, filter_index=data["filter_index"], seed=0)
+    estimator.estimate(data["test_queries"], data["truth_probs"], data["entities_of_interest"], data["targets"],
+                       data["relations"], data["anchors"], data["head_is_missing"],
+                       tol=mc_tol, max_draws=mc_max_draws)
+    return {"summary": estimator.summary(), "n_draws": estimator.n_draws, "converged": estimator.converged,
+            "mean_ranks": estimator.mean_ranks, "rank_standard_errors": estimator.rank_standard_errors,
+            "rank_distributions": {name: [estimator.rank_distribution(name, q) for q in range(estimator.n_queries)]
+                                   for name in estimator.names},
+            "names": estimator.names}
+
+
+def precision_report(data: dict, scores: TensorStore, precision: str) -> dict:
+    # Rank changes if the scores are quantized
+    if precision == "float32":
+        return None
+    return rank_change_report(scores, data["targets"], modes=(precision,), chunk_size=scores.query_chunk,
+                              relations=data["relations"], anchors=data["anchors"],
+                              head_is_missing=data["head_is_missing"], filter_index=data["filter_index"])
+
+
+def render_report(data: dict, scores: TensorStore, voting_methods: list, k: int, precision: str) -> list:
+    # Table, CSV and ranked indices for all queries
+    files = ["table.tex", "table.csv", "ranking.npz"]
+    with tracing.span("report", n_queries=len(data["test_queries"])):
+        with open(files[0], "w") as latex_file, open(files[1], "w", newline="") as csv_file:
+            # Reduced precision: the votes are computed from the quantized scores
+            write_report(data["test_queries"], data["entities_of_interest"], data["entities"], scores,
+                         voting_methods, k=k,
+                         latex_file=latex_file,
+                         csv_file=csv_file,
+                         npz_file=files[2],
+                         precision=precision,
+                         query_chunk=scores.query_chunk)
+    return files
+
+
+def render_figures(entities_dict: dict, train_relations, test_relations) -> list:
+    with tracing.span("plot", fname="graph_clf_space"):
+        plot_graph(entities_dict, train_relations, test_relations)
+    with tracing.span("plot", fname="graph_layout"):
+        plot_graph_layout(list(entities_dict), train_relations, test_relations, fname="graph_layout")
+
+    with tracing.span("plot", fname="wout_test_queries"):
+        plot_graph_presentation(entities_dict, train_relations, test_relations=[],
+                                fname="wout_test_queries")
+
+    with tracing.span("plot", fname="example query"):
+        plot_graph_presentation(entities_dict, train_relations=[], test_relations=test_relations,
+                                fname="example query",
+                                show_pm_glyphs=False)
+
+    with tracing.span("plot", fname="simple_graph"):
+        plot_graph_presentation(entities={"Earth": (-2, 0), "Sun": (2, 0)}, train_relations=[("Earth", "orbits", "Sun")], test_relations=[],
+                                fname="simple_graph",
+                                figsize=(6, 6),
+                                legend_only_orbits=True)
+    return ["../figures/graph_clf_space.pdf", "../figures/graph_clf_space.png"] + \
+        [f"../figures/graphs/{fname}.png" for fname in ["graph_layout", "wout_test_queries", "example query", "simple_graph"]]
+
+
+def build_pipeline(cache_dir: str = "cache", **params) -> Pipeline:
+    """ Stages of the experiment, see pipeline.py. Parameters:
+        entities, train_relations, test_relations, scores_dir, voting_methods, k, n_boot, precision,
+        mc_tol, mc_max_draws, entities_dict (positions of the entities, only for the figures)
+    """
+    defaults = {"scores_dir": "scores", "voting_methods": [Majority(), Borda(), Range()],
+                "k": 4, "n_boot": 1000, "precision": "float32", "mc_tol": 0.005, "mc_max_draws": 4096}
+    pipeline = Pipeline(cache_dir, **{**defaults, **params})
+    pipeline.add("data", load_data, params=("entities", "train_relations", "test_relations"),
+                 code=(TripleStore, FilterIndex))
+    pipeline.add("models", train_models, inputs=("data",),
+                 code=(KGE_model, KGE_model_1, KGE_model_2, KGE_model_3, ProxySpec))
+    # The TensorStore is its own cache on disk
+    pipeline.add("scores", score_queries, inputs=("data", "models"), params=("scores_dir",), cache=False)
+    pipeline.add("ranks", rank_models, inputs=("data", "scores"), code=(ParallelEvaluator, filtered_ranks))
+    pipeline.add("votes", vote, inputs=("data", "scores"), params=("voting_methods",),
+                 code=(filtered_ranks, Majority, Borda, Range))
+    pipeline.add("metrics", bootstrap_metrics, inputs=("ranks", "votes"), params=("k", "n_boot"),
+                 code=(confidence_intervals,))
+    pipeline.add("monte_carlo", monte_carlo_metrics, inputs=("data", "models"),
+                 params=("voting_methods", "k", "mc_tol", "mc_max_draws"),
+                 code=(MonteCarloEstimator, KGE_model, ProxySpec))
+    pipeline.add("precision", precision_report, inputs=("data", "scores"), params=("precision",),
+                 code=(rank_change_report, quantize))
+    pipeline.add("report", render_report, inputs=("data", "scores"), params=("voting_methods", "k", "precision"),
+                 code=(write_report, ReportWriter, quantize), files=True)
+    pipeline.add("figures", render_figures, params=("entities_dict", "train_relations", "test_relations"),
+                 code=(plot_graphs.draw_entity, plot_graphs.draw_arrow, plot_graph, plot_graph_layout, draw_relations,
+                       presentation.draw_entity, presentation.draw_arrow, plot_graph_presentation, draw_binary_glyph),
+                 files=True)
+    return pipeline
+
+
+def main(entities, train_relations, test_relations=(), precision: str = "float32",
+         scores_dir: str = "scores", cache_dir: str = "cache", k: int = 4, monte_carlo: bool = False):
+    """ monte_carlo: also estimate the metrics over the noise of the proxy models (see monte_carlo.py)
+    """
+    pipeline = build_pipeline(cache_dir, entities=list(entities), train_relations=list(train_relations),
+                              test_relations=list(test_relations), scores_dir=scores_dir)
+    targets = ["ranks", "metrics", "precision", "report"] + (["monte_carlo"] if monte_carlo else [])
+    outputs = pipeline.run(targets, precision=precision, k=k)
+    print(f"Stages run: {', '.join(pipeline.executed) or 'none (all cached)'}")
+
+    # Metrics
+    filtered = outputs["ranks"]["filtered"]
+    print(format_confidence_intervals(outputs["metrics"]))
+    if outputs["precision"] is not None:
+        n_ranks = len(filtered) * len(filtered[0])
+        print(format_rank_change_report(outputs["precision"], n_ranks=n_ranks))
+    if monte_carlo:
+        mc = outputs["monte_carlo"]
+        print(format_monte_carlo(mc["summary"], mc["n_draws"], mc["converged"]))
+    return pipeline
 
-    # 
-    model_preds = np.zeros((len(kge_models), len(test_queries), len(entities)))
-    # Prediction
-    for i, model in enumerate(kge_models):
-        model_preds[i] = model.predict_w_truth_prob(test_queries, truth_probs, entities_of_interest)
-        idz = np.argsort(-model_preds[i])
-    
-    # Since only one query for table, remove inner dim
-    # (n_models, n_queries, n_entities) -> (n_models, n_entities)
-    model_preds = model_preds.squeeze()
-    latex_str = latex_table(query=test_queries[0],
-                            entity_of_interest=entities_of_interest[0],
-                            entities=entities,
-                            model_preds=model_preds,
-                            kge_models=kge_models,
-                            voting_methods=voting_methods)
-    # print(latex_str)
-    # save to file
-    with open("table.tex", "w") as f:
-        f.write(latex_str)
-    
-    
 
 if __name__ == "__main__":
+    # Set KGE_TRACE=trace.json to record a Chrome trace of the run
+    trace_file = os.environ.get("KGE_TRACE")
+    # Set KGE_MONTE_CARLO=1 to estimate the metrics over the noise of the proxy models
+    monte_carlo = bool(os.environ.get("KGE_MONTE_CARLO"))
+    # Set KGE_PRECISION=float16 or int8 to store the scores and take the votes quantized
+    precision = os.environ.get("KGE_PRECISION", "float32")
+    if trace_file:
+        tracing.enable(memory=True)
+
     # Draw nodes (entities) # 5:3.5
     entities_dict = {
         "Earth": (3, -0.5),
@@ -184,20 +299,13 @@ if __name__ == "__main__":
         # ("Hubble", "observes", "Sirius", 0.9),
     ]
 
-    plot_graph(entities_dict, train_relations, test_relations)
-    main(entities, train_relations)
-    
-    plot_graph_presentation(entities_dict, train_relations, test_relations=[],
-                            fname="wout_test_queries")
-
-    plot_graph_presentation(entities_dict, train_relations=[], test_relations=test_relations,
-                            fname="example query",
-                            show_pm_glyphs=False)
-    
-    plot_graph_presentation(entities={"Earth": (-2, 0), "Sun": (2, 0)}, train_relations=[("Earth", "orbits", "Sun")], test_relations=[],
-                            fname="simple_graph",
-                            figsize=(6, 6),
-                            legend_only_orbits=True)
+    # Only the stages whose inputs, parameters or code changed are run again
+    pipeline = main(entities, train_relations, test_relations, precision=precision, monte_carlo=monte_carlo)
+    pipeline.run(["figures"], entities_dict=entities_dict)
+
+    if trace_file:
+        tracing.export_chrome_trace(trace_file)
+        print(tracing.summary())
 
 
 
@@ -0,0 +1,265 @@
+# Monte Carlo estimation over the noise of the proxy models
+#
+# A proxy model is value = scale * truth + offset + noise (see kge_models.ProxySpec),
+# so one prediction is one sample. Here S noise realisations of all models are drawn
+# as (S, M, Q, E) blocks, chunked over the draws and the queries so that a block
+# (with its truth and votes) stays below CHUNK_BYTES: the queries are split into
+# chunks of which one draw fits, the draws into chunks of up to min_draws. A warning is
+# given if even one draw of one query does not fit.
+# Per (draw chunk, query chunk) the truth of the query chunk is computed (once, if all
+# queries are one chunk), it costs one noise call per model, one rank count over all
+# (draw, model, query) rows and one vote per draw and method. Every block draws from
+# its own Generator (SeedSequence(seed, spawn_key=(chunk, model, query_chunk))), so the
+# draws only depend on the seed and the chunk sizes.
+#
+# Per draw the filtered ranks of every model and voting method give Hits@k, MRR and
+# (model 0 is h0) the ambiguity and discrepancy of the top-k decisions, as in
+# bootstrap.py; they are summed over the query chunks of the draw. Their mean and
+# variance over the draws are merged chunk by chunk (Chan et al.), the standard
+# error is sqrt(var / n_draws). Sequential stopping: no more chunks are drawn once
+# min_draws are done and the largest standard error of these statistics is below tol
+# (or at max_draws).
+# The distribution of the rank of every target is kept as a sparse histogram (only
+# the ranks that occurred), the realistic ranks are multiples of 1/2.
+#
+# Example:
+#     estimator = MonteCarloEstimator(models, [Borda()], k=4, filter_index=filter_index)
+#     estimator.estimate(queries, truth_probs, elements_of_interest, targets,
+#                        relations, anchors, head_is_missing, tol=0.005)
+#     print(format_monte_carlo(estimator.summary()))
+
+import warnings
+
+import numpy as np
+
+from filter_index import FilterIndex
+from ranking import ranks_of_targets
+import tracing
+
+
+CHUNK_BYTES = 64 << 20
+
+
+class RunningMoments():
+    def __init__(self, n_statistics: int):
+        self.n = 0
+        self.mean = np.zeros(n_statistics)
+        self.m2 = np.zeros(n_statistics)    # sum of the squared deviations from the mean
+
+    def update(self, samples: np.ndarray):
+        """ samples.shape = (n_samples, n_statistics)
+        """
+        n = len(samples)
+        if n == 0:
+            return
+        mean = samples.mean(axis=0)
+        m2 = ((samples - mean) ** 2).sum(axis=0)
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+    @property
+    def variance(self) -> np.ndarray:
+        return self.m2 / max(self.n - 1, 1)
+
+    @property
+    def standard_error(self) -> np.ndarray:
+        return np.sqrt(self.variance / max(self.n, 1))
+
+
+class MonteCarloEstimator():
+    def __init__(self, models: list, voting_methods=(), k: int = 10, ties: str = "realistic",
+                 filter_index: FilterIndex = None, seed=0, chunk_bytes: int = CHUNK_BYTES,
+                 model_names: list = None):
+        """ models: fitted kge_models.KGE_model, model 0 is h0
+        """
+        self.models = list(models)
+        self.voting_methods = list(voting_methods)
+        self.k = k
+        self.ties = ties
+        self.filter_index = filter_index
+        self.seed = seed
+        self.chunk_bytes = chunk_bytes
+        model_names = model_names or [f"h_{i}" for i in range(len(self.models))]
+        self.names = list(model_names) + [str(vm) for vm in self.voting_methods]
+
+    @property
+    def n_models(self) -> int:
+        return len(self.models)
+
+    @property
+    def statistic_names(self) -> list:
+        names = [f"Hits@{self.k} {name}" for name in self.names] + [f"MRR {name}" for name in self.names]
+        names.append("ambiguity")
+        if self.n_models > 1:
+            names.append("discrepancy")
+        return names
+
+    def rng(self, chunk_idx: int, model_idx: int, query_chunk_idx: int = 0) -> np.random.Generator:
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(chunk_idx, model_idx, query_chunk_idx)))
+
+    def draw(self, truth: np.ndarray, chunk_idx: int, n_draws: int, query_chunk_idx: int = 0) -> np.ndarray:
+        """ (n_draws, M, Q, E) float32 values of all models, truth.shape = (M, Q, E) of one query chunk
+        """
+        block = np.empty((n_draws, *truth.shape), dtype=np.float32)
+        for m, model in enumerate(self.models):
+            block[:, m] = model.spec(truth[m], self.rng(chunk_idx, m, query_chunk_idx), dtype=np.float32,
+                                     n_draws=n_draws)
+        return block
+
+    def ranks(self, block: np.ndarray, targets: np.ndarray, filtered: tuple) -> np.ndarray:
+        """ (n_draws, n_models + n_voting_methods, Q) filtered ranks of the targets of one block
+
+        filtered: (query_idx, entity_idx) of the known answers except the targets
+        """
+        n_draws, n_models, n_queries, n_entities = block.shape
+        # The votes are taken on the unfiltered values, as in main.vote
+        voted = np.empty((n_draws, len(self.voting_methods), n_queries, n_entities), dtype=np.float32)
+        for v, vm in enumerate(self.voting_methods):
+            for s in range(n_draws):
+                voted[s, v] = vm(block[s])
+        ranks = []
+        for values in (block, voted):
+            values[:, :, filtered[0], filtered[1]] = -np.inf
+            rows = values.reshape(-1, n_entities)
+            ranks.append(ranks_of_targets(rows, np.tile(targets, len(rows) // n_queries), ties=self.ties)
+                         .reshape(n_draws, -1, n_queries))
+        return np.concatenate(ranks, axis=1)
+
+    def sums(self, ranks: np.ndarray) -> np.ndarray:
+        """ (n_draws, n_sums) sums over the queries of one block, see statistics
+        """
+        hits = ranks <= self.k
+        flips = hits[:, 1:self.n_models] != hits[:, :1]
+        return np.hstack([hits.sum(axis=-1), (1. / ranks).sum(axis=-1),
+                          flips.any(axis=1).sum(axis=-1)[:, None], flips.sum(axis=-1)])
+
+    def statistics(self, sums: np.ndarray, n_queries: int) -> np.ndarray:
+        """ (n_draws, n_statistics) Hits@k, MRR, ambiguity and discrepancy of every draw
+        from the sums over all queries
+        """
+        n_names = len(self.names)
+        means = sums / n_queries
+        # Decisions of the members which differ from h0: on any query, and per member
+        statistics = [means[:, :2 * n_names + 1]]
+        if self.n_models > 1:
+            statistics.append(means[:, 2 * n_names + 1:].max(axis=1)[:, None])
+        return np.hstack(statistics)
+
+    def _count_ranks(self, ranks: np.ndarray, query_start: int):
+        # Bin of rank r is 2 r - 2, r = 1, 1.5, ..., n_entities, key (name, query, bin)
+        n_bins = 2 * self.n_entities - 1
+        names = np.arange(ranks.shape[1])[:, None]
+        queries = query_start + np.arange(ranks.shape[2])
+        keys = ((names * self.n_queries + queries) * n_bins + np.rint(2 * ranks - 2).astype(np.int64)).ravel()
+        keys, inverse = np.unique(np.concatenate([self._rank_keys, keys]), return_inverse=True)
+        weights = np.concatenate([self._rank_key_counts, np.ones(ranks.size, dtype=np.int64)])
+        self._rank_keys = keys
+        self._rank_key_counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(keys)).astype(np.int64)
+
+    def _query_chunk(self, queries, truth_probs, elements_of_interest, targets, relations, anchors,
+                     head_is_missing, start: int, stop: int) -> tuple:
+        # Truth (M, q, E) and the known answers except the targets of the queries start:stop
+        truth = np.stack([model.truth(queries[start:stop], truth_probs[start:stop], elements_of_interest[start:stop])
+                          for model in self.models])
+        filtered = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        if self.filter_index is not None:
+            query_idx, entity_idx = self.filter_index.gather(relations[start:stop], anchors[start:stop],
+                                                             head_is_missing[start:stop])
+            keep = entity_idx != targets[start:stop][query_idx]
+            filtered = (query_idx[keep], entity_idx[keep])
+        return truth, filtered
+
+    def estimate(self, queries: list, truth_probs: list, elements_of_interest: list, targets: np.ndarray,
+                 relations: np.ndarray = None, anchors: np.ndarray = None, head_is_missing: np.ndarray = None,
+                 tol: float = 0.005, min_draws: int = 32, max_draws: int = 4096) -> "MonteCarloEstimator":
+        """ Draws chunks of noise realisations until the estimates converge
+
+        Input:
+            queries, truth_probs, elements_of_interest: as for KGE_model.predict_w_truth_prob
+            targets: (Q,) entity index of the element of interest of every query
+            relations, anchors, head_is_missing: encoded queries, only needed with a filter_index
+            tol: stop once the standard errors of all statistics are below tol
+        """
+        targets = np.asarray(targets)
+        self.n_queries, self.n_entities = len(queries), self.models[0].n_entities
+        n_names = len(self.names)
+
+        # Bytes per (draw, query): values, votes and the share of the truth
+        row_bytes = 4 * self.n_entities * (self.n_models + len(self.voting_methods)) + 8 * self.n_entities * self.n_models
+        if row_bytes > self.chunk_bytes:
+            warnings.warn(f"One draw of one query takes {row_bytes} bytes, more than chunk_bytes={self.chunk_bytes}")
+        query_chunk = int(np.clip(self.chunk_bytes // row_bytes, 1, self.n_queries))
+        # Convergence is checked after every chunk, the first time at min_draws
+        chunk_draws = int(np.clip(self.chunk_bytes // (row_bytes * query_chunk), 1, min(min_draws, max_draws)))
+        query_starts = list(range(0, self.n_queries, query_chunk))
+        self.moments = RunningMoments(len(self.statistic_names))
+        self.rank_moments = [RunningMoments(n_names * (min(start + query_chunk, self.n_queries) - start))
+                             for start in query_starts]
+        self._rank_keys = np.zeros(0, dtype=np.int64)
+        self._rank_key_counts = np.zeros(0, dtype=np.int64)
+        self.converged = False
+        inputs = (queries, truth_probs, elements_of_interest, targets, relations, anchors, head_is_missing)
+        # Computed once if all queries are one chunk
+        single = self._query_chunk(*inputs, 0, self.n_queries) if len(query_starts) == 1 else None
+
+        with tracing.span("monte_carlo", n_models=self.n_models, n_queries=self.n_queries,
+                          n_entities=self.n_entities, chunk_draws=chunk_draws, query_chunk=query_chunk,
+                          max_draws=max_draws):
+            for chunk_idx in range(-(-max_draws // chunk_draws)):
+                n_draws = min(chunk_draws, max_draws - self.n_draws)
+                sums = 0.
+                for q, start in enumerate(query_starts):
+                    stop = min(start + query_chunk, self.n_queries)
+                    truth, filtered = single or self._query_chunk(*inputs, start, stop)
+                    ranks = self.ranks(self.draw(truth, chunk_idx, n_draws, q), targets[start:stop], filtered)
+                    sums = sums + self.sums(ranks)
+                    self.rank_moments[q].update(ranks.reshape(n_draws, -1))
+                    self._count_ranks(ranks, start)
+                self.moments.update(self.statistics(sums, self.n_queries))
+                if self.n_draws >= min_draws and self.moments.standard_error.max() < tol:
+                    self.converged = True
+                    break
+        return self
+
+    @property
+    def n_draws(self) -> int:
+        return self.moments.n
+
+    @property
+    def mean_ranks(self) -> np.ndarray:
+        """ (n_names, Q) expected rank of every target
+        """
+        return np.concatenate([m.mean.reshape(len(self.names), -1) for m in self.rank_moments], axis=1)
+
+    @property
+    def rank_standard_errors(self) -> np.ndarray:
+        return np.concatenate([m.standard_error.reshape(len(self.names), -1) for m in self.rank_moments], axis=1)
+
+    def rank_distribution(self, name: str, query: int) -> tuple:
+        """ (ranks, probabilities) of the target of a query under a model or voting method
+        """
+        n_bins = 2 * self.n_entities - 1
+        first = (self.names.index(name) * self.n_queries + query) * n_bins
+        lo, hi = np.searchsorted(self._rank_keys, [first, first + n_bins])
+        counts = self._rank_key_counts[lo:hi]
+        return 1. + (self._rank_keys[lo:hi] - first) / 2, counts / counts.sum()
+
+    def summary(self) -> dict:
+        """ {statistic: {"estimate", "se", "std"}}, std is the spread over the draws
+        """
+        return {name: {"estimate": float(mean), "se": float(se), "std": float(np.sqrt(var))}
+                for name, mean, se, var in zip(self.statistic_names, self.moments.mean,
+                                               self.moments.standard_error, self.moments.variance)}
+
+
+def format_monte_carlo(summary: dict, n_draws: int = None, converged: bool = None) -> str:
+    header = f"{'statistic':<24} {'estimate':>8} {'se':>8} {'std':>8}"
+    if n_draws is not None:
+        header += f"  ({n_draws} draws{'' if converged is None else ', converged' if converged else ', not converged'})"
+    lines = [header]
+    for name, s in summary.items():
+        lines.append(f"{name:<24} {s['estimate']:>8.3f} {s['se']:>8.4f} {s['std']:>8.3f}")
+    return "\n".join(lines)
@@ -0,0 +1,104 @@
+# Filtered negative sampling for KGE training
+#
+# Every triple is packed into one int64 key (head * n_relations + relation) * n_entities + tail.
+# A batch is corrupted at once, the candidates are checked against the sorted keys
+# of the known positives with one np.searchsorted, and only the slots that hit a
+# known positive are drawn again.
+#
+# Strategies:
+#     uniform: head or tail is corrupted with probability 1/2
+#     bernoulli: the head is corrupted with probability tph / (tph + hpt) of the relation
+#                (tails per head, heads per tail), so 1-N relations get fewer false negatives
+
+import numpy as np
+
+from triples import HEAD, RELATION, TAIL
+
+
+def triple_keys(triples: np.ndarray, n_entities: int, n_relations: int) -> np.ndarray:
+    triples = np.asarray(triples, dtype=np.int64)
+    return (triples[:, HEAD] * n_relations + triples[:, RELATION]) * n_entities + triples[:, TAIL]
+
+
+class NegativeSampler():
+    def __init__(self, positives: np.ndarray,
+                 n_entities: int,
+                 n_relations: int,
+                 strategy: str = "uniform",
+                 max_rounds: int = 10,
+                 seed=None):
+        """ positives: all known int triples (n_triples, 3), e.g. TripleStore.all_triples()
+        """
+        assert strategy in ("uniform", "bernoulli")
+        assert n_entities**2 * n_relations < np.iinfo(np.int64).max
+        self.n_entities = n_entities
+        self.n_relations = n_relations
+        self.strategy = strategy
+        self.max_rounds = max_rounds
+        self.rng = np.random.default_rng(seed)
+        positives = np.asarray(positives).reshape(-1, 3)
+        self.keys = np.unique(triple_keys(positives, n_entities, n_relations))
+        self.head_prob = self._head_probabilities(positives)
+
+    def _head_probabilities(self, positives: np.ndarray) -> np.ndarray:
+        if self.strategy == "uniform" or len(positives) == 0:
+            return np.full(self.n_relations, 0.5)
+        r = positives[:, RELATION].astype(np.int64)
+        n_triples = np.bincount(r, minlength=self.n_relations)
+        # Distinct (relation, head) and (relation, tail) pairs
+        n_heads = np.bincount(np.unique(r * self.n_entities + positives[:, HEAD]) // self.n_entities,
+                              minlength=self.n_relations)
+        n_tails = np.bincount(np.unique(r * self.n_entities + positives[:, TAIL]) // self.n_entities,
+                              minlength=self.n_relations)
+        tph = n_triples / np.maximum(n_heads, 1)
+        hpt = n_triples / np.maximum(n_tails, 1)
+        return np.where(n_triples > 0, tph / np.maximum(tph + hpt, 1e-12), 0.5)
+
+    def add(self, triples: np.ndarray):
+        """ New known positives (the Bernoulli probabilities are not updated)
+        """
+        self.keys = np.union1d(self.keys, triple_keys(np.asarray(triples).reshape(-1, 3),
+                                                      self.n_entities, self.n_relations))
+
+    def resize(self, n_entities: int, n_relations: int):
+        """ More entities or relations, the keys are re-packed (their order does not change)
+        """
+        assert n_entities >= self.n_entities and n_relations >= self.n_relations
+        if (n_entities, n_relations) == (self.n_entities, self.n_relations):
+            return
+        assert n_entities**2 * n_relations < np.iinfo(np.int64).max
+        tails = self.keys % self.n_entities
+        heads, relations = np.divmod(self.keys // self.n_entities, self.n_relations)
+        self.keys = (heads * n_relations + relations) * n_entities + tails
+        self.head_prob = np.concatenate([self.head_prob, np.full(n_relations - self.n_relations, 0.5)])
+        self.n_entities, self.n_relations = n_entities, n_relations
+
+    def is_known(self, triples: np.ndarray) -> np.ndarray:
+        keys = triple_keys(triples, self.n_entities, self.n_relations)
+        known = np.zeros(len(keys), dtype=bool)
+        if len(self.keys) == 0:
+            return known
+        # Searching sorted keys walks self.keys in order, which is much more cache friendly
+        order = np.argsort(keys)
+        keys = keys[order]
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        known[order] = self.keys[pos] == keys
+        return known
+
+    def corrupt(self, batch: np.ndarray, n_neg: int, rng: np.random.Generator = None) -> np.ndarray:
+        """ n_neg corrupted triples per triple of the batch, shape (len(batch) * n_neg, 3)
+
+        Slots still hitting a known positive after max_rounds are kept as they are.
+        """
+        rng = rng or self.rng
+        negatives = np.repeat(batch, n_neg, axis=0)
+        corrupt_head = rng.random(len(negatives)) < self.head_prob[negatives[:, RELATION]]
+        column = np.where(corrupt_head, HEAD, TAIL)
+        negatives[np.arange(len(negatives)), column] = rng.integers(0, self.n_entities, len(negatives))
+        slots = np.nonzero(self.is_known(negatives))[0]
+        for _ in range(self.max_rounds - 1):
+            if len(slots) == 0:
+                break
+            negatives[slots, column[slots]] = rng.integers(0, self.n_entities, len(slots))
+            slots = slots[self.is_known(negatives[slots])]
+        return negatives
@@ -0,0 +1,131 @@
+# Thread-parallel evaluation of the test queries
+#
+# The queries are split into chunks and every (model, chunk) pair is one task on a
+# ThreadPoolExecutor. NumPy releases the GIL in its heavy kernels (matmul, sort,
+# random generation), so the threads use all cores without pickling anything.
+# BLAS is pinned to blas_threads per task (with threadpoolctl, if installed) so
+# that n_workers tasks do not each start a full BLAS thread pool.
+#
+# Every task writes into its own slice of a preallocated result and draws from
+# its own Generator (SeedSequence(seed, spawn_key=(model, chunk))), so the result
+# does not depend on the number of threads or the order the tasks finish in.
+#
+# Usage:
+#     evaluator = ParallelEvaluator(n_workers=8)
+#     ranks = evaluator.ranks(model_score_fn(models, relations, anchors, head_is_missing),
+#                             len(models), targets, relations, anchors, head_is_missing,
+#                             filter_index=filter_index)
+
+import contextlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+import numpy as np
+
+from candidates import CandidateSets
+from filter_index import FilterIndex
+from ranking import ranks_of_targets
+import tracing
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+def model_score_fn(models: list, relations: np.ndarray, anchors: np.ndarray, head_is_missing: np.ndarray):
+    """ score_fn for models with a score(relations, anchors, head_is_missing) method (e.g. kge.DistMult)
+    """
+    def score_fn(m, start, stop, rng):
+        return models[m].score(relations[start:stop], anchors[start:stop], head_is_missing[start:stop])
+    return score_fn
+
+
+class ParallelEvaluator():
+    def __init__(self, n_workers: int = None, chunk_size: int = 1024, blas_threads: int = 1, seed=0):
+        """ score_fn(model_idx, start, stop, rng) -> (stop - start, n_entities) scores
+        of the queries start:stop, noise is drawn from rng
+        """
+        self.n_workers = n_workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.blas_threads = blas_threads
+        self.seed = seed
+
+    def _blas_limits(self):
+        if threadpool_limits is None or self.blas_threads is None:
+            return contextlib.nullcontext()
+        return threadpool_limits(limits=self.blas_threads, user_api="blas")
+
+    def rng(self, model_idx: int, chunk_idx: int) -> np.random.Generator:
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(model_idx, chunk_idx)))
+
+    def _chunks(self, start: int, stop: int) -> list:
+        # (chunk, start, stop) of the queries start:stop, on the grid of chunk_size from query 0
+        return [(c, max(start, c * self.chunk_size), min(stop, (c + 1) * self.chunk_size))
+                for c in range(start // self.chunk_size, -(-stop // self.chunk_size))]
+
+    def _run(self, task, models: Iterable[int], chunks: list, name: str):
+        models = list(models)
+        n_queries = sum(stop - start for _, start, stop in chunks)
+        with tracing.span(name, n_models=len(models), n_queries=n_queries, n_workers=self.n_workers), \
+                self._blas_limits(), ThreadPoolExecutor(self.n_workers) as pool:
+            futures = [pool.submit(task, m, c, start, stop) for m in models for c, start, stop in chunks]
+            for future in futures:
+                future.result()
+
+    def scores(self, score_fn, n_models: int, n_queries: int, n_entities: int,
+               dtype=np.float32) -> np.ndarray:
+        """ All scores, shape (n_models, n_queries, n_entities)
+        """
+        scores = np.zeros((n_models, n_queries, n_entities), dtype=dtype)
+
+        def task(m, c, start, stop):
+            scores[m, start:stop] = score_fn(m, start, stop, self.rng(m, c))
+
+        self._run(task, range(n_models), self._chunks(0, n_queries), "parallel_predict")
+        return scores
+
+    def model_scores(self, score_fn, model_idx: int, start: int, stop: int, n_entities: int,
+                     dtype=np.float32) -> np.ndarray:
+        """ Scores of one model for the queries start:stop, shape (stop - start, n_entities)
+
+        Same values as scores(...)[model_idx, start:stop] if start and stop are multiples of
+        chunk_size (or stop is n_queries), e.g. for TensorStore.append_model.
+        """
+        scores = np.zeros((stop - start, n_entities), dtype=dtype)
+
+        def task(m, c, c_start, c_stop):
+            scores[c_start - start:c_stop - start] = score_fn(m, c_start, c_stop, self.rng(m, c))
+
+        self._run(task, [model_idx], self._chunks(start, stop), "parallel_predict")
+        return scores
+
+    def ranks(self, score_fn, n_models: int,
+              targets: np.ndarray,
+              relations: np.ndarray = None,
+              anchors: np.ndarray = None,
+              head_is_missing: np.ndarray = None,
+              filter_index: FilterIndex = None,
+              candidates: CandidateSets = None,
+              ties: str = "realistic") -> np.ndarray:
+        """ Filtered ranks of the targets (see ranking.filtered_ranks), shape (n_models, n_queries)
+
+        Only one chunk of scores per thread is alive at a time.
+        """
+        targets = np.asarray(targets)
+        ranks = np.zeros((n_models, len(targets)))
+
+        def task(m, c, start, stop):
+            chunk = np.array(score_fn(m, start, stop, self.rng(m, c)))
+            if not np.issubdtype(chunk.dtype, np.floating):
+                chunk = chunk.astype(np.float32)
+            if candidates is not None:
+                candidates.apply(chunk, relations[start:stop], head_is_missing[start:stop])
+            if filter_index is not None:
+                filter_index.apply(chunk, relations[start:stop], anchors[start:stop],
+                                   head_is_missing[start:stop], targets=targets[start:stop])
+            ranks[m, start:stop] = ranks_of_targets(chunk, targets[start:stop], ties=ties)
+
+        self._run(task, range(n_models), self._chunks(0, len(targets)), "parallel_rank")
+        return ranks
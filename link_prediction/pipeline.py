@@ -0,0 +1,248 @@
+# Memoized experiment pipeline
+#
+# An experiment is a chain of named stages (data, models, scores, voting, metrics,
+# report, figures). A stage is a function of the outputs of its input stages and of
+# named parameters, it is called with keyword arguments:
+#     pipeline.add("ranks", rank_models, inputs=("data", "scores"), params=("ties",))
+#     -> rank_models(data=..., scores=..., ties=...)
+#
+# The output of a stage is pickled to cache_dir/{name}-{key}.pkl with
+#     key = hash(source code of the stage function, of the modules of the objects it
+#                refers to by a global name and of the objects listed in code=, together
+#                with the modules in their directory these import (transitively),
+#                values of its parameters, keys of its input stages)
+# E.g. rank_models refers to ParallelEvaluator, so parallel_eval.py, ranking.py and
+# filter_index.py are part of the key. code= is for the code that is reached through
+# the inputs or parameters (methods of models or voting methods), helpers in the
+# module of the stage function itself have to be listed there as well.
+# So changing a parameter or the code of a stage re-runs that stage and everything
+# downstream of it, the stages upstream are not even loaded. A sweep runs the
+# pipeline for every combination of parameter values, stages whose key does not
+# depend on the swept parameters are computed once.
+#
+# Stages with side effects (files) declare files=True and return the paths they
+# wrote, they re-run if one of the files is gone or was overwritten (e.g. by the
+# same stage with other parameters), a hash of the files is kept with the output. Stages with cache=False run
+# whenever they are needed, e.g. if they keep their own cache on disk.
+#
+# Usage:
+#     pipeline = Pipeline("cache", k=4)
+#     pipeline.add("data", load_data, params=("entities",))
+#     pipeline.add("metrics", metrics, inputs=("data",), params=("k",))
+#     outputs = pipeline.run(entities=entities)
+#     results = pipeline.sweep(["metrics"], k=[1, 4, 10])
+
+import hashlib
+import inspect
+import itertools
+import os
+import pickle
+from collections import namedtuple
+
+import tracing
+
+
+Stage = namedtuple("Stage", ["name", "fn", "inputs", "params", "code", "cache", "files"])
+
+
+def source_of(obj) -> str:
+    """ Source code of a function or class, its qualified name if there is none (builtins)
+    """
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return f"{getattr(obj, '__module__', '')}.{getattr(obj, '__qualname__', repr(obj))}"
+
+
+def _directory(obj) -> str:
+    module = obj if inspect.ismodule(obj) else inspect.getmodule(obj)
+    file = getattr(module, "__file__", None)
+    return None if file is None else os.path.dirname(os.path.abspath(file))
+
+
+def local_modules(obj, directory: str = None) -> list:
+    """ Module of obj (a module, class or function) and the modules it imports, directly
+    or through each other, sorted by name. Only modules in directory count, by default
+    the one of obj.
+    """
+    directory = directory or _directory(obj)
+    found = {}
+    pending = [obj]
+    while pending:
+        dep = pending.pop()
+        module = dep if inspect.ismodule(dep) else inspect.getmodule(dep)
+        if module is None or module.__name__ in found or _directory(module) != directory:
+            continue
+        found[module.__name__] = module
+        pending += [v for v in vars(module).values() if inspect.ismodule(v) or inspect.isclass(v) or inspect.isfunction(v)]
+    return [found[name] for name in sorted(found)]
+
+
+def referenced_globals(fn) -> list:
+    """ Modules, classes and functions a function refers to by a global name,
+    also from the functions and lambdas defined in it
+    """
+    names, codes = set(), [fn.__code__]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes += [c for c in code.co_consts if inspect.iscode(c)]
+    values = [fn.__globals__[n] for n in sorted(names) if n in fn.__globals__]
+    return [v for v in values if inspect.ismodule(v) or inspect.isclass(v) or inspect.isfunction(v)]
+
+
+def code_fingerprint(objs, directory: str = None) -> str:
+    """ Hash of the sources of local_modules of all objs, e.g. for caches outside a Pipeline
+    """
+    modules = {m.__name__: m for obj in objs for m in local_modules(obj, directory)}
+    h = hashlib.sha1()
+    for name in sorted(modules):
+        h.update(name.encode())
+        h.update(source_of(modules[name]).encode())
+    return h.hexdigest()[:16]
+
+
+def fingerprint(value) -> str:
+    return hashlib.sha1(pickle.dumps(value, protocol=4)).hexdigest()
+
+
+def file_digest(fname: str) -> str:
+    if not os.path.exists(fname):
+        return None
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Pipeline():
+    def __init__(self, cache_dir: str = "cache", **params):
+        """ params: default values of the parameters, run(**params) overrides them
+        """
+        self.cache_dir = cache_dir
+        self.params = params
+        self.stages = {}
+        self.executed = []       # stages run by the last run(), the rest came from the cache
+        self._memory = {}        # key -> cache entry, shared by the runs of a sweep
+        self._sources = {}
+
+    def add(self, name: str, fn, inputs=(), params=(), code=(), cache: bool = True, files: bool = False):
+        """ Declares a stage, its inputs have to be declared before
+        """
+        for i in inputs:
+            assert i in self.stages, f"Stage {name}: unknown input stage {i}"
+        self.stages[name] = Stage(name, fn, tuple(inputs), tuple(params), tuple(code), cache, files)
+        return fn
+
+    def stage(self, name: str = None, inputs=(), params=(), code=(), cache: bool = True, files: bool = False):
+        """ Decorator version of add
+        """
+        def decorator(fn):
+            return self.add(name or fn.__name__, fn, inputs, params, code, cache, files)
+        return decorator
+
+    def _source(self, obj) -> str:
+        if obj not in self._sources:
+            self._sources[obj] = source_of(obj)
+        return self._sources[obj]
+
+    def _code_key(self, stage: Stage) -> str:
+        if stage not in self._sources:
+            # The module of the stage function only counts with the objects listed from it
+            own = inspect.getmodule(stage.fn)
+            outside = [obj for obj in (*referenced_globals(stage.fn), *stage.code) if inspect.getmodule(obj) is not own]
+            self._sources[stage] = code_fingerprint(outside, _directory(stage.fn)) + \
+                "".join(self._source(obj) for obj in stage.code if inspect.getmodule(obj) is own)
+        return self._sources[stage]
+
+    def keys(self, params: dict) -> dict:
+        """ Cache key of every stage for the given parameter values
+        """
+        keys = {}
+        for name, stage in self.stages.items():
+            # Stages missing a parameter have no key and fail only if they are needed
+            missing = [p for p in stage.params if p not in params] + [i for i in stage.inputs if keys[i] is None]
+            if missing:
+                keys[name] = None
+                continue
+            h = hashlib.sha1(name.encode())
+            h.update(self._source(stage.fn).encode())
+            h.update(self._code_key(stage).encode())
+            for p in stage.params:
+                h.update(p.encode())
+                h.update(fingerprint(params[p]).encode())
+            for i in stage.inputs:
+                h.update(keys[i].encode())
+            keys[name] = h.hexdigest()[:16]
+        return keys
+
+    def _file(self, name: str, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{name}-{key}.pkl")
+
+    @staticmethod
+    def _entry(stage: Stage, output) -> dict:
+        files = {f: file_digest(f) for f in output} if stage.files else {}
+        return {"output": output, "files": files}
+
+    @staticmethod
+    def _valid(entry: dict) -> bool:
+        return all(file_digest(f) == digest for f, digest in entry["files"].items())
+
+    def _get(self, name: str, keys: dict, params: dict, outputs: dict):
+        if name in outputs:
+            return outputs[name]
+        stage = self.stages[name]
+        key = keys[name]
+        if key is None:
+            missing = [p for p in stage.params if p not in params]
+            raise KeyError(f"Stage {name}: no value for the parameters {missing} (or those of its inputs)")
+        fname = self._file(name, key)
+        if stage.cache and key not in self._memory and os.path.exists(fname):
+            with open(fname, "rb") as f:
+                self._memory[key] = pickle.load(f)
+        if stage.cache and key in self._memory and self._valid(self._memory[key]):
+            outputs[name] = self._memory[key]["output"]
+            return outputs[name]
+
+        kwargs = {i: self._get(i, keys, params, outputs) for i in stage.inputs}
+        kwargs.update({p: params[p] for p in stage.params})
+        with tracing.span(f"stage_{name}", key=key):
+            output = stage.fn(**kwargs)
+        self.executed.append(name)
+        outputs[name] = output
+        if stage.cache:
+            self._memory[key] = entry = self._entry(stage, output)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = fname + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(entry, f, protocol=4)
+            os.replace(tmp, fname)
+        return output
+
+    def run(self, targets=None, **params) -> dict:
+        """ Outputs of the target stages (default all), only the stages they need are
+        computed or loaded
+        """
+        params = {**self.params, **params}
+        targets = list(self.stages) if targets is None else list(targets)
+        keys = self.keys(params)
+        self.executed = []
+        outputs = {}
+        return {t: self._get(t, keys, params, outputs) for t in targets}
+
+    def sweep(self, targets=None, **grid) -> list:
+        """ run for every combination of the parameter values in grid (name -> values)
+
+        Returns:
+            [(params, outputs)], the params of a run are the swept values only
+        """
+        names = list(grid)
+        results = []
+        executed = []
+        for values in itertools.product(*(grid[n] for n in names)):
+            params = dict(zip(names, values))
+            results.append((params, self.run(targets, **params)))
+            executed += self.executed
+        self.executed = executed
+        return results
@@ -5,6 +5,9 @@ from matplotlib.lines import Line2D
 import numpy as np
 
 from plot_glyph import draw_binary_glyph, TRUE_GREEN, FALSE_RED
+from adjacency import Adjacency
+from graph_layout import LayoutCache, draw_relations
+from triples import TripleStore, HEAD, TAIL
 
 # Configure matplotlib to use LaTeX
 plt.rc('text', usetex=True)
@@ -97,3 +100,83 @@ def plot_graph(entities,
     fig.savefig("../figures/graph_clf_space.pdf")
     fig.savefig("../figures/graph_clf_space.png", dpi=300)
 
+
+def plot_graph_layout(entities,
+                      train_relations,
+                      test_relations,
+                      fname: str = "graph_layout",
+                      n_clf: int = 2,
+                      max_labels: int = 50,
+                      glyph_size: float = 1.,
+                      layout_cache: LayoutCache = None):
+    """ Like plot_graph, but the entities are placed by graph_layout.force_layout, so
+    entities is a list of names (or a dict, its positions are ignored). Works for
+    thousands of entities: the edges of a relation are one LineCollection and the
+    names are only drawn for at most max_labels entities.
+    """
+    cm = 1/2.54  # centimeters in inches
+    fig, ax = plt.subplots(figsize=(16*cm, 16*cm))
+    ax.axis("off")
+    ax.set_aspect("equal")
+
+    store = TripleStore(entities)
+    train = store.encode(train_relations)
+    test = store.encode(test_relations)
+    all_triples = np.concatenate([train, test])
+    layout_cache = layout_cache or LayoutCache()
+    positions = layout_cache.layout(np.arange(store.n_entities), all_triples[:, [HEAD, TAIL]])
+
+    # The arrows stop in front of the name boxes
+    shrink = 0.
+    if store.n_entities <= max_labels:
+        for name, pos in zip(store.entities, positions):
+            draw_entity(ax, pos, name, size=8)
+        shrink = 0.08
+    else:
+        ax.scatter(positions[:, 0], positions[:, 1], s=2, color=(1., 0.8, 0.5), zorder=3)
+
+    # Legend entry per (split, relation), a relation can be in both splits
+    collections = {}
+    for split, triples, linewidth, head_length in (("test", test, 2, 0.04), ("train", train, 0.5, 0.02)):
+        for name, c in draw_relations(ax, positions, triples, store.relations, linewidth=linewidth,
+                                      head_length=head_length, shrink=shrink).items():
+            collections[split, name] = c
+
+    # Binary glyphs on the test relations
+    rng = np.random.default_rng(seed=42)
+    for (start, _, end), (*_, truth_prob) in zip(test, test_relations):
+        drawpoint = (3*positions[start] + 2*positions[end]) / 5
+        glyph_values = rng.choice([True, False], (1+n_clf,), p=[truth_prob, 1-truth_prob])
+        draw_binary_glyph(ax, *drawpoint, eps_set=glyph_values[1:1+n_clf], h0=glyph_values[0], ground_truth=True,
+                          size=glyph_size)
+
+    legend_elements = [Line2D([0], [0], color=c.get_color()[0], linewidth=c.get_linewidth()[0],
+                              label=f"{name.capitalize()} ({split})")
+                       for (split, name), c in collections.items()]
+    ax.legend(handles=legend_elements, loc="best", frameon=True)
+    ax.margins(0.1)
+    ax.autoscale_view()
+
+    plt.tight_layout()
+    fig.savefig(f"../figures/graphs/{fname}.png", dpi=300)
+    # Called once per query context, the figures are not kept open
+    plt.close(fig)
+
+
+def plot_query_context(store: TripleStore,
+                       adjacency: Adjacency,
+                       anchor: str,
+                       test_relations=(),
+                       k: int = 2,
+                       max_degree: int = None,
+                       fname: str = "query_context",
+                       **kwargs):
+    """ plot_graph_layout of the k-hop neighbourhood of an entity, e.g. the anchor
+    of a query the models disagree on. Only the test relations inside it are drawn.
+    """
+    context = adjacency.context([store.entity_to_id[anchor]], k, max_degree=max_degree)
+    nodes, _, triples = context[0]
+    names = [store.entities[i] for i in nodes]
+    inside = set(names)
+    test_relations = [t for t in test_relations if t[0] in inside and t[2] in inside]
+    plot_graph_layout(names, store.decode(triples), test_relations, fname=fname, **kwargs)
@@ -0,0 +1,145 @@
+# Reduced precision storage for score tensors and embeddings
+#
+# "float16": plain half precision
+# "int8":    per row (last axis) affine quantization x ~ (code + 127) * scale + offset
+#            with codes in [-127, 127], i.e. 1 byte per value plus 8 bytes per row.
+#            The range of a row is taken over its finite values, non-finite values
+#            (e.g. the -inf of filtered or pruned entities) get the code -128, which
+#            dequantizes to -inf.
+#
+# The quantization is monotone within a row, so ranks, Borda and Majority votes
+# can be computed on the codes directly and Range voting (min-max rescaling per
+# row) is invariant to it as well.
+
+import numpy as np
+
+from ranking import filtered_ranks
+
+
+MODES = ("float32", "float16", "int8")
+# Rows of the codes converted to float32 at a time in matmul_T
+MATMUL_BLOCK = 4096
+# int8 code of the non-finite values
+NONFINITE_CODE = -128
+
+
+class QuantizedArray():
+    def __init__(self, codes: np.ndarray, mode: str, scale: np.ndarray = None, offset: np.ndarray = None):
+        self.codes = codes
+        self.mode = mode
+        self.scale = scale      # (*shape[:-1], 1) float32, only int8
+        self.offset = offset    # (*shape[:-1], 1) float32, only int8
+
+    @classmethod
+    def quantize(cls, x: np.ndarray, mode: str = "int8") -> "QuantizedArray":
+        assert mode in MODES, f"Unknown mode {mode}, use one of {MODES}"
+        if mode != "int8":
+            return cls(np.asarray(x, dtype=mode), mode)
+
+        x = np.asarray(x, dtype=np.float32)
+        finite = np.isfinite(x)
+        lo = np.where(finite, x, np.inf).min(axis=-1, keepdims=True)
+        hi = np.where(finite, x, -np.inf).max(axis=-1, keepdims=True)
+        # Rows without a finite value
+        lo, hi = np.where(np.isfinite(lo), lo, 0.), np.where(np.isfinite(hi), hi, 0.)
+        scale = np.where(hi > lo, (hi - lo) / 254, 1.).astype(np.float32)
+        codes = (np.rint((np.where(finite, x, lo) - lo) / scale) - 127).astype(np.int8)
+        codes[~finite] = NONFINITE_CODE
+        return cls(codes, mode, scale, lo.astype(np.float32))
+
+    @property
+    def shape(self) -> tuple:
+        return self.codes.shape
+
+    @property
+    def nbytes(self) -> int:
+        extra = 0 if self.scale is None else self.scale.nbytes + self.offset.nbytes
+        return self.codes.nbytes + extra
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, idx) -> "QuantizedArray":
+        """ Slicing along the leading axes, the last axis stays complete
+        """
+        if self.scale is None:
+            return QuantizedArray(self.codes[idx], self.mode)
+        return QuantizedArray(self.codes[idx], self.mode, self.scale[idx], self.offset[idx])
+
+    def dequantize(self) -> np.ndarray:
+        if self.mode != "int8":
+            return self.codes.astype(np.float32)
+        values = (self.codes.astype(np.float32) + 127) * self.scale + self.offset
+        values[self.codes == NONFINITE_CODE] = -np.inf
+        return values
+
+    def matmul_T(self, query_vectors: np.ndarray) -> np.ndarray:
+        """ query_vectors @ dequantize().T without materializing the float rows
+
+        For embeddings (n_entities, dim): q . e_j = scale_j * (q . codes_j + 127 sum(q)) + offset_j * sum(q)
+        Only MATMUL_BLOCK rows of the codes are converted to float32 at a time.
+        """
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        n_rows = len(self.codes)
+        result = np.empty((*query_vectors.shape[:-1], n_rows), dtype=np.float32)
+        q_sum = query_vectors.sum(axis=-1, keepdims=True)
+        for start in range(0, n_rows, MATMUL_BLOCK):
+            stop = min(start + MATMUL_BLOCK, n_rows)
+            dots = query_vectors @ self.codes[start:stop].T.astype(np.float32)
+            if self.mode == "int8":
+                dots += 127 * q_sum
+                dots *= self.scale[start:stop, 0]
+                dots += q_sum * self.offset[start:stop, 0]
+            result[..., start:stop] = dots
+        return result
+
+
+def quantize(x: np.ndarray, mode: str = "int8") -> QuantizedArray:
+    return QuantizedArray.quantize(x, mode)
+
+
+def rank_change_report(scores,
+                       targets: np.ndarray,
+                       modes=("float16", "int8"),
+                       chunk_size: int = 1024,
+                       **rank_kwargs) -> list:
+    """ How many target ranks change if the scores are stored quantized
+
+    Input:
+        scores.shape = (n_models, n_queries, n_entities), compared against float32,
+        an array, memmap or TensorStore, it is read one model and chunk_size queries at a time
+        rank_kwargs: passed on to filtered_ranks (queries and filter_index)
+    Returns:
+        one dict per mode with the number of changed ranks, the largest rank
+        difference and the memory of the score tensor
+    """
+    targets = np.asarray(targets)
+    n_models, n_queries, n_entities = scores.shape
+    changed, max_diff, nbytes = np.zeros(len(modes), dtype=np.int64), np.zeros(len(modes)), np.zeros(len(modes))
+    for m in range(n_models):
+        for start in range(0, n_queries, chunk_size):
+            stop = min(start + chunk_size, n_queries)
+            chunk = np.asarray(scores[m, start:stop], dtype=np.float32)
+            kwargs = {key: value[start:stop] if isinstance(value, np.ndarray) else value
+                      for key, value in rank_kwargs.items()}
+            ref_ranks = filtered_ranks(chunk, targets[start:stop], **kwargs)
+            for i, mode in enumerate(modes):
+                q = quantize(chunk, mode)
+                # Ranks straight from the codes, they are monotone within a row
+                diff = np.abs(filtered_ranks(q.codes, targets[start:stop], **kwargs) - ref_ranks)
+                changed[i] += (diff > 0).sum()
+                max_diff[i] = max(max_diff[i], diff.max(initial=0.))
+                nbytes[i] += q.nbytes
+    report = [{"mode": "float32", "changed": 0, "max_diff": 0., "nbytes": 4 * n_models * n_queries * n_entities}]
+    for i, mode in enumerate(modes):
+        report.append({"mode": mode, "changed": int(changed[i]), "max_diff": float(max_diff[i]),
+                       "nbytes": int(nbytes[i])})
+    return report
+
+
+def format_rank_change_report(report: list, n_ranks: int) -> str:
+    lines = [f"{'mode':<9}{'changed ranks':>15}{'max diff':>10}{'MiB':>10}"]
+    for row in report:
+        lines.append(f"{row['mode']:<9}{row['changed']:>8} / {n_ranks:<5}{row['max_diff']:>10.1f}"
+                     f"{row['nbytes'] / 2**20:>10.3f}")
+    return "\n".join(lines)
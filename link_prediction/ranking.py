@@ -0,0 +1,75 @@
+# Rank engine for link prediction
+#
+# Computes the rank of the target entity of every query, chunk by chunk,
+# optionally filtered by a FilterIndex (all other known answers are ignored).
+
+import numpy as np
+
+from candidates import CandidateSets
+from filter_index import FilterIndex
+import tracing
+
+
+def ranks_of_targets(scores: np.ndarray, targets: np.ndarray, ties: str = "realistic") -> np.ndarray:
+    """ Rank (starting at 1) of the target in every row
+
+    Input:
+        scores.shape = (n_queries, n_entities), higher is better
+        ties: "optimistic", "pessimistic" or "realistic" (mean of both)
+    """
+    target_scores = scores[np.arange(len(scores)), targets][:, None]
+    greater = (scores > target_scores).sum(axis=-1)
+    if ties == "optimistic":
+        return 1. + greater
+    equal = (scores == target_scores).sum(axis=-1) - 1
+    if ties == "pessimistic":
+        return 1. + greater + equal
+    return 1. + greater + equal / 2
+
+
+def filtered_ranks(scores,
+                   targets: np.ndarray,
+                   relations: np.ndarray = None,
+                   anchors: np.ndarray = None,
+                   head_is_missing: np.ndarray = None,
+                   filter_index: FilterIndex = None,
+                   chunk_size: int = 1024,
+                   ties: str = "realistic",
+                   candidates: CandidateSets = None) -> np.ndarray:
+    """ Ranks of the targets, all known answers except the target are filtered
+
+    Input:
+        scores: (n_queries, n_entities) array (or memmap), or a function
+                scores(start, stop) returning the scores of these queries
+        relations, anchors, head_is_missing: encoded queries (see TripleStore.encode_queries),
+                only needed with a filter_index or candidates
+        candidates: the entities pruned by the domain / range of the relation score -inf
+    """
+    targets = np.asarray(targets)
+    n_queries = len(targets)
+    ranks = np.zeros(n_queries)
+    with tracing.span("rank", n_queries=n_queries, filtered=filter_index is not None):
+        for start in range(0, n_queries, chunk_size):
+            stop = min(start + chunk_size, n_queries)
+            if callable(scores):
+                chunk = np.array(scores(start, stop))
+            else:
+                chunk = np.array(scores[start:stop])
+            if (filter_index is not None or candidates is not None) and \
+                    not np.issubdtype(chunk.dtype, np.floating):
+                chunk = chunk.astype(np.float32)
+            if candidates is not None:
+                candidates.apply(chunk, relations[start:stop], head_is_missing[start:stop])
+            if filter_index is not None:
+                filter_index.apply(chunk, relations[start:stop], anchors[start:stop],
+                                   head_is_missing[start:stop], targets=targets[start:stop])
+            ranks[start:stop] = ranks_of_targets(chunk, targets[start:stop], ties=ties)
+    return ranks
+
+
+def hits_at_k(ranks: np.ndarray, k: int) -> float:
+    return float(np.mean(ranks <= k))
+
+
+def mean_reciprocal_rank(ranks: np.ndarray) -> float:
+    return float(np.mean(1. / ranks))
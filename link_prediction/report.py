@@ -0,0 +1,217 @@
+# Streaming report of the rankings per query
+#
+# Writes a LaTeX table per query, a CSV with one line per (query, column, rank)
+# and a .npz with the ranked entity indices, all from a single pass over the queries.
+# The scores are read one chunk of queries at a time.
+
+import csv
+import zipfile
+from io import BytesIO
+from typing import Iterable
+
+import numpy as np
+
+from query import Query
+from quantize import QuantizedArray, quantize
+import tracing
+
+
+# Shorten the name of the entities for the table
+SHRINK_NAMES = {"Curiosity Rover": "Rover",
+                "Jupiter": "Jup."}
+
+
+def latex_query(query: Query) -> str:
+    """ (?, orbits, Sun) -> $\\langle ?, \\text{orbits}, \\text{Sun} \\rangle$
+    """
+    if query.head_is_missing:
+        head, tail = "?", r"\text{" + query.value + "}"
+    else:
+        head, tail = r"\text{" + query.value + "}", "?"
+    return r"$q=\langle " + head + r", \text{" + query.relation + "}, " + tail + r" \rangle$"
+
+
+class _NpyStream():
+    """ Writes the rows of a (n_rows, *row_shape) array into a .npy entry of a zip archive
+    """
+    def __init__(self, zf: zipfile.ZipFile, name: str, n_rows: int, row_shape: tuple, dtype):
+        self.dtype = np.dtype(dtype)
+        self.n_rows = n_rows
+        self.row_shape = tuple(row_shape)
+        self.rows_written = 0
+        self.fh = zf.open(name + ".npy", "w", force_zip64=True)
+        header = {"descr": np.lib.format.dtype_to_descr(self.dtype),
+                  "fortran_order": False,
+                  "shape": (n_rows,) + self.row_shape}
+        np.lib.format.write_array_header_1_0(self.fh, header)
+
+    def write(self, row: np.ndarray):
+        assert row.shape == self.row_shape
+        self.fh.write(np.ascontiguousarray(row, dtype=self.dtype).tobytes())
+        self.rows_written += 1
+
+    def close(self):
+        assert self.rows_written == self.n_rows, \
+            f"Announced {self.n_rows} queries but wrote {self.rows_written}"
+        self.fh.close()
+
+
+class ReportWriter():
+    def __init__(self, entities: Iterable[str],
+                 column_names: Iterable[str],
+                 n_models: int,
+                 k: int = 4,
+                 n_rows: int = None,
+                 latex_file=None,
+                 csv_file=None,
+                 npz_file: str = None,
+                 n_queries: int = None,
+                 shrink_names: dict = SHRINK_NAMES):
+        """ Streams the rankings of every query to the given outputs
+
+        Input:
+            entities: names of the entities, the caller's list is not modified
+            column_names: one per column, the first n_models are models h_i,
+                          the rest voting methods
+            k: a double line is drawn after rank k
+            n_rows: number of ranks written per query (default all entities)
+            latex_file, csv_file: open text file handles (or None)
+            npz_file: path of the .npz with the ranked indices (needs n_queries)
+        """
+        self.entities = [shrink_names.get(e, e) for e in entities]
+        self.column_names = list(column_names)
+        self.n_models = n_models
+        self.n_cols = len(self.column_names)
+        self.k = k
+        self.n_rows = len(self.entities) if n_rows is None else min(n_rows, len(self.entities))
+        self.latex_file = latex_file
+        self.csv = csv.writer(csv_file) if csv_file is not None else None
+        self._zip = None
+
+        if self.csv is not None:
+            self.csv.writerow(["query", "entity_of_interest", "column", "rank", "entity", "value"])
+        if npz_file is not None:
+            assert n_queries is not None, "The .npz header needs the number of queries"
+            self._zip = zipfile.ZipFile(npz_file, "w", compression=zipfile.ZIP_STORED)
+            self._ranking = _NpyStream(self._zip, "ranking", n_queries,
+                                       (self.n_cols, self.n_rows), np.int32)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _ranking_of(self, scores: np.ndarray) -> np.ndarray:
+        """ Indices of the n_rows best entities per column, best first
+        """
+        if self.n_rows < scores.shape[-1]:
+            top = np.argpartition(-scores, self.n_rows - 1, axis=-1)[:, :self.n_rows]
+            order = np.argsort(-np.take_along_axis(scores, top, axis=-1), axis=-1, kind="stable")
+            return np.take_along_axis(top, order, axis=-1)
+        return np.argsort(-scores, axis=-1, kind="stable")
+
+    def write_query(self, query: Query, entity_of_interest: str, scores: np.ndarray):
+        """ Writes all outputs for a single query
+
+        Input:
+            scores.shape = (n_cols, n_entities)
+            unsorted float values of the models and the voting methods for the query
+        """
+        assert scores.shape == (self.n_cols, len(self.entities))
+        ranking_idz = self._ranking_of(scores)
+        values = np.take_along_axis(scores, ranking_idz, axis=-1)
+
+        if self.latex_file is not None:
+            self._write_latex(query, entity_of_interest, ranking_idz, values)
+        if self.csv is not None:
+            for i_col, name in enumerate(self.column_names):
+                self.csv.writerows([str(query), entity_of_interest, name, i_rank + 1,
+                                    self.entities[idx], f"{val:.6g}"]
+                                   for i_rank, (idx, val) in enumerate(zip(ranking_idz[i_col], values[i_col])))
+        if self._zip is not None:
+            self._ranking.write(ranking_idz)
+
+    def _write_latex(self, query, entity_of_interest, ranking_idz, values):
+        n_voting = self.n_cols - self.n_models
+        lines = ["\\begin{table} ",
+                 "\\centering ",
+                 "\\begin{tabular}{" + "r|"*self.n_cols + "r}",
+                 # Super-Header
+                 f"&\\multicolumn{{{self.n_models}}}" + "{|c|}{Models}&",
+                 f"\\multicolumn{{{n_voting}}}" + "{|c}{Voting Methods using Models $h_i$}" + r"\\",
+                 " \\hline "]
+        # Header
+        header = [f"$h_{i_col}(q, e)$" if i_col < self.n_models else self.column_names[i_col]
+                  for i_col in range(self.n_cols)]
+        lines.append("Rank &" + " &".join(header) + r"\\")
+        lines.append("\\hline")
+        self.latex_file.write("\n".join(lines) + "\n")
+
+        # Data
+        for i_rank in range(self.n_rows):
+            cells = [f"{self.entities[ranking_idz[i_col, i_rank]]} ({values[i_col, i_rank]:.1f})"
+                     for i_col in range(self.n_cols)]
+            self.latex_file.write(f"{i_rank+1} &" + "&\t\t".join(cells) + r"\\" + "\n")
+            if i_rank == self.k-1:
+                self.latex_file.write(r"\hline \hline" + "\n")
+
+        self.latex_file.write(r"\end{tabular}" + "\n")
+        self.latex_file.write(r"\caption{Sorted values of $h_i(tr(q,e))$ with " + latex_query(query)
+                              + " where we want to predict " + entity_of_interest + r"}" + "\n")
+        self.latex_file.write(r"\end{table}" + "\n")
+
+    def close(self):
+        if self._zip is not None:
+            self._ranking.close()
+            # Small metadata to decode the indices
+            for name, arr in [("entities", np.array(self.entities)),
+                              ("columns", np.array(self.column_names))]:
+                buf = BytesIO()
+                np.save(buf, arr)
+                self._zip.writestr(name + ".npy", buf.getvalue())
+            self._zip.close()
+            self._zip = None
+
+
+def write_report(queries: Iterable[Query],
+                 entities_of_interest: Iterable[str],
+                 entities: Iterable[str],
+                 model_preds: np.ndarray,
+                 voting_methods,
+                 k: int = 4,
+                 n_rows: int = None,
+                 latex_file=None,
+                 csv_file=None,
+                 npz_file: str = None,
+                 precision: str = "float32",
+                 query_chunk: int = 1024):
+    """ Writes the report for all queries
+
+    Input:
+        model_preds.shape = (n_models, n_queries, n_entities)
+        can be a memmap, a TensorStore or a QuantizedArray, it is read query_chunk
+        queries at a time (one read per model and chunk).
+        precision: the chunks are quantized to it (per row, so the same as quantizing
+        all at once). The votes of a QuantizedArray are taken on its codes (monotone
+        per row, see quantize.py), the table shows the dequantized values of the models.
+    """
+    n_models = model_preds.shape[0]
+    column_names = [f"h_{i}" for i in range(n_models)] + [str(v) for v in voting_methods]
+    with ReportWriter(entities, column_names, n_models, k=k, n_rows=n_rows,
+                      latex_file=latex_file, csv_file=csv_file,
+                      npz_file=npz_file, n_queries=len(queries)) as writer:
+        for start in range(0, len(queries), query_chunk):
+            chunk = model_preds[:, start:start + query_chunk]
+            if precision != "float32" and not isinstance(chunk, QuantizedArray):
+                chunk = quantize(chunk, precision)
+            if isinstance(chunk, QuantizedArray):
+                codes, preds = chunk.codes, chunk.dequantize()
+            else:
+                codes = preds = np.asarray(chunk)
+            for j in range(preds.shape[1]):
+                with tracing.span("vote", n_methods=len(voting_methods)):
+                    voting_vals = [voting_method(codes[:, j]) for voting_method in voting_methods]
+                writer.write_query(queries[start + j], entities_of_interest[start + j],
+                                   np.vstack([preds[:, j], *voting_vals]))
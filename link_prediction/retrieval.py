@@ -0,0 +1,161 @@
+# Approximate top-k retrieval for inner product scoring (DistMult / ComplEx style)
+#
+# IVF index: the entity embeddings are clustered with k-means and stored list by list.
+# A query only scores the entities of the n_probe closest lists and re-ranks this
+# shortlist exactly. n_probe is the recall vs. latency knob.
+#
+# Maximum inner product search is reduced to nearest neighbour search by appending
+# sqrt(max_norm^2 - |e|^2) to every entity embedding (and 0 to the query).
+#
+# Run `python retrieval.py` for a benchmark against exhaustive scoring.
+
+import time
+
+import numpy as np
+
+
+def _nearest_centroid(X: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    c_norms = np.sum(centroids**2, axis=-1)
+    assignment = np.zeros(len(X), dtype=np.int32)
+    for start in range(0, len(X), chunk_size):
+        chunk = X[start:start + chunk_size]
+        # argmin |x - c|^2 = argmin |c|^2 - 2 x.c
+        assignment[start:start + chunk_size] = np.argmin(c_norms - 2 * chunk @ centroids.T, axis=-1)
+    return assignment
+
+
+def kmeans(X: np.ndarray, n_clusters: int, n_iter: int = 10, sample_size: int = 65536,
+           seed=None) -> np.ndarray:
+    """ Lloyd's algorithm on a random sample of X, returns the centroids
+    """
+    rng = np.random.default_rng(seed)
+    if len(X) > sample_size:
+        X = X[rng.choice(len(X), sample_size, replace=False)]
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = _nearest_centroid(X, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, X)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Restart empty clusters at random points
+        centroids[empty] = X[rng.choice(len(X), empty.sum(), replace=False)]
+    return centroids
+
+
+def exhaustive_top_k(query_vectors: np.ndarray, embeddings: np.ndarray, k: int,
+                     chunk_size: int = 65536) -> tuple:
+    """ Exact top-k by inner product, returns (ids, scores) of shape (n_queries, k)
+
+    embeddings can also be a QuantizedArray (see quantize.py)
+    """
+    best_ids = np.zeros((len(query_vectors), 0), dtype=np.int64)
+    best_scores = np.zeros((len(query_vectors), 0), dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        rows = embeddings[start:start + chunk_size]
+        scores = rows.matmul_T(query_vectors) if hasattr(rows, "matmul_T") else query_vectors @ rows.T
+        ids = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, ids], axis=1)
+        kk = min(k, scores.shape[1])
+        top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_ids, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+class IVFIndex():
+    def __init__(self, embeddings: np.ndarray, n_lists: int = None, n_iter: int = 10,
+                 sample_size: int = 65536, seed=None):
+        """ Builds the inverted file index over the rows of embeddings (n_entities, dim)
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        n_entities = len(embeddings)
+        n_lists = n_lists or max(1, int(np.sqrt(n_entities)))
+
+        # MIPS -> nearest neighbour
+        norms2 = np.sum(embeddings**2, axis=-1)
+        augmented = np.hstack([embeddings, np.sqrt(norms2.max() - norms2)[:, None]])
+
+        centroids = kmeans(augmented, n_lists, n_iter=n_iter, sample_size=sample_size, seed=seed)
+        assignment = _nearest_centroid(augmented, centroids)
+
+        # Lists in CSR format, the vectors of a list are contiguous in memory
+        order = np.argsort(assignment, kind="stable")
+        self.list_indptr = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        self.list_ids = order.astype(np.int32)
+        self.list_vectors = embeddings[order]
+        self.centroids = centroids
+        self.n_lists = n_lists
+
+    def _probe(self, query_vectors: np.ndarray, n_probe: int) -> np.ndarray:
+        # Nearest centroids of the augmented query (q, 0)
+        dist = np.sum(self.centroids**2, axis=-1) - 2 * query_vectors @ self.centroids[:, :-1].T
+        n_probe = min(n_probe, self.n_lists)
+        return np.argpartition(dist, n_probe - 1, axis=-1)[:, :n_probe]
+
+    def search(self, query_vectors: np.ndarray, k: int = 10, n_probe: int = 8) -> tuple:
+        """ Approximate top-k, returns (ids, scores) of shape (n_queries, k)
+
+        Queries with less than k candidates in their lists are padded with id -1 and score -inf.
+        """
+        query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        probes = self._probe(query_vectors, n_probe)
+        ids = np.full((len(query_vectors), k), -1, dtype=np.int64)
+        scores = np.full((len(query_vectors), k), -np.inf, dtype=np.float32)
+        for i, q in enumerate(query_vectors):
+            rows = np.concatenate([np.arange(self.list_indptr[l], self.list_indptr[l+1]) for l in probes[i]])
+            # Exact re-ranking of the shortlist
+            candidate_scores = self.list_vectors[rows] @ q
+            kk = min(k, len(rows))
+            if kk == 0:
+                continue
+            top = np.argpartition(-candidate_scores, kk - 1)[:kk]
+            top = top[np.argsort(-candidate_scores[top])]
+            ids[i, :kk] = self.list_ids[rows[top]]
+            scores[i, :kk] = candidate_scores[top]
+        return ids, scores
+
+
+def recall_at_k(approx_ids: np.ndarray, exact_ids: np.ndarray) -> float:
+    hits = [len(np.intersect1d(a, e)) for a, e in zip(approx_ids, exact_ids)]
+    return float(np.sum(hits) / exact_ids.size)
+
+
+def benchmark(n_entities: int = 10**6, dim: int = 32, n_queries: int = 100, k: int = 10,
+              n_probes=(1, 2, 4, 8, 16, 32), n_types: int = 200, seed=0):
+    """ Recall and latency of the IVF index against exhaustive scoring
+
+    The entity embeddings are drawn around n_types type centers, as entities
+    of the same type end up close in the embedding space.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 1, (n_types, dim)).astype(np.float32)
+    embeddings = centers[rng.integers(0, n_types, n_entities)] + \
+                 0.5 * rng.normal(0, 1, (n_entities, dim)).astype(np.float32)
+    query_vectors = embeddings[rng.integers(0, n_entities, n_queries)] * \
+                    rng.normal(1, 0.2, (n_queries, dim)).astype(np.float32)
+
+    t = time.perf_counter()
+    index = IVFIndex(embeddings, seed=seed)
+    print(f"Build: {time.perf_counter() - t:.1f} s for {n_entities} entities, {index.n_lists} lists")
+
+    t = time.perf_counter()
+    exact_ids, _ = exhaustive_top_k(query_vectors, embeddings, k)
+    exact_ms = (time.perf_counter() - t) * 1e3 / n_queries
+    print(f"Exhaustive: {exact_ms:.2f} ms/query")
+
+    results = []
+    for n_probe in n_probes:
+        t = time.perf_counter()
+        ids, _ = index.search(query_vectors, k=k, n_probe=n_probe)
+        ms = (time.perf_counter() - t) * 1e3 / n_queries
+        results.append({"n_probe": n_probe, "recall": recall_at_k(ids, exact_ids), "ms_per_query": ms})
+        print(f"n_probe={n_probe:>3}: recall@{k} = {results[-1]['recall']:.3f}, {ms:.2f} ms/query")
+    return results
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,272 @@
+# Local query service for the ensemble (h0 and the epsilon set)
+#
+# Protocol: one JSON object per line over TCP or a Unix socket
+#     -> {"anchor": "Sun", "relation": "orbits", "head_is_missing": true, "k": 5}
+#     <- {"query": "(?, orbits, Sun)", "ranking": [...], "scores": [...],
+#         "multiplicity": {"rank_spread": ..., "top_k_flip": ...}, "latency_ms": ...}
+#     -> {"stats": true}
+#     <- {"requests": ..., "batches": ..., "mean_batch_size": ..., "p50_ms": ..., "p99_ms": ...}
+#
+# Concurrent requests arriving within `window` seconds are coalesced into one
+# micro-batch, which is scored once by every model of the ensemble. Every request
+# is checked (known anchor and relation, k > 0) before it joins a batch, a bad
+# request only fails itself. The answer to a request does not depend on the
+# requests it is batched with: the multiplicity is computed with its own k.
+#
+# Example:
+#     python service.py --triples train.tsv --n-models 5 --port 8765
+#     echo '{"anchor": "Sun", "relation": "orbits", "head_is_missing": true}' | nc localhost 8765
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+
+import numpy as np
+
+from filter_index import FilterIndex
+from query import Query
+from triples import TripleStore
+from voting_methods import Borda
+
+
+def multiplicity(scores: np.ndarray, voted: np.ndarray, k: int) -> tuple:
+    """ Per-query disagreement within the ensemble
+
+    Input:
+        scores.shape = (n_models, n_queries, n_entities), model 0 is h0
+        voted.shape = (n_queries, n_entities) the voted scores
+    Returns:
+        rank_spread: (n_queries,) max - min rank of the voted winner over the models
+        top_k_flip: (n_queries,) fraction of the epsilon set whose top-k differs from h0's
+    """
+    n_models, n_queries, _ = scores.shape
+    winner = np.argmax(voted, axis=-1)
+    winner_scores = scores[:, np.arange(n_queries), winner][..., None]
+    winner_ranks = 1 + (scores > winner_scores).sum(axis=-1)
+    rank_spread = winner_ranks.max(axis=0) - winner_ranks.min(axis=0)
+
+    top_k = np.sort(np.argpartition(-scores, k - 1, axis=-1)[..., :k], axis=-1)
+    if n_models > 1:
+        top_k_flip = np.any(top_k[1:] != top_k[:1], axis=-1).mean(axis=0)
+    else:
+        top_k_flip = np.zeros(n_queries)
+    return rank_spread, top_k_flip
+
+
+class MicroBatcher():
+    def __init__(self, process_batch, window: float = 0.002, max_batch: int = 256):
+        """ Collects submitted items and hands them to process_batch(items) -> results
+
+        process_batch runs in a thread, so the event loop keeps accepting requests
+        """
+        self.process_batch = process_batch
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        self._tasks = set()     # running batches, the loop only keeps weak references
+        self.n_batches = 0
+        self.n_items = 0
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        items = [item for item, _ in batch]
+        self.n_batches += 1
+        self.n_items += len(items)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(None, self.process_batch, items)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        # A request whose client is gone (cancelled future) does not hold up the others
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class QueryService():
+    def __init__(self, score_fn,
+                 store: TripleStore,
+                 voting_method=None,
+                 filter_index: FilterIndex = None,
+                 window: float = 0.002,
+                 max_batch: int = 256,
+                 max_k: int = 100):
+        """ Answers (anchor, relation, ?) queries with the voted ranking of the ensemble
+
+        Input:
+            score_fn(relations, anchors, head_is_missing) -> (n_models, n_queries, n_entities)
+                model 0 is h0, the others the epsilon set
+            filter_index: known answers, excluded from the ranking
+        """
+        self.score_fn = score_fn
+        self.store = store
+        self.voting_method = voting_method or Borda()
+        self.filter_index = filter_index
+        self.max_k = max_k
+        self.batcher = MicroBatcher(self._process_batch, window=window, max_batch=max_batch)
+        self.latencies = deque(maxlen=100000)
+
+    def parse(self, request: dict) -> tuple:
+        """ (query, relation id, anchor id, k) of a request, ValueError if it can not be answered
+
+        Only looks up the store, serving never changes it
+        """
+        query = Query(request["anchor"], request["relation"], bool(request.get("head_is_missing", False)))
+        if query.relation not in self.store.relation_to_id:
+            raise ValueError(f"Unknown relation {query.relation!r}")
+        if query.value not in self.store.entity_to_id:
+            raise ValueError(f"Unknown entity {query.value!r}")
+        k = int(request.get("k", 10))
+        if k <= 0:
+            raise ValueError(f"k has to be positive, got {k}")
+        k = min(k, self.max_k, self.store.n_entities)
+        return query, self.store.relation_to_id[query.relation], self.store.entity_to_id[query.value], k
+
+    def _process_batch(self, requests: list) -> list:
+        """ requests: parsed requests, see parse
+        """
+        queries = [query for query, _, _, _ in requests]
+        relations = np.array([r for _, r, _, _ in requests], dtype=np.int32)
+        anchors = np.array([a for _, _, a, _ in requests], dtype=np.int32)
+        head_is_missing = np.array([q.head_is_missing for q in queries], dtype=bool)
+        ks = np.array([k for _, _, _, k in requests])
+        scores = np.array(self.score_fn(relations, anchors, head_is_missing), dtype=np.float64)
+        voted = self.voting_method(scores)
+        # Known answers are voted on but not ranked
+        if self.filter_index is not None:
+            for values in [*scores, voted]:
+                self.filter_index.apply(values, relations, anchors, head_is_missing)
+
+        # The requests of a batch are grouped by their k
+        rank_spread = np.zeros(len(requests), dtype=np.int64)
+        top_k_flip = np.zeros(len(requests))
+        for k in np.unique(ks):
+            rows = np.flatnonzero(ks == k)
+            rank_spread[rows], top_k_flip[rows] = multiplicity(scores[:, rows], voted[rows], int(k))
+        ranking = np.argsort(-voted, axis=-1)
+        # At most the unfiltered entities are ranked, -inf is not valid JSON
+        n_ranked = np.minimum(ks, np.isfinite(voted).sum(axis=-1))
+
+        results = []
+        for i, query in enumerate(queries):
+            idx = ranking[i, :n_ranked[i]]
+            results.append({"query": str(query),
+                            "ranking": [self.store.entities[j] for j in idx],
+                            "scores": [float(v) for v in voted[i, idx]],
+                            "multiplicity": {"rank_spread": int(rank_spread[i]),
+                                             "top_k_flip": float(top_k_flip[i])}})
+        return results
+
+    async def answer(self, request: dict) -> dict:
+        if request.get("stats"):
+            return self.stats()
+        t = time.perf_counter()
+        result = await self.batcher.submit(self.parse(request))
+        latency = (time.perf_counter() - t) * 1e3
+        self.latencies.append(latency)
+        return {**result, "latency_ms": latency}
+
+    def stats(self) -> dict:
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {"requests": self.batcher.n_items,
+                "batches": self.batcher.n_batches,
+                "mean_batch_size": self.batcher.n_items / max(self.batcher.n_batches, 1),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p99_ms": float(np.percentile(latencies, 99))}
+
+    async def _respond(self, line: bytes) -> dict:
+        try:
+            return await self.answer(json.loads(line))
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Requests of one connection are processed concurrently but answered in order
+        responses = asyncio.Queue()
+
+        async def write_responses():
+            while (task := await responses.get()) is not None:
+                writer.write(json.dumps(await task).encode() + b"\n")
+                await writer.drain()
+
+        writer_task = asyncio.ensure_future(write_responses())
+        while line := await reader.readline():
+            if line.strip():
+                await responses.put(asyncio.ensure_future(self._respond(line)))
+        await responses.put(None)
+        await writer_task
+        writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765, unix_path: str = None):
+        if unix_path:
+            server = await asyncio.start_unix_server(self._handle, path=unix_path)
+        else:
+            server = await asyncio.start_server(self._handle, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+
+def ensemble_score_fn(models: list):
+    """ score_fn for embedding models with a score(relations, anchors, head_is_missing) method
+    """
+    def score_fn(relations, anchors, head_is_missing):
+        return np.stack([m.score(relations, anchors, head_is_missing) for m in models])
+    return score_fn
+
+
+def load_triples(fname: str) -> list:
+    """ Tab separated head, relation, tail per line
+    """
+    with open(fname) as f:
+        return [tuple(line.rstrip("\n").split("\t")[:3]) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    from kge import DistMult
+
+    parser = argparse.ArgumentParser(description="Link prediction query service")
+    parser.add_argument("--triples", required=True, help="tsv file with head, relation, tail")
+    parser.add_argument("--n-models", type=int, default=5, help="h0 and n-1 epsilon set members")
+    parser.add_argument("--dim", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--window-ms", type=float, default=2.)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", default=None, help="serve on this Unix socket instead")
+    args = parser.parse_args()
+
+    triples = load_triples(args.triples)
+    entities = sorted({t[0] for t in triples} | {t[2] for t in triples})
+    store = TripleStore(entities)
+    train = store.add("train", triples)
+    models = [DistMult(store.n_entities, store.n_relations, dim=args.dim, seed=seed).fit(train, epochs=args.epochs)
+              for seed in range(args.n_models)]
+
+    service = QueryService(ensemble_score_fn(models), store,
+                           filter_index=FilterIndex.from_triples(train, store.n_entities),
+                           window=args.window_ms / 1e3)
+    asyncio.run(service.serve(host=args.host, port=args.port, unix_path=args.unix))
@@ -0,0 +1,198 @@
+# Parallel evaluation of an ensemble (h0 and the epsilon set) across processes
+#
+# The parameters of all models are published once into shared memory blocks.
+# A small manifest (block name, shape, dtype per array) is all a worker receives,
+# it attaches to the blocks without copying and scores its slice of the queries.
+# Only the compact per-query results (target ranks, top-k ids) travel back.
+# The pool of workers is started once and reused by every evaluate call, the query
+# arrays of a call are published separately and attached by the workers per call.
+#
+# Usage:
+#     with SharedEnsembleEvaluator(models, n_workers=8) as evaluator:
+#         results = evaluator.evaluate(relations, anchors, head_is_missing, targets,
+#                                      filter_index=filter_index)
+
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from filter_index import FilterIndex
+from ranking import ranks_of_targets
+
+
+def publish(arrays: dict) -> tuple:
+    """ Copies every array into its own shared memory block
+
+    Returns:
+        manifest: {key: {"name", "shape", "dtype"}}, picklable and tiny
+        blocks: the SharedMemory objects, to be closed and unlinked by the owner
+    """
+    manifest, blocks = {}, []
+    for key, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        manifest[key] = {"name": shm.name, "shape": arr.shape, "dtype": arr.dtype.str}
+        blocks.append(shm)
+    return manifest, blocks
+
+
+def _open_block(name: str) -> shared_memory.SharedMemory:
+    # The owner unlinks the block. A worker must not register it with the resource
+    # tracker, otherwise it is reported as leaked or unlinked a second time.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always registers (bpo-39959), the worker is single threaded
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def attach(manifest: dict) -> tuple:
+    """ Zero-copy views of the published arrays (and the blocks to keep them alive)
+    """
+    arrays, blocks = {}, []
+    for key, entry in manifest.items():
+        shm = _open_block(entry["name"])
+        arrays[key] = np.ndarray(entry["shape"], dtype=np.dtype(entry["dtype"]), buffer=shm.buf)
+        blocks.append(shm)
+    return arrays, blocks
+
+
+# State of a worker process, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(manifest: dict, k: int):
+    arrays, blocks = attach(manifest)
+    _worker.update(arrays=arrays, blocks=blocks, k=k, queries=None)
+
+
+def _attach_queries(manifest: dict) -> tuple:
+    # The query arrays of the current evaluate call, attached once per worker and call
+    names = tuple(entry["name"] for entry in manifest.values())
+    if _worker["queries"] is None or _worker["queries"][0] != names:
+        if _worker["queries"] is not None:
+            # The views have to be gone before the blocks can be closed
+            blocks = _worker["queries"][3]
+            _worker["queries"] = None
+            for shm in blocks:
+                shm.close()
+        arrays, blocks = attach(manifest)
+        filter_index = None
+        if "filter_keys" in arrays:
+            filter_index = FilterIndex(arrays["filter_keys"], arrays["filter_indptr"],
+                                       arrays["filter_indices"], _worker["arrays"]["entity_emb"].shape[1])
+        _worker["queries"] = (names, arrays, filter_index, blocks)
+    return _worker["queries"][1:3]
+
+
+def _evaluate_slice(task: tuple) -> tuple:
+    query_manifest, start, stop = task
+    a = _worker["arrays"]
+    k = _worker["k"]
+    q, filter_index = _attach_queries(query_manifest)
+    relations = q["relations"][start:stop]
+    anchors = q["anchors"][start:stop]
+    head_is_missing = q["head_is_missing"][start:stop]
+    targets = q["targets"][start:stop]
+
+    n_models = a["entity_emb"].shape[0]
+    ranks = np.zeros((n_models, stop - start))
+    top_k = np.zeros((n_models, stop - start, k), dtype=np.int32)
+    for m in range(n_models):
+        entity_emb = a["entity_emb"][m]
+        # DistMult scores (see kge.DistMult.score)
+        scores = (entity_emb[anchors] * a["relation_emb"][m][relations]) @ entity_emb.T
+        if filter_index is not None:
+            filter_index.apply(scores, relations, anchors, head_is_missing, targets=targets)
+        ranks[m] = ranks_of_targets(scores, targets)
+        top = np.argpartition(-scores, k - 1, axis=-1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=-1), axis=-1)
+        top_k[m] = np.take_along_axis(top, order, axis=-1)
+    return start, ranks, top_k
+
+
+class SharedEnsembleEvaluator():
+    def __init__(self, models: list, n_workers: int = None, k: int = 10):
+        """ Publishes the embeddings of the models (DistMult, same shapes) into shared memory
+
+        models[0] is taken as the baseline h0, the others as the epsilon set
+        """
+        self.n_workers = n_workers or mp.cpu_count()
+        self.n_models = len(models)
+        self.manifest, self.blocks = publish({
+            "entity_emb": np.stack([m.entity_emb for m in models]),
+            "relation_emb": np.stack([m.relation_emb for m in models])})
+        self.n_entities = self.manifest["entity_emb"]["shape"][1]
+        self.k = min(k, self.n_entities)
+        self._pool = None
+
+    @property
+    def pool(self):
+        # Started on first use, the workers attach the model blocks once
+        if self._pool is None:
+            ctx = mp.get_context("spawn")
+            self._pool = ctx.Pool(self.n_workers, initializer=_init_worker, initargs=(self.manifest, self.k))
+        return self._pool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def evaluate(self, relations: np.ndarray,
+                 anchors: np.ndarray,
+                 head_is_missing: np.ndarray,
+                 targets: np.ndarray,
+                 filter_index: FilterIndex = None,
+                 chunk_size: int = 1024) -> dict:
+        """ Scores all queries with all models, split over the worker processes
+
+        Returns:
+            ranks: (n_models, n_queries) filtered rank of the target
+            top_k: (n_models, n_queries, k) best entity ids
+        """
+        query_arrays = {"relations": np.asarray(relations, dtype=np.int32),
+                        "anchors": np.asarray(anchors, dtype=np.int32),
+                        "head_is_missing": np.asarray(head_is_missing, dtype=bool),
+                        "targets": np.asarray(targets, dtype=np.int32)}
+        if filter_index is not None:
+            # The workers only see the main CSR arrays, the caller's index keeps its delta
+            filter_index = filter_index.copy().compact()
+            query_arrays.update(filter_keys=filter_index.keys,
+                                filter_indptr=filter_index.indptr,
+                                filter_indices=filter_index.indices)
+        query_manifest, query_blocks = publish(query_arrays)
+
+        n_queries = len(targets)
+        ranks = np.zeros((self.n_models, n_queries))
+        top_k = np.zeros((self.n_models, n_queries, self.k), dtype=np.int32)
+        tasks = [(query_manifest, s, min(s + chunk_size, n_queries)) for s in range(0, n_queries, chunk_size)]
+        try:
+            for start, slice_ranks, slice_top_k in self.pool.imap_unordered(_evaluate_slice, tasks):
+                stop = start + slice_ranks.shape[1]
+                ranks[:, start:stop] = slice_ranks
+                top_k[:, start:stop] = slice_top_k
+        finally:
+            for shm in query_blocks:
+                shm.close()
+                shm.unlink()
+        return {"ranks": ranks, "top_k": top_k}
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
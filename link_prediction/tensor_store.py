@@ -0,0 +1,151 @@
+# Out-of-core store for per-model tensors, e.g. the (models, queries, entities) scores
+#
+# Layout of a store directory:
+#     index.json               shape, dtype, chunking, model names, meta data
+#     m{model}_q{chunk}.npy    the rows chunk*query_chunk ... of one model
+#
+# Every file is a plain .npy of shape (<= query_chunk, *item_shape) and is read as a
+# memmap, so readers only touch the chunks of the slice they ask for. Models are
+# appended one at a time and never have to be in memory as a whole.
+#
+# Usage:
+#     store = TensorStore.open_or_create("scores", n_queries, (n_entities,), meta={...})
+#     store.append_model(lambda start, stop: model.score(...), name="h0")
+#     chunk = store.read_slice(queries=slice(0, 1024))     # (n_models, 1024, n_entities)
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+import tracing
+
+
+class TensorStore():
+    INDEX = "index.json"
+
+    def __init__(self, path: str):
+        """ Opens an existing store, see create / open_or_create
+        """
+        self.path = path
+        with open(os.path.join(path, self.INDEX)) as f:
+            index = json.load(f)
+        self.n_queries = index["n_queries"]
+        self.item_shape = tuple(index["item_shape"])
+        self.dtype = np.dtype(index["dtype"])
+        self.query_chunk = index["query_chunk"]
+        self.models = index["models"]
+        self.meta = index["meta"]
+
+    @classmethod
+    def create(cls, path: str, n_queries: int, item_shape=(), dtype="float32",
+               query_chunk: int = 1024, meta: dict = None) -> "TensorStore":
+        """ New empty store, an existing one at path is replaced
+
+        item_shape: trailing shape per query, e.g. (n_entities,) for scores, () for ranks
+        meta: json serializable description of the content, see open_or_create
+        """
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        index = {"n_queries": n_queries, "item_shape": list(item_shape), "dtype": np.dtype(dtype).str,
+                 "query_chunk": query_chunk, "models": [], "meta": meta or {}}
+        with open(os.path.join(path, cls.INDEX), "w") as f:
+            json.dump(index, f)
+        return cls(path)
+
+    @classmethod
+    def open_or_create(cls, path: str, n_queries: int, item_shape=(), dtype="float32",
+                       query_chunk: int = 1024, meta: dict = None) -> "TensorStore":
+        """ Reuses the store at path if it holds the same kind of tensor and meta data
+        """
+        if os.path.exists(os.path.join(path, cls.INDEX)):
+            store = cls(path)
+            if store.n_queries == n_queries and store.item_shape == tuple(item_shape) and \
+                    store.dtype == np.dtype(dtype) and store.meta == json.loads(json.dumps(meta or {})):
+                return store
+        return cls.create(path, n_queries, item_shape, dtype, query_chunk, meta)
+
+    def _save_index(self):
+        index = {"n_queries": self.n_queries, "item_shape": list(self.item_shape), "dtype": self.dtype.str,
+                 "query_chunk": self.query_chunk, "models": self.models, "meta": self.meta}
+        tmp = os.path.join(self.path, self.INDEX + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(self.path, self.INDEX))
+
+    @property
+    def n_models(self) -> int:
+        return len(self.models)
+
+    @property
+    def shape(self) -> tuple:
+        return (self.n_models, self.n_queries, *self.item_shape)
+
+    @property
+    def n_chunks(self) -> int:
+        return -(-self.n_queries // self.query_chunk)
+
+    def _file(self, model: int, chunk: int) -> str:
+        return os.path.join(self.path, f"m{model}_q{chunk}.npy")
+
+    def append_model(self, values, name: str = None) -> int:
+        """ Writes the tensor of one more model, returns its index
+
+        values: array (n_queries, *item_shape) (or memmap), or a function
+                values(start, stop) returning the rows of these queries
+        """
+        m = self.n_models
+        with tracing.span("store_append", model=m, n_queries=self.n_queries):
+            for c in range(self.n_chunks):
+                start, stop = c * self.query_chunk, min((c + 1) * self.query_chunk, self.n_queries)
+                rows = values(start, stop) if callable(values) else values[start:stop]
+                out = np.lib.format.open_memmap(self._file(m, c), mode="w+", dtype=self.dtype,
+                                                shape=(stop - start, *self.item_shape))
+                out[...] = rows
+                out.flush()
+                del out
+        # The model only becomes visible once all its chunks are written
+        self.models.append(name or f"h{m}")
+        self._save_index()
+        return m
+
+    def read_chunk(self, model: int, chunk: int) -> np.ndarray:
+        """ Memmap of one chunk (read only)
+        """
+        return np.load(self._file(model, chunk), mmap_mode="r")
+
+    def read_slice(self, models=None, queries: slice = slice(None)) -> np.ndarray:
+        """ (len(models), n_selected_queries, *item_shape), only the needed chunks are read
+
+        models: int, slice or list of model indices, default all
+        queries: slice with step 1
+        """
+        model_idx = np.arange(self.n_models)[models if models is not None else slice(None)]
+        squeeze = np.ndim(model_idx) == 0
+        model_idx = np.atleast_1d(model_idx)
+        start, stop, step = queries.indices(self.n_queries)
+        assert step == 1
+        stop = max(start, stop)
+        result = np.zeros((len(model_idx), stop - start, *self.item_shape), dtype=self.dtype)
+        for c in range(start // self.query_chunk, -(-stop // self.query_chunk)):
+            c_start = c * self.query_chunk
+            lo, hi = max(start, c_start), min(stop, c_start + self.query_chunk)
+            for i, m in enumerate(model_idx):
+                result[i, lo - start:hi - start] = self.read_chunk(m, c)[lo - c_start:hi - c_start]
+        return result[0] if squeeze else result
+
+    def __getitem__(self, key) -> np.ndarray:
+        """ store[models, queries] with an int or a slice for the queries, e.g. store[:, i]
+        """
+        models, queries = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(queries, (int, np.integer)):
+            rows = self.read_slice(models, slice(queries, queries + 1))
+            return np.take(rows, 0, axis=rows.ndim - 1 - len(self.item_shape))
+        return self.read_slice(models, queries)
+
+    def values_fn(self, model: int):
+        """ values(start, stop) of one model, e.g. for ranking.filtered_ranks
+        """
+        return lambda start, stop: self.read_slice(model, slice(start, stop))
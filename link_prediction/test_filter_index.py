@@ -0,0 +1,80 @@
+import numpy as np
+
+from filter_index import FilterIndex
+
+
+def random_triples(n_triples, n_entities=40, n_relations=3, seed=0):
+    rng = np.random.default_rng(seed)
+    triples = rng.integers(0, n_entities, (n_triples, 3))
+    triples[:, 1] %= n_relations
+    return triples
+
+
+def assert_same_csr(index, reference):
+    assert index._delta is None
+    np.testing.assert_array_equal(index.keys, reference.keys)
+    np.testing.assert_array_equal(index.indptr, reference.indptr)
+    np.testing.assert_array_equal(index.indices, reference.indices)
+
+
+def test_compact_equals_rebuild():
+    triples = random_triples(400)
+    index = FilterIndex.from_triples(triples[:300], 40)
+    index.MAX_DELTA_FRACTION = 10.   # keep everything in the delta
+    for batch in np.array_split(triples[300:], 4):
+        index.insert(batch)
+    assert index._delta is not None
+    assert index.n_answers == FilterIndex.from_triples(triples, 40).n_answers
+    assert_same_csr(index.compact(), FilterIndex.from_triples(triples, 40))
+
+
+def test_automatic_compact_equals_rebuild():
+    triples = random_triples(400, seed=1)
+    index = FilterIndex.from_triples(triples[:50], 40)
+    for batch in np.array_split(triples[50:], 20):
+        index.insert(batch)
+    assert_same_csr(index.compact(), FilterIndex.from_triples(triples, 40))
+
+
+def test_gather_with_delta():
+    triples = random_triples(300, seed=2)
+    index = FilterIndex.from_triples(triples[:200], 40)
+    index.MAX_DELTA_FRACTION = 10.
+    index.insert(triples[200:])
+    reference = FilterIndex.from_triples(triples, 40)
+    for relation in range(3):
+        for anchor in range(40):
+            for head_is_missing in (False, True):
+                np.testing.assert_array_equal(index.answers(relation, anchor, head_is_missing),
+                                              reference.answers(relation, anchor, head_is_missing))
+
+
+def test_insert_returns_changed_rows():
+    triples = np.array([[0, 0, 1], [0, 0, 2], [3, 1, 0]])
+    index = FilterIndex.from_triples(triples, 5)
+    assert len(index.insert(triples[:2])) == 0
+    changed = index.insert(np.array([[0, 0, 4]]))
+    expected = FilterIndex.row_keys(np.array([0, 0]), np.array([0, 4]), np.array([False, True]), 5)
+    np.testing.assert_array_equal(changed, np.sort(expected))
+    np.testing.assert_array_equal(index.answers(0, 0, False), [1, 2, 4])
+
+
+def test_copy_keeps_the_delta():
+    triples = random_triples(300, seed=4)
+    index = FilterIndex.from_triples(triples[:200], 40)
+    index.MAX_DELTA_FRACTION = 10.
+    index.insert(triples[200:])
+    compacted = index.copy().compact()
+    assert index._delta is not None
+    assert_same_csr(compacted, FilterIndex.from_triples(triples, 40))
+
+
+def test_resize_equals_rebuild():
+    triples = random_triples(300, seed=5)
+    index = FilterIndex.from_triples(triples[:200], 40)
+    index.MAX_DELTA_FRACTION = 10.
+    index.insert(triples[200:])
+    index.resize(50)
+    new = np.array([[45, 1, 3], [2, 0, 49]])
+    index.insert(new)
+    assert_same_csr(index.compact(), FilterIndex.from_triples(np.concatenate([triples, new]), 50))
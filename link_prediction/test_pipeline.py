@@ -0,0 +1,109 @@
+import importlib
+import sys
+
+from pipeline import Pipeline
+
+
+def data(n):
+    return list(range(n))
+
+
+def total(data, scale):
+    return scale * sum(data)
+
+
+def report(total):
+    return f"total {total}"
+
+
+def make_pipeline(cache_dir, **params):
+    pipeline = Pipeline(str(cache_dir), **params)
+    pipeline.add("data", data, params=("n",))
+    pipeline.add("total", total, inputs=("data",), params=("scale",))
+    pipeline.add("report", report, inputs=("total",))
+    return pipeline
+
+
+def test_cached_run(tmp_path):
+    pipeline = make_pipeline(tmp_path, n=4, scale=1)
+    assert pipeline.run()["report"] == "total 6"
+    assert pipeline.executed == ["data", "total", "report"]
+    assert pipeline.run()["report"] == "total 6"
+    assert pipeline.executed == []
+    # A new pipeline loads the outputs from cache_dir
+    pipeline = make_pipeline(tmp_path, n=4, scale=1)
+    assert pipeline.run(["report"]) == {"report": "total 6"}
+    assert pipeline.executed == []
+
+
+def test_parameter_change_reruns_downstream(tmp_path):
+    pipeline = make_pipeline(tmp_path, n=4, scale=1)
+    pipeline.run()
+    assert pipeline.run(scale=2)["report"] == "total 12"
+    assert sorted(pipeline.executed) == ["report", "total"]
+    assert pipeline.run(n=5, scale=2)["report"] == "total 20"
+    assert sorted(pipeline.executed) == ["data", "report", "total"]
+    # Back to the first values, everything is cached
+    pipeline.run()
+    assert pipeline.executed == []
+
+
+def test_sweep_shares_upstream_stages(tmp_path):
+    pipeline = make_pipeline(tmp_path, n=4)
+    results = pipeline.sweep(["report"], scale=[1, 2, 3])
+    assert [outputs["report"] for _, outputs in results] == ["total 6", "total 12", "total 18"]
+    assert pipeline.executed.count("data") == 1
+    assert pipeline.executed.count("total") == 3
+
+
+def test_code_change_reruns_downstream(tmp_path, monkeypatch):
+    code = tmp_path / "code"
+    code.mkdir()
+    monkeypatch.syspath_prepend(str(code))
+    (code / "helpers.py").write_text("def offset():\n    return 1\n")
+    (code / "stages.py").write_text(
+        "from helpers import offset\n\n\n"
+        "def first(n):\n    return n\n\n\n"
+        "def second(first):\n    return first + offset()\n")
+
+    def run():
+        for name in ("helpers", "stages"):
+            sys.modules.pop(name, None)
+        stages = importlib.import_module("stages")
+        pipeline = Pipeline(str(tmp_path / "cache"), n=1)
+        pipeline.add("first", stages.first, params=("n",))
+        pipeline.add("second", stages.second, inputs=("first",))
+        return pipeline.run()["second"], sorted(pipeline.executed)
+
+    assert run() == (2, ["first", "second"])
+    assert run() == (2, [])
+    # The module of a function the stage refers to changed
+    (code / "helpers.py").write_text("def offset():\n    return 10\n")
+    assert run() == (11, ["second"])
+    # The stage function itself changed
+    (code / "stages.py").write_text(
+        "from helpers import offset\n\n\n"
+        "def first(n):\n    return n\n\n\n"
+        "def second(first):\n    return first + 2 * offset()\n")
+    assert run() == (21, ["second"])
+
+
+def test_files_stage_reruns_when_its_file_is_gone(tmp_path):
+    fname = tmp_path / "out.txt"
+
+    def write(n):
+        fname.write_text(str(n))
+        return [str(fname)]
+
+    pipeline = Pipeline(str(tmp_path / "cache"), n=3)
+    pipeline.add("write", write, params=("n",), files=True)
+    pipeline.run()
+    pipeline.run()
+    assert pipeline.executed == []
+    fname.unlink()
+    pipeline.run()
+    assert pipeline.executed == ["write"]
+    # Overwritten by another parameter value
+    pipeline.run(n=4)
+    pipeline.run(n=3)
+    assert pipeline.executed == ["write"]
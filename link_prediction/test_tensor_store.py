@@ -0,0 +1,41 @@
+import numpy as np
+
+from tensor_store import TensorStore
+
+
+def test_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(3, 10, 7)).astype(np.float32)
+    store = TensorStore.create(str(tmp_path / "scores"), 10, (7,), query_chunk=4, meta={"seed": 0})
+    store.append_model(values[0], name="h0")
+    store.append_model(lambda start, stop: values[1, start:stop])
+    store.append_model(values[2])
+
+    reopened = TensorStore(str(tmp_path / "scores"))
+    assert reopened.shape == (3, 10, 7)
+    assert reopened.models == ["h0", "h1", "h2"]
+    assert reopened.n_chunks == 3
+    np.testing.assert_array_equal(reopened.read_slice(), values)
+    np.testing.assert_array_equal(reopened.read_slice(1, slice(3, 9)), values[1, 3:9])
+    np.testing.assert_array_equal(reopened.read_slice([2, 0], slice(5, 6)), values[[2, 0], 5:6])
+    np.testing.assert_array_equal(reopened[:, 2:7], values[:, 2:7])
+    np.testing.assert_array_equal(reopened[:, 9], values[:, 9])
+    np.testing.assert_array_equal(reopened[0, 4], values[0, 4])
+    np.testing.assert_array_equal(reopened.values_fn(2)(1, 8), values[2, 1:8])
+
+
+def test_scalar_items(tmp_path):
+    ranks = np.arange(9, dtype=np.float64)
+    store = TensorStore.create(str(tmp_path / "ranks"), 9, dtype="float64", query_chunk=5)
+    store.append_model(ranks)
+    assert store.shape == (1, 9)
+    np.testing.assert_array_equal(TensorStore(str(tmp_path / "ranks"))[0], ranks)
+
+
+def test_open_or_create(tmp_path):
+    path = str(tmp_path / "scores")
+    store = TensorStore.open_or_create(path, 6, (2,), query_chunk=4, meta={"k": (1, 2)})
+    store.append_model(np.ones((6, 2)))
+    # Same tensor and meta data (tuples are stored as lists): the models are kept
+    assert TensorStore.open_or_create(path, 6, (2,), meta={"k": (1, 2)}).n_models == 1
+    assert TensorStore.open_or_create(path, 6, (2,), meta={"k": (1, 3)}).n_models == 0
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from voting_methods import (Borda, Majority, PartialBorda, PartialMajority, PartialRange, Range,
+                            average_ranks, top_k_lists)
+
+
+N_CLF, N_QUERIES, N_ENTITIES = 5, 7, 12
+
+
+def scores(ties: bool, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    if ties:
+        return rng.integers(0, 4, (N_CLF, N_QUERIES, N_ENTITIES)).astype(np.float64)
+    return rng.normal(size=(N_CLF, N_QUERIES, N_ENTITIES))
+
+
+def test_average_ranks():
+    values = np.array([[3., 1., 3., 2., 1., 3.]])
+    np.testing.assert_array_equal(average_ranks(values), [[4., 0.5, 4., 2., 0.5, 4.]])
+
+
+@pytest.mark.parametrize("partial, full, ties", [(PartialMajority, Majority, False),
+                                                  (PartialBorda, Borda, False),
+                                                  (PartialBorda, Borda, True),
+                                                  (PartialRange, Range, False),
+                                                  (PartialRange, Range, True)])
+def test_full_lists_equal_full_voting(partial, full, ties):
+    values = scores(ties)
+    expected = full()(values)
+    np.testing.assert_allclose(partial(k=N_ENTITIES)(values), expected)
+    # A single query, (n_clf, n_entities)
+    np.testing.assert_allclose(partial(k=N_ENTITIES)(values[:, 0]), expected[0])
+
+
+@pytest.mark.parametrize("partial, full", [(PartialBorda, Borda), (PartialRange, Range)])
+def test_vote_lists_at_full_length(partial, full):
+    values = scores(ties=True, seed=1)
+    expected = full()(values)
+    candidates, votes = partial(k=N_ENTITIES).vote_lists(*top_k_lists(values, N_ENTITIES), N_ENTITIES)
+    assert candidates.shape == (N_QUERIES, N_ENTITIES)
+    np.testing.assert_array_equal(np.sort(candidates, axis=-1), np.broadcast_to(np.arange(N_ENTITIES), candidates.shape))
+    np.testing.assert_allclose(votes, np.take_along_axis(expected, candidates, axis=-1))
+    # Best first
+    assert np.all(np.diff(votes, axis=-1) <= 0)
+
+
+def test_unlisted_entities():
+    values = scores(ties=False, seed=2)
+    voted = PartialBorda(k=2)(values)
+    top, _ = top_k_lists(values, 2)
+    listed = np.zeros(voted.shape, dtype=bool)
+    for model_top in top:
+        listed[np.arange(N_QUERIES)[:, None], model_top] = True
+    assert np.all(np.isfinite(voted) == listed)
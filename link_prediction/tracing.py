@@ -0,0 +1,199 @@
+# Lightweight tracing of the pipeline stages (fit, predict, ranking, voting, metrics, plotting)
+#
+# Usage:
+#     import tracing
+#     tracing.enable(memory=True)
+#     with tracing.span("predict", model="KGE_model_1") as sp:
+#         preds = model.predict_w_truth_prob(...)
+#         sp.add_arrays(preds)
+#     tracing.export_chrome_trace("trace.json")
+#     print(tracing.summary())
+#
+# When tracing is disabled `span` returns a shared no-op object, so the
+# instrumentation can stay in the code at (almost) no cost.
+#
+# Threads: the tracemalloc peak is one per process, so only spans of the main thread
+# measure memory, their peak includes the allocations of all threads (e.g. of the
+# workers of parallel_eval). Spans of other threads report a mem_peak of 0. Likewise
+# the cpu time of a main thread span is the process time (all threads), of another
+# thread's span the time of that thread.
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+
+class _NullSpan():
+    """ Returned by `span` while tracing is disabled """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def add_arrays(self, *arrays):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span():
+    def __init__(self, tracer, name: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.array_bytes = 0
+        self.mem_peak = 0
+        self._abs_peak = 0
+
+    def add_arrays(self, *arrays):
+        """ Records the bytes of arrays allocated within this stage
+        """
+        for a in arrays:
+            self.array_bytes += np.asarray(a).nbytes
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self._main = threading.current_thread() is threading.main_thread()
+        self._clock = time.process_time if self._main else time.thread_time
+        if self.tracer.memory and self._main:
+            current, peak = tracemalloc.get_traced_memory()
+            # Hand the peak seen so far to the enclosing spans before resetting it
+            for parent in stack:
+                parent._abs_peak = max(parent._abs_peak, peak)
+            tracemalloc.reset_peak()
+            self._mem_start = current
+            self._abs_peak = current
+        stack.append(self)
+        self._cpu_start = self._clock()
+        self._wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wall = time.perf_counter() - self._wall_start
+        self.cpu = self._clock() - self._cpu_start
+        stack = self.tracer._stack()
+        stack.pop()
+        if self.tracer.memory and self._main:
+            self._abs_peak = max(self._abs_peak, tracemalloc.get_traced_memory()[1])
+            self.mem_peak = self._abs_peak - self._mem_start
+            if stack:
+                stack[-1]._abs_peak = max(stack[-1]._abs_peak, self._abs_peak)
+        # Nested spans also count towards the array bytes of their parent
+        if stack:
+            stack[-1].array_bytes += self.array_bytes
+        self.tracer._record(self)
+        return False
+
+
+class Tracer():
+    def __init__(self, memory: bool = False):
+        self.memory = memory
+        self.events = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, sp: Span):
+        event = {"name": sp.name,
+                 "ts": (sp._wall_start - self._t0) * 1e6,
+                 "dur": sp.wall * 1e6,
+                 "cpu": sp.cpu,
+                 "mem_peak": sp.mem_peak,
+                 "array_bytes": sp.array_bytes,
+                 "tid": threading.get_ident(),
+                 "args": sp.args}
+        with self._lock:
+            self.events.append(event)
+
+    def span(self, name: str, **args) -> Span:
+        return Span(self, name, args)
+
+    def to_chrome_trace(self) -> dict:
+        """ Complete ("X") events of the Chrome trace event format,
+        can be opened in chrome://tracing or https://ui.perfetto.dev
+        """
+        pid = os.getpid()
+        trace_events = []
+        for ev in self.events:
+            args = {str(k): str(v) for k, v in ev["args"].items()}
+            args.update(cpu_ms=round(ev["cpu"] * 1e3, 3),
+                        mem_peak_bytes=ev["mem_peak"],
+                        array_bytes=ev["array_bytes"])
+            trace_events.append({"name": ev["name"], "ph": "X", "cat": "kge",
+                                 "ts": ev["ts"], "dur": ev["dur"],
+                                 "pid": pid, "tid": ev["tid"], "args": args})
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def summary(self) -> str:
+        """ Table aggregated over all spans of the same name
+        """
+        rows = {}
+        for ev in self.events:
+            row = rows.setdefault(ev["name"], [0, 0., 0., 0, 0])
+            row[0] += 1
+            row[1] += ev["dur"] / 1e6
+            row[2] += ev["cpu"]
+            row[3] = max(row[3], ev["mem_peak"])
+            row[4] += ev["array_bytes"]
+
+        header = f"{'stage':<24}{'calls':>7}{'wall [s]':>11}{'cpu [s]':>11}{'peak [MiB]':>12}{'arrays [MiB]':>14}"
+        lines = [header, "-" * len(header)]
+        for name, (calls, wall, cpu, peak, nbytes) in sorted(rows.items(), key=lambda r: -r[1][1]):
+            lines.append(f"{name:<24}{calls:>7}{wall:>11.4f}{cpu:>11.4f}{peak / 2**20:>12.2f}{nbytes / 2**20:>14.2f}")
+        return "\n".join(lines)
+
+
+_tracer = None
+
+
+def enable(memory: bool = False) -> Tracer:
+    """ Starts recording spans, with `memory=True` also the tracemalloc peak per span
+    """
+    global _tracer
+    _tracer = Tracer(memory=memory)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return _tracer
+
+
+def disable() -> Tracer:
+    """ Stops recording and returns the tracer holding the recorded spans
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None and tracer.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return tracer
+
+
+def is_enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, **args):
+    """ Context manager timing the enclosed stage, no-op while tracing is disabled
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, **args)
+
+
+def export_chrome_trace(fname: str, tracer: Tracer = None):
+    tracer = tracer or _tracer
+    with open(fname, "w") as f:
+        json.dump(tracer.to_chrome_trace(), f)
+
+
+def summary(tracer: Tracer = None) -> str:
+    tracer = tracer or _tracer
+    return tracer.summary()
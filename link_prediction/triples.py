@@ -0,0 +1,98 @@
+# Integer encoding of the triples
+#
+# Entities and relations are mapped to ids, every split is stored as an
+# int32 array of shape (n_triples, 3) with the columns (head, relation, tail).
+
+from typing import Iterable
+
+import numpy as np
+
+from query import Query
+
+
+HEAD, RELATION, TAIL = 0, 1, 2
+
+
+class TripleStore():
+    def __init__(self, entities: Iterable[str], relations: Iterable[str] = ()):
+        self.entities = list(entities)
+        self.entity_to_id = {e: i for i, e in enumerate(self.entities)}
+        self.relations = []
+        self.relation_to_id = {}
+        for r in relations:
+            self._relation_id(r)
+        self.splits = {}
+
+    @property
+    def n_entities(self) -> int:
+        return len(self.entities)
+
+    @property
+    def n_relations(self) -> int:
+        return len(self.relations)
+
+    def _relation_id(self, relation: str) -> int:
+        if relation not in self.relation_to_id:
+            self.relation_to_id[relation] = len(self.relations)
+            self.relations.append(relation)
+        return self.relation_to_id[relation]
+
+    def add_entities(self, entities: Iterable[str]) -> np.ndarray:
+        """ Appends the unknown entities, returns the ids of the new ones
+        """
+        new = []
+        for e in entities:
+            if e not in self.entity_to_id:
+                self.entity_to_id[e] = len(self.entities)
+                self.entities.append(e)
+                new.append(self.entity_to_id[e])
+        return np.array(new, dtype=np.int32)
+
+    def add_relations(self, relations: Iterable[str]) -> np.ndarray:
+        """ Appends the unknown relations, returns the ids of the new ones
+        """
+        n = self.n_relations
+        for r in relations:
+            self._relation_id(r)
+        return np.arange(n, self.n_relations, dtype=np.int32)
+
+    def encode(self, triples: Iterable[tuple]) -> np.ndarray:
+        """ (head, relation, tail[, ...]) names -> int32 array (n_triples, 3)
+
+        Additional columns, e.g. the truth_prob of the test relations, are ignored.
+        Unknown relations are added, unknown entities raise a KeyError.
+        """
+        encoded = [(self.entity_to_id[t[0]], self._relation_id(t[1]), self.entity_to_id[t[2]])
+                   for t in triples]
+        return np.array(encoded, dtype=np.int32).reshape(-1, 3)
+
+    def decode(self, triples: np.ndarray) -> list:
+        return [(self.entities[h], self.relations[r], self.entities[t]) for h, r, t in triples]
+
+    def add(self, split: str, triples: Iterable[tuple]) -> np.ndarray:
+        """ Appends the triples to the split (e.g. "train", "valid", "test")
+        """
+        encoded = self.encode(triples)
+        if split in self.splits:
+            self.splits[split] = np.concatenate([self.splits[split], encoded])
+        else:
+            self.splits[split] = encoded
+        return encoded
+
+    def all_triples(self, splits: Iterable[str] = None) -> np.ndarray:
+        splits = self.splits.keys() if splits is None else splits
+        arrays = [self.splits[s] for s in splits if s in self.splits]
+        if not arrays:
+            return np.zeros((0, 3), dtype=np.int32)
+        return np.concatenate(arrays)
+
+    def encode_queries(self, queries: Iterable[Query]) -> tuple:
+        """ Queries -> (relations, anchors, head_is_missing) arrays
+        """
+        relations = np.array([self._relation_id(q.relation) for q in queries], dtype=np.int32)
+        anchors = np.array([self.entity_to_id[q.value] for q in queries], dtype=np.int32)
+        head_is_missing = np.array([q.head_is_missing for q in queries], dtype=bool)
+        return relations, anchors, head_is_missing
+
+    def encode_entities(self, entities: Iterable[str]) -> np.ndarray:
+        return np.array([self.entity_to_id[e] for e in entities], dtype=np.int32)
@@ -3,6 +3,25 @@
 
 import numpy as np
 
+def average_ranks(values: np.ndarray) -> np.ndarray:
+    """ 0-based ascending rank along the last axis, tied values get the mean of their ranks
+    (as scipy.stats.rankdata(method="average") - 1)
+    """
+    order = np.argsort(values, axis=-1, kind="stable")
+    sorted_values = np.take_along_axis(values, order, axis=-1)
+    n = values.shape[-1]
+    positions = np.broadcast_to(np.arange(n), values.shape)
+    # First and last position of the group of equal values of every position
+    new = np.ones(values.shape, dtype=bool)
+    new[..., 1:] = sorted_values[..., 1:] != sorted_values[..., :-1]
+    first = np.maximum.accumulate(np.where(new, positions, 0), axis=-1)
+    last = np.flip(np.minimum.accumulate(np.flip(np.where(np.roll(new, -1, axis=-1), positions, n - 1), axis=-1),
+                                         axis=-1), axis=-1)
+    ranks = np.empty(values.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2, axis=-1)
+    return ranks
+
+
 class VotingMethod:
     def __init__(self):
         pass
@@ -11,32 +30,204 @@ class VotingMethod:
         """ Voting metod from social choice theory
 
         Expects the predicted values from multiple classifiers of
-        shape (n_clf, n_queries, n_entities)
-        for making a table n_queries=1 is required which automatically drops the dimension
+        shape (n_clf, n_queries, n_entities) or (n_clf, n_entities)
 
         Returns:
-            np.ndarray: _description_
+            np.ndarray: aggregated score of shape (n_queries, n_entities) or (n_entities,),
+                        higher is better
         """
         raise NotImplementedError
-    
+
 
 class Majority(VotingMethod):
     def __str__(self):
         return "Majority"
-    
+
     def __call__(self, predicted_values: np.ndarray) -> np.ndarray:
-        return np.argmax(predicted_values, axis=-1)
+        # Every classifier votes for its top entity
+        n_entities = predicted_values.shape[-1]
+        winners = np.argmax(predicted_values, axis=-1).reshape(len(predicted_values), -1)
+        votes = np.zeros((winners.shape[1], n_entities))
+        rows = np.arange(winners.shape[1])
+        for w in winners:
+            votes[rows, w] += 1
+        return votes.reshape(predicted_values.shape[1:])
 
 class Borda(VotingMethod):
     def __str__(self):
         return "Borda"
-    
+
     def __call__(self, predicted_values: np.ndarray) -> np.ndarray:
-        # TODO:
-        return (np.argsort(-predicted_values, axis=-1), np.arange(predicted_values.shape[-1]))
+        # An entity on rank r gets (n_entities - 1 - r) points from every classifier,
+        # i.e. one per entity it beats, tied entities share their ranks equally
+        return average_ranks(predicted_values).sum(axis=0)
 
 class Range(VotingMethod):
     def __str__(self):
         return "Range"
     def __call__(self, predicted_values: np.ndarray) -> np.ndarray:
-        return np.argmax(predicted_values, axis=-1)
\ No newline at end of file
+        # Rescale every classifier to [-1, 1] and sum up (see helper_table.py)
+        if not np.issubdtype(predicted_values.dtype, np.floating):
+            predicted_values = predicted_values.astype(np.float32)
+        v_min = predicted_values.min(axis=-1, keepdims=True)
+        v_max = predicted_values.max(axis=-1, keepdims=True)
+        span = np.where(v_max > v_min, v_max - v_min, 1.)
+        return (2 * (predicted_values - v_min) / span - 1).sum(axis=0)
+
+
+class Copeland(VotingMethod):
+    def __init__(self, k: int = 10):
+        # Pairwise contests only between the candidates in the top-k of any classifier
+        self.k = k
+
+    def __str__(self):
+        return "Copeland"
+
+    def __call__(self, predicted_values: np.ndarray) -> np.ndarray:
+        # An entity gets 1 point for every candidate it beats in a pairwise majority and
+        # 1/2 for a tie. Entities outside the top-k of all classifiers get -inf.
+        shape = predicted_values.shape
+        predicted_values = predicted_values.reshape(shape[0], -1, shape[-1])
+        n_clf, n_queries, n_entities = predicted_values.shape
+        k = min(self.k, n_entities)
+
+        # Union of the top-k per query: duplicates are pushed behind the unique ids
+        top = np.argpartition(-predicted_values, k - 1, axis=-1)[..., :k]
+        ids = np.sort(top.transpose(1, 0, 2).reshape(n_queries, -1), axis=-1)
+        ids[:, 1:][ids[:, 1:] == ids[:, :-1]] = n_entities
+        ids = np.sort(ids, axis=-1)
+        valid = ids < n_entities
+        n_candidates = valid.sum(axis=-1).max()
+        ids, valid = ids[:, :n_candidates], valid[:, :n_candidates]
+        candidates = np.where(valid, ids, 0)
+
+        # Win matrix (n_queries, k', k'): number of classifiers preferring i over j
+        wins = np.zeros((n_queries, n_candidates, n_candidates), dtype=np.int32)
+        for values in predicted_values:
+            s = np.take_along_axis(values, candidates, axis=-1)
+            wins += s[:, :, None] > s[:, None, :]
+        contest = valid[:, :, None] & valid[:, None, :]
+        beats = (wins > wins.transpose(0, 2, 1)) & contest
+        ties = (wins == wins.transpose(0, 2, 1)) & contest
+        points = beats.sum(axis=-1) + (ties.sum(axis=-1) - 1) / 2
+
+        result = np.full((n_queries, n_entities), -np.inf)
+        rows = np.broadcast_to(np.arange(n_queries)[:, None], ids.shape)
+        result[rows[valid], ids[valid]] = points[valid]
+        return result.reshape(shape[1:])
+
+
+# Voting on truncated rankings
+#
+# Every model only ships its top-k as (index, score) lists of shape (n_clf, n_queries, k).
+# The votes are aggregated over the union of the listed candidates per query,
+# entities a model did not list get the tail credit of the method.
+# vote_lists works on the lists, __call__ takes the full scores like every VotingMethod
+# and gives -inf to the entities no model listed.
+
+def top_k_lists(predicted_values: np.ndarray, k: int) -> tuple:
+    """ (n_clf, n_queries, n_entities) scores -> top-k (indices, scores), best first
+    """
+    top = np.argpartition(-predicted_values, k - 1, axis=-1)[..., :k]
+    top_scores = np.take_along_axis(predicted_values, top, axis=-1)
+    order = np.argsort(-top_scores, axis=-1, kind="stable")
+    return np.take_along_axis(top, order, axis=-1), np.take_along_axis(top_scores, order, axis=-1)
+
+
+class PartialVotingMethod(VotingMethod):
+    name = None
+
+    def __init__(self, k: int = 10):
+        # Length of the list of every model
+        self.k = k
+
+    def __str__(self):
+        return f"{self.name}@{self.k}"
+
+    # Points of an entity a model did not list
+    def tail_credit(self, n_entities: int, k: int) -> float:
+        return 0.
+
+    def points(self, top_scores: np.ndarray, n_entities: int) -> np.ndarray:
+        """ Points of the listed entities, top_scores is sorted best first
+        """
+        raise NotImplementedError
+
+    def __call__(self, predicted_values: np.ndarray) -> np.ndarray:
+        # Vote on the top-k lists of the full scores, the entities no model listed get -inf
+        shape = predicted_values.shape
+        predicted_values = predicted_values.reshape(shape[0], -1, shape[-1])
+        n_clf, n_queries, n_entities = predicted_values.shape
+        candidates, votes = self.vote_lists(*top_k_lists(predicted_values, min(self.k, n_entities)), n_entities)
+        result = np.full((n_queries, n_entities), -np.inf)
+        listed = candidates >= 0
+        rows = np.broadcast_to(np.arange(n_queries)[:, None], candidates.shape)
+        result[rows[listed], candidates[listed]] = votes[listed]
+        return result.reshape(shape[1:])
+
+    def vote_lists(self, top_indices: np.ndarray, top_scores: np.ndarray, n_entities: int) -> tuple:
+        """ Voting over the union of the candidates of all models
+
+        Input:
+            top_indices, top_scores: (n_clf, n_queries, k), sorted best first per list
+        Returns:
+            candidates: (n_queries, n_candidates) entity indices, best first, padded with -1
+            votes: (n_queries, n_candidates) aggregated score, padded with -inf
+        """
+        n_clf, n_queries, k = top_indices.shape
+        points = self.points(top_scores, n_entities)
+
+        # Sorted merge of all lists: one key per (query, entity)
+        keys = (np.arange(n_queries)[None, :, None] * n_entities + top_indices).ravel()
+        union, inverse = np.unique(keys, return_inverse=True)
+        votes = np.bincount(inverse, weights=points.ravel(), minlength=len(union))
+        n_listed = np.bincount(inverse, minlength=len(union))
+        votes += (n_clf - n_listed) * self.tail_credit(n_entities, k)
+
+        # Scatter into (n_queries, n_candidates), best first
+        query = union // n_entities
+        order = np.lexsort((-votes, query))
+        counts = np.bincount(query, minlength=n_queries)
+        column = np.arange(len(union)) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = np.full((n_queries, counts.max(initial=0)), -1, dtype=np.int64)
+        result = np.full(candidates.shape, -np.inf)
+        candidates[query[order], column] = union[order] % n_entities
+        result[query[order], column] = votes[order]
+        return candidates, result
+
+
+class PartialMajority(PartialVotingMethod):
+    name = "Majority"
+
+    def points(self, top_scores, n_entities):
+        points = np.zeros(top_scores.shape)
+        points[..., 0] = 1
+        return points
+
+
+class PartialBorda(PartialVotingMethod):
+    name = "Borda"
+
+    def tail_credit(self, n_entities, k):
+        # Mean of the points of the ranks k..n_entities-1
+        return max(n_entities - k - 1, 0) / 2
+
+    def points(self, top_scores, n_entities):
+        # n_entities - 1 - position in the list, tied scores share their positions
+        return n_entities - top_scores.shape[-1] + average_ranks(top_scores)
+
+
+class PartialRange(PartialVotingMethod):
+    name = "Range"
+
+    def tail_credit(self, n_entities, k):
+        # Unlisted entities score at most the bottom of the list
+        return -1.
+
+    def points(self, top_scores, n_entities):
+        # Rescale every list to [-1, 1], the full range is unknown to the voter
+        top_scores = np.asarray(top_scores, dtype=np.float64)
+        v_min = top_scores.min(axis=-1, keepdims=True)
+        v_max = top_scores.max(axis=-1, keepdims=True)
+        span = np.where(v_max > v_min, v_max - v_min, 1.)
+        return 2 * (top_scores - v_min) / span - 1